@@ -4,27 +4,38 @@ from typing import Callable, TYPE_CHECKING
 import numpy as np
 
 from seg2link import parameters
-from seg2link.misc import flatten_2d_list, get_unused_labels_quick
+from seg2link.misc import get_unused_labels_quick
 
 if TYPE_CHECKING:
     from seg2link.seg2link_round1 import Seg2LinkR1
 
 
+def assert_relabeled_by_values(labels_old: np.ndarray, labels_new: np.ndarray):
+    """Positions sharing a label should still share a label after merge/delete/link (the labels stored as disjoint
+    sets should give the same results as replacing the values in the flat label list)"""
+    pairs = np.unique(np.stack((labels_old, labels_new)), axis=1)
+    assert len(np.unique(pairs[0])) == pairs.shape[1], \
+        f"Some label was transformed into multiple labels: {pairs.T.tolist()}"
+
+
 def test_merge_r1(emseg1: "Seg2LinkR1"):
     """Merge will generate unused_labels except for the minimum (target) label"""
     def deco(func: Callable) -> Callable:
         def wrapper(*args, **kwargs):
             if parameters.DEBUG:
                 seg_old = emseg1.vis.viewer.layers["segmentation"].data.copy()
-                labels_old = np.array(flatten_2d_list(emseg1.labels._labels)[0])
+                labels_old = np.array(emseg1.labels.flatten()[0])
                 merge_list = copy.deepcopy(emseg1.label_list)
                 unused_labels_old = emseg1.labels.cal_unused_labels()
 
                 func(*args, **kwargs)
                 seg_new = emseg1.vis.viewer.layers["segmentation"].data.copy()
-                labels_new = np.array(flatten_2d_list(emseg1.labels._labels)[0])
+                labels_new = np.array(emseg1.labels.flatten()[0])
                 unused_labels_new = emseg1.labels.cal_unused_labels()
 
+                assert_relabeled_by_values(labels_old, labels_new)
+                unmerged = ~np.isin(labels_old, list(merge_list))
+                assert np.array_equal(labels_new[unmerged], labels_old[unmerged]), "Labels not merged were modified"
                 for label in merge_list:
                     assert np.all(labels_new[labels_old == label] == min(merge_list)), \
                         f"Label{label} was not merged correctly (Label part)"
@@ -50,7 +61,7 @@ def test_delete_r1(emseg1: "Seg2LinkR1"):
         def wrapper(*args, **kwargs):
             if parameters.DEBUG:
                 seg_old = emseg1.vis.viewer.layers["segmentation"].data.copy()
-                labels_old = np.array(flatten_2d_list(emseg1.labels._labels)[0])
+                labels_old = np.array(emseg1.labels.flatten()[0])
                 unused_labels_old = emseg1.labels.cal_unused_labels()
                 if emseg1.label_list:
                     delete_list = copy.deepcopy(emseg1.label_list)
@@ -58,9 +69,12 @@ def test_delete_r1(emseg1: "Seg2LinkR1"):
                     delete_list = [emseg1.vis.viewer.layers["segmentation"].selected_label]
                 func(*args, **kwargs)
                 seg_new = emseg1.vis.viewer.layers["segmentation"].data.copy()
-                labels_new = np.array(flatten_2d_list(emseg1.labels._labels)[0])
+                labels_new = np.array(emseg1.labels.flatten()[0])
                 unused_labels_new = emseg1.labels.cal_unused_labels()
 
+                assert_relabeled_by_values(labels_old, labels_new)
+                undeleted = ~np.isin(labels_old, list(delete_list))
+                assert np.array_equal(labels_new[undeleted], labels_old[undeleted]), "Labels not deleted were modified"
                 for label in delete_list:
                     assert np.all(labels_new[labels_old == label] == 0), \
                         f"Label{label} was not deleted correctly (Label part)"
@@ -86,7 +100,7 @@ def test_divide_r1(emseg1: "Seg2LinkR1"):
 
                 slice = emseg1.current_slice - emseg1.vis.get_slice(emseg1.current_slice).start - 1
                 seg_old = emseg1.vis.viewer.layers["segmentation"].data[..., slice].copy()
-                labels_old = np.array(flatten_2d_list(emseg1.labels._labels)[0])
+                labels_old = np.array(emseg1.labels.flatten()[0])
                 unused_labels_old = emseg1.labels.cal_unused_labels()
 
                 func(*args, **kwargs)
@@ -115,9 +129,10 @@ def test_link_r1(emseg1: "Seg2LinkR1"):
     def deco(func: Callable) -> Callable:
         def wrapper(*args, **kwargs):
             if parameters.DEBUG:
-                labels_old = np.array(flatten_2d_list(emseg1.labels._labels)[0])
+                labels_old = np.array(emseg1.labels.flatten()[0])
                 func(*args, **kwargs)
-                labels_new = np.array(flatten_2d_list(emseg1.labels._labels)[0])
+                labels_new = np.array(emseg1.labels.flatten()[0])
+                assert_relabeled_by_values(labels_old, labels_new[:len(labels_old)])
 
                 sorted_labels_new = np.unique(labels_new)
                 sorted_labels_new = sorted_labels_new[sorted_labels_new > 0]
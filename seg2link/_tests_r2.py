@@ -30,6 +30,7 @@ def test_merge_r2(emseg2: "Seg2LinkR2"):
                         assert label in unused_labels_new or label > np.max(labels_new), \
                             f"label {label} should be in unused_labels_new"
                 print("Unused labels:", emseg2.cache_bbox.unused_labels)
+                assert_label_stats(emseg2, merge_list)
                 print("Merge test was passed")
             else:
                 func(*args, **kwargs)
@@ -56,6 +57,7 @@ def test_delete_r2(emseg2: "Seg2LinkR2"):
                     assert label in unused_labels_new or label > np.max(labels_new), \
                         f"label {label} should be in unused_labels_new"
                 print("Unused labels:", emseg2.cache_bbox.unused_labels)
+                assert_label_stats(emseg2, delete_list)
                 print("Delete test was passed")
             else:
                 func(*args, **kwargs)
@@ -90,9 +92,23 @@ def test_divide_r2(emseg2: "Seg2LinkR2"):
                 for label in labels_divided_set:
                     assert label not in unused_labels_new, f"label {label} should not be in unused_labels_new"
                 print("Unused labels:", emseg2.cache_bbox.unused_labels)
+                assert_label_stats(emseg2, labels_divided_set | {label_ori})
                 print("Divide test was passed")
             else:
                 func(*args, **kwargs)
         return wrapper
     return deco
 
+
+
+def assert_label_stats(emseg2: "Seg2LinkR2", labels):
+    """The statistics updated by the modification should be the same as the ones computed from the image"""
+    for label in labels:
+        voxels = np.argwhere(emseg2.labels == label)
+        stats = emseg2.cache_bbox.stats
+        assert stats.count(label) == len(voxels), \
+            f"label {label}: count {stats.count(label)} != {len(voxels)}"
+        if len(voxels) > 0:
+            assert np.allclose(stats.centroid(label), voxels.mean(axis=0)), f"label {label}: wrong centroid"
+            assert np.array_equal(stats.occupied_slices(label), np.unique(voxels[:, 2])), \
+                f"label {label}: wrong occupied slices"
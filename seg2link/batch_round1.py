@@ -0,0 +1,212 @@
+"""Run the round #1 (Seg2D + Link) on a whole image stack without the napari viewer.
+
+The results are archived in the same History_labels/History_seg folders used by the GUI,
+so the GUI can retrieve and proofread them later.
+
+Usage (command line):
+    seg2link-batch-r1 --cells path/to/cells --result path/to/results [--mask path/to/mask --fill-holes]
+    seg2link-batch-r1 --cells path/to/volume.zarr --cells-key cell_region --result path/to/results
+    seg2link-batch-r1 --config config.ini
+"""
+import argparse
+import time
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Optional, List, Set, Union
+
+import numpy as np
+from numpy import ndarray
+
+from seg2link import parameters
+from seg2link._tests_r1 import test_link_r1
+from seg2link.misc import load_cell_region, load_mask_region
+from seg2link.seg2dlink_core import Labels, Segmentation, Archive, FlatLabels
+from seg2link.slice_cache import SliceCache
+
+
+class Seg2LinkR1Batch:
+    """Segment and link the cells in 3D EM images slice by slice, without visualization"""
+
+    def __init__(self, cell_region: ndarray, mask: Optional[ndarray], enable_mask: bool, layer_num: int,
+                 path_save: Path, ratio_overlap: float, ratio_mask: float):
+        self.current_slice = 0
+        self.layer_num = layer_num
+        self.label_list: Set[int] = set()
+        self.labels_divided: List[int] = []
+        self.archive = Archive(self, path_save)
+        self.archive.make_folders()
+        self.seg_img_cache = SliceCache(self.archive.load_seg_img, parameters.pars.cache_seg_mb_r1 * 2 ** 20,
+                                        batch_loader=self.archive.load_seg_imgs)
+        self.seg = Segmentation(cell_region, enable_mask, mask, ratio_mask)
+        self.labels = Labels(self, ratio_overlap)
+        self.times_per_slice: List[float] = []
+
+    def retrieve_or_restart(self, target_slice: int):
+        """Continue from the target slice stored in the archive, or restart from slice 1 when target_slice is 0"""
+        history = self.archive.retrieve_history(target_slice, self.seg_img_cache)
+        if history is None:
+            self.current_slice = 0
+            self.labels.reset()
+        else:
+            labels, seg_img = history
+            self._set_labels(labels)
+            self.seg.current_seg = seg_img.copy()
+            print(f"Retrieved the slice {self.current_slice}")
+
+    def _set_labels(self, labels: Union[List[List[int]], FlatLabels, Labels]):
+        """Used for setting the possible stored labels: list, flat labels or Labels object"""
+        if isinstance(labels, Labels):
+            self.labels.set_flat(*labels.flatten())
+        elif isinstance(labels, FlatLabels):
+            self.labels.set_flat(*labels)
+        else:
+            self.labels._labels = labels
+        self.current_slice = self.labels.slice_num
+
+    def link_and_relabel(self):
+        @test_link_r1(self)
+        def link_relabel():
+            should_relabel = self.labels.link_or_append_labels()
+            if should_relabel:
+                self.labels.relabel()
+        link_relabel()
+
+    def next_slice(self):
+        """Segment and link the next slice, then archive the result"""
+        self.current_slice += 1
+        self.seg.watershed(self.current_slice)
+        if self.seg.current_seg.max() == 0:
+            print(f"Warning: no cell was detected in slice {self.current_slice}!")
+            self.labels.append_labels(self.seg)
+        else:
+            self.link_and_relabel()
+        self.archive.archive_labels_and_seg2d()
+
+    def run(self, stop_slice: Optional[int] = None):
+        """Process all slices after the current slice until stop_slice (by default the last slice)"""
+        stop_slice = self.layer_num if stop_slice is None else min(stop_slice, self.layer_num)
+        if self.current_slice >= stop_slice:
+            print(f"Slices 1-{self.current_slice} were already processed")
+            return
+        print(f"Segmenting and linking slices {self.current_slice + 1}-{stop_slice}...")
+        t_start = time.perf_counter()
+        num_processed = len(self.times_per_slice)
+        while self.current_slice < stop_slice:
+            t0 = time.perf_counter()
+            self.next_slice()
+            self.times_per_slice.append(time.perf_counter() - t0)
+            self.report_progress(stop_slice)
+        self.archive.flush()
+        self.seg.prefetch.close()
+        self.report_summary(self.times_per_slice[num_processed:], time.perf_counter() - t_start)
+        print(self.seg_img_cache)
+
+    def report_progress(self, stop_slice: int):
+        t = self.times_per_slice[-1]
+        print(f"Slice {self.current_slice}/{stop_slice}: {t:.2f} s, "
+              f"largest label: {self.labels.max_label}")
+
+    @staticmethod
+    def report_summary(times_per_slice: List[float], t_total: float):
+        times = np.asarray(times_per_slice)
+        print(f"Processed {len(times)} slices in {t_total:.1f} s "
+              f"({len(times) / t_total:.2f} slices/s; per slice: mean {times.mean():.2f} s, "
+              f"median {np.median(times):.2f} s, max {times.max():.2f} s)")
+
+
+def run_round1(path_cells: Path, path_result: Path, cell_value: int = 1, threshold_link: float = 0.5,
+               enable_mask: bool = False, path_mask: Optional[Path] = None, mask_value: int = 1,
+               fill_holes: bool = False, threshold_mask: float = 0.8, target_slice: Optional[int] = None,
+               stop_slice: Optional[int] = None, key_cells: str = "", key_mask: str = "") -> Seg2LinkR1Batch:
+    """Segment and link a whole image stack. Continue from the latest archived slice when target_slice is None.
+    The images are folders of TIFF images, or datasets (key_cells/key_mask) in Zarr/N5/HDF5 containers"""
+    Path(path_result).mkdir(parents=True, exist_ok=True)
+    print("Loading cell image... Please wait")
+    cells = load_cell_region(cell_value, path_cells, key_cells)
+    if enable_mask:
+        print("Loading mask image... Please wait")
+        mask = load_mask_region(mask_value, path_mask, fill_holes, key_mask)
+    else:
+        mask = None
+    emseg1 = Seg2LinkR1Batch(cells, mask, enable_mask, cells.shape[2], path_result, threshold_link, threshold_mask)
+    latest_slice = emseg1.archive.latest_slice
+    emseg1.retrieve_or_restart(latest_slice if target_slice is None else min(target_slice, latest_slice))
+    emseg1.run(stop_slice)
+    return emseg1
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Seg2Link round #1 (Seg2D + Link) without GUI. The results can be retrieved in the GUI later.")
+    parser.add_argument("--config", type=Path, help="A config.ini saved from the GUI. "
+                                                    "Paths/parameters given below overwrite the ones in it")
+    parser.add_argument("--cells", type=Path, help="Folder of the cell region images (*.tiff), "
+                                                   "or a Zarr/N5/HDF5 container (with --cells-key)")
+    parser.add_argument("--cells-key", help="Dataset of the cell region images in the container")
+    parser.add_argument("--result", type=Path, help="Folder for storing the results")
+    parser.add_argument("--cell-value", type=int, help="Value of the cell region. Default: 1")
+    parser.add_argument("--threshold-link", type=float, help="Min_Overlap (linking). Default: 0.5")
+    parser.add_argument("--mask", type=Path, help="Folder of the mask images (*.tiff), or a Zarr/N5/HDF5 container "
+                                                  "(with --mask-key). If not set, skip masking")
+    parser.add_argument("--mask-key", help="Dataset of the mask images in the container")
+    parser.add_argument("--mask-value", type=int, help="Value of the mask region. Default: 1")
+    parser.add_argument("--fill-holes", action="store_true", default=None, help="Fill holes in the mask images")
+    parser.add_argument("--threshold-mask", type=float, help="Min_Overlap (masking). Default: 0.8")
+    restart = parser.add_mutually_exclusive_group()
+    restart.add_argument("--restart", action="store_true", help="Delete the archived results and restart from slice 1")
+    restart.add_argument("--from-slice", type=int, help="Continue from this archived slice. Default: the latest one")
+    parser.add_argument("--to-slice", type=int, help="Stop after this slice. Default: the last slice")
+    return parser.parse_args(argv)
+
+
+def _pars_from_config(path_ini: Optional[Path]) -> dict:
+    """Read the paths/parameters saved by the GUI, and apply the advanced parameters"""
+    if path_ini is None:
+        return {}
+    config_ = ConfigParser()
+    if not config_.read(path_ini):
+        raise FileNotFoundError(f"Config file {path_ini} was not found")
+    if config_.has_section("advanced_parameters"):
+        parameters.pars.set_from_dict(dict(config_["advanced_parameters"]))
+    pars_r1r2 = dict(config_["parameters_r1r2"]) if config_.has_section("parameters_r1r2") else {}
+    pars_r1 = dict(config_["parameters_r1"]) if config_.has_section("parameters_r1") else {}
+    pars = {}
+    for key in ("path_cells", "path_mask", "path_result"):
+        if key in pars_r1r2:
+            pars[key] = Path(pars_r1r2[key])
+    for key in ("key_cells", "key_mask"):
+        if pars_r1r2.get(key):
+            pars[key] = pars_r1r2[key]
+    for key in ("cell_value", "mask_value"):
+        if key in pars_r1r2:
+            pars[key] = int(pars_r1r2[key])
+    for key in ("threshold_link", "threshold_mask"):
+        if key in pars_r1:
+            pars[key] = float(pars_r1[key])
+    if "use_mask" in pars_r1:
+        pars["enable_mask"] = pars_r1["use_mask"] == "True"
+    if "use_fill_holes" in pars_r1:
+        pars["fill_holes"] = pars_r1["use_fill_holes"] == "True"
+    return pars
+
+
+def main(argv: Optional[List[str]] = None):
+    args = _parse_args(argv)
+    pars = _pars_from_config(args.config)
+    args_pars = {"path_cells": args.cells, "path_result": args.result, "cell_value": args.cell_value,
+                 "threshold_link": args.threshold_link, "path_mask": args.mask, "mask_value": args.mask_value,
+                 "fill_holes": args.fill_holes, "threshold_mask": args.threshold_mask, "key_cells": args.cells_key,
+                 "key_mask": args.mask_key}
+    pars.update({key: value for key, value in args_pars.items() if value is not None})
+    if args.mask is not None:
+        pars["enable_mask"] = True
+    if pars.get("path_cells") is None or pars.get("path_result") is None:
+        raise ValueError("The folder of cell region images (--cells) and the folder of results (--result) are required")
+    if pars.get("enable_mask") and pars.get("path_mask") is None:
+        raise ValueError("The folder of mask images (--mask) is required when using the mask")
+    target_slice = 0 if args.restart else args.from_slice
+    run_round1(target_slice=target_slice, stop_slice=args.to_slice, **pars)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,21 +16,29 @@ Bbox = Tuple[slice, slice, slice]
 
 
 class CacheBbox:
+    """Bboxes and statistics (see LabelStats) of all labels"""
     def __init__(self, emseg2: "Seg2LinkR2"):
         self.emseg2 = emseg2
         self.seg_shape = self.emseg2.labels.shape
         self.pad = (50, 50, 5)
         self.new_labels = set()
         self.bbox: Dict[int, Bbox] = {}
+        self.stats = LabelStats()
         self.load_or_generate_bbox(emseg2.labels_path)
 
     def load_or_generate_bbox(self, labels_path: Path):
         bbox_path = self.generate_bbox_path(labels_path)
+        stats_path = self.generate_stats_path(labels_path)
         last_modi_time_labels = os.path.getmtime(str(labels_path))
         if bbox_path.exists():
             last_modi_time_bbox = os.path.getmtime(str(bbox_path))
             if last_modi_time_bbox > last_modi_time_labels:
                 self.load_bbox(bbox_path)
+                if stats_path.exists() and os.path.getmtime(str(stats_path)) > last_modi_time_labels:
+                    self.stats.load(stats_path)
+                else:
+                    self.refresh_stats()
+                    self.stats.save(stats_path)
                 return
         self.refresh_bboxes()
         self._save_bbox(bbox_path)
@@ -40,6 +48,10 @@ class CacheBbox:
         with open(bbox_path, 'rb') as f:
             self.bbox = pickle.load(f)
 
+    @property
+    def max_label(self) -> int:
+        return max(self.stats.max_label, max(self.new_labels, default=0))
+
     def cal_unused_labels(self) -> Set[int]:
         return set(get_unused_labels_quick(self.bbox.keys()))
 
@@ -59,11 +71,18 @@ class CacheBbox:
         _subregions = get_all_subregions_3d(self.emseg2.labels)
         self.bbox: Dict[int, Bbox] = {label + 1: bbox for label, bbox in enumerate(_subregions) if bbox is not None}
         self.emseg2.vis.widgets.show_state_info("Bboxes were calculated")
+        self.refresh_stats()
+
+    def refresh_stats(self):
+        self.emseg2.vis.widgets.show_state_info("Calculating statistics of all labels... Please wait")
+        self.stats.compute(self.emseg2.labels)
+        self.emseg2.vis.widgets.show_state_info("Statistics of labels were calculated")
 
     def _save_bbox(self, bbox_path: Path):
         bbox_path.parent.mkdir(parents=True, exist_ok=True)
         with open(bbox_path, 'wb') as f:
             pickle.dump(self.bbox, f, pickle.HIGHEST_PROTOCOL)
+        self.stats.save(bbox_path.parent / (bbox_path.stem + "_stats.pickle"))
 
     def save_bbox(self, labels_path: Path):
         bbox_path = self.generate_bbox_path(labels_path)
@@ -73,6 +92,10 @@ class CacheBbox:
     def generate_bbox_path(labels_path: Path):
         return labels_path.parent / "cache_bbox" / (labels_path.stem + ".pickle")
 
+    @staticmethod
+    def generate_stats_path(labels_path: Path):
+        return labels_path.parent / "cache_bbox" / (labels_path.stem + "_stats.pickle")
+
     def update_bbox_for_division(self, seg_subregion: ndarray, label_ori: int, divide_list: List[int], bbox_with_division: Bbox):
         """Add new divided labels, update changed labels, and delete the removed label after division"""
         bboxes_subregion_with_division = get_all_subregions_3d(seg_subregion)
@@ -170,13 +193,28 @@ class CacheBbox:
         return self.pad_bbox(result)
 
     def update_new_labels(self):
-        new_labels_ = self.new_labels.copy()
-        for label in new_labels_:
+        """Update the bboxes and statistics of the labels inserted (painted) by users, and the statistics of the
+        labels they may have been painted over, i.e. the labels whose bboxes overlap with the painted ones"""
+        if not self.new_labels:
+            return
+        new_labels, self.new_labels = self.new_labels, set()
+        bboxes_painted = []
+        for label in new_labels:
             try:
                 self.bbox[label] = bbox_3D_quick(array_isin_labels_quick(label, self.emseg2.labels))
             except NoLabelError:
                 self.bbox.pop(label)
-            self.new_labels.remove(label)
+                continue
+            self.stats.refresh_label(label, self.emseg2.labels[self.bbox[label]], self.bbox[label])
+            bboxes_painted.append(self.bbox[label])
+        labels_painted_over = [label for label, bbox in self.bbox.items() if label not in new_labels and
+                               any(bboxes_overlap(self.pad_bbox(bbox), bbox_p) for bbox_p in bboxes_painted)]
+        for label in labels_painted_over:
+            try:
+                bbox, _ = self.get_subregion_3d(label)
+            except NoLabelError:
+                bbox = self.bbox[label]  # All voxels were painted over
+            self.stats.refresh_label(label, self.emseg2.labels[bbox], bbox)
 
     def pad_bbox(self, bbox: Bbox) -> Bbox:
         x0, x1 = bbox[0].start, bbox[0].stop
@@ -192,12 +230,187 @@ class CacheBbox:
         return slice(x0_, x1_), slice(y0_, y1_), slice(z0_, z1_)
 
 
+class LabelStats:
+    """Voxel number, centroid and occupied slices (z-range) of all labels
+
+    Notes
+    -----
+    The statistics are computed once for the whole image, then updated with the voxels changed in the subarrays
+    before/after each modification (merge/delete/divide and undo/redo), so the queries do not scan the image.
+    The voxel numbers and the sums of the coordinates are stored in arrays indexed by the labels, and
+    the voxel numbers per slice of a label are stored as (first slice, numbers in the following slices).
+    Labels painted by users (insert), and the labels painted over, are refreshed by refresh_label().
+    """
+    def __init__(self):
+        self.counts = np.zeros(1, dtype=np.int64)
+        self.coord_sums = np.zeros((1, 3), dtype=np.int64)
+        self.z_counts: Dict[int, Tuple[int, ndarray]] = {}
+        self._max_label: Optional[int] = 0
+
+    def compute(self, labels_img: ndarray, block_voxels: int = 2 ** 22):
+        """Compute the statistics of all labels slice by slice (in blocks of rows)"""
+        h, w, depth = labels_img.shape
+        num = int(labels_img.max()) + 1 if labels_img.size else 1
+        self.counts = np.zeros(num, dtype=np.int64)
+        self.coord_sums = np.zeros((num, 3), dtype=np.int64)
+        block_rows = max(1, min(h, block_voxels // max(w, 1)))
+        rows_local = np.repeat(np.arange(block_rows), w)
+        cols = np.tile(np.arange(w), block_rows)
+        z_labels, z_slices, z_nums = [], [], []
+        for z in range(depth):
+            counts_z = np.zeros(num, dtype=np.int64)
+            for r0 in range(0, h, block_rows):
+                block = np.asarray(labels_img[r0:r0 + block_rows, :, z]).ravel()
+                counts_block = np.bincount(block, minlength=num)
+                counts_z += counts_block
+                self.coord_sums[:, 0] += np.bincount(block, weights=rows_local[:len(block)],
+                                                     minlength=num).astype(np.int64) + r0 * counts_block
+                self.coord_sums[:, 1] += np.bincount(block, weights=cols[:len(block)], minlength=num).astype(np.int64)
+            self.counts += counts_z
+            self.coord_sums[:, 2] += z * counts_z
+            labels_z = np.flatnonzero(counts_z[1:]) + 1
+            z_labels.append(labels_z)
+            z_slices.append(np.full(len(labels_z), z))
+            z_nums.append(counts_z[labels_z])
+        self.counts[0] = 0
+        self.coord_sums[0] = 0
+        self.z_counts = {}
+        if depth > 0:
+            self._add_z_counts(np.concatenate(z_labels), np.concatenate(z_slices), np.concatenate(z_nums))
+        self._max_label = None
+
+    def refresh_label(self, label: int, subarray: ndarray, bbox: Bbox):
+        """Recompute the statistics of a label inside its bbox"""
+        self._remove_label(label)
+        voxels = np.nonzero(subarray == label)
+        coords = [c + bbox[i].start for i, c in enumerate(voxels)]
+        self._add_voxels(np.full(len(coords[0]), label), coords, 1)
+
+    def update(self, bbox: Bbox, subarray_before: ndarray, subarray_after: ndarray):
+        """Update the statistics with the voxels changed in the bbox"""
+        changed = np.nonzero(subarray_before != subarray_after)
+        if len(changed[0]) == 0:
+            return
+        coords = [c + bbox[i].start for i, c in enumerate(changed)]
+        self._add_voxels(subarray_before[changed], coords, -1)
+        self._add_voxels(subarray_after[changed], coords, 1)
+
+    def _add_voxels(self, labels: ndarray, coords: List[ndarray], sign: int):
+        foreground = labels != 0
+        labels = labels[foreground].astype(np.int64)
+        if len(labels) == 0:
+            return
+        coords = np.stack([c[foreground] for c in coords], axis=1)
+        self._reserve(int(labels.max()) + 1)
+        np.add.at(self.counts, labels, sign)
+        np.add.at(self.coord_sums, labels, sign * coords)
+        depth = int(coords[:, 2].max()) + 1
+        keys, nums = np.unique(labels * depth + coords[:, 2], return_counts=True)
+        self._add_z_counts(keys // depth, keys % depth, sign * nums)
+        labels_changed = np.unique(labels)
+        if sign > 0 and self._max_label is not None:
+            self._max_label = max(self._max_label, int(labels_changed[-1]))
+        elif sign < 0 and self._max_label is not None and self.counts[self._max_label] == 0:
+            self._max_label = None
+
+    def _add_z_counts(self, labels: ndarray, slices: ndarray, nums: ndarray):
+        """Add the voxel numbers in the slices to the labels. The (label, slice) pairs should be unique"""
+        order = np.lexsort((slices, labels))
+        labels, slices, nums = labels[order], slices[order], nums[order]
+        starts = np.flatnonzero(np.diff(labels, prepend=-1))
+        for label, slices_l, nums_l in zip(labels[starts].tolist(), np.split(slices, starts[1:]),
+                                           np.split(nums, starts[1:])):
+            z0, z_nums = self.z_counts.get(label, (int(slices_l[0]), np.zeros(0, dtype=np.int64)))
+            z0_new = min(z0, int(slices_l[0]))
+            z1_new = max(z0 + len(z_nums), int(slices_l[-1]) + 1)
+            z_nums_new = np.zeros(z1_new - z0_new, dtype=np.int64)
+            z_nums_new[z0 - z0_new:z0 - z0_new + len(z_nums)] = z_nums
+            z_nums_new[slices_l - z0_new] += nums_l
+            occupied = np.flatnonzero(z_nums_new)
+            if len(occupied) == 0:
+                self.z_counts.pop(label, None)
+            else:
+                self.z_counts[label] = (z0_new + int(occupied[0]), z_nums_new[occupied[0]:occupied[-1] + 1])
+
+    def _remove_label(self, label: int):
+        if label < len(self.counts):
+            self.counts[label] = 0
+            self.coord_sums[label] = 0
+        self.z_counts.pop(label, None)
+        if label == self._max_label:
+            self._max_label = None
+
+    def _reserve(self, size: int):
+        if size > len(self.counts):
+            capacity = max(size, 2 * len(self.counts))
+            self.counts = np.concatenate((self.counts, np.zeros(capacity - len(self.counts), dtype=np.int64)))
+            self.coord_sums = np.concatenate(
+                (self.coord_sums, np.zeros((capacity - len(self.coord_sums), 3), dtype=np.int64)))
+
+    @property
+    def max_label(self) -> int:
+        if self._max_label is None:
+            labels = np.flatnonzero(self.counts)
+            self._max_label = int(labels[-1]) if len(labels) else 0
+        return self._max_label
+
+    @property
+    def cell_num(self) -> int:
+        return len(self.z_counts)
+
+    def areas(self) -> ndarray:
+        """Voxel numbers of all labels, indexed by the labels"""
+        return self.counts[:self.max_label + 1].copy()
+
+    def count(self, label: int) -> int:
+        return int(self.counts[label]) if 0 < label < len(self.counts) else 0
+
+    def centroid(self, label: int) -> ndarray:
+        """Centroid (row, column, slice) of the label"""
+        if self.count(label) == 0:
+            raise NoLabelError
+        return self.coord_sums[label] / self.counts[label]
+
+    def z_range(self, label: int) -> Tuple[int, int]:
+        """First slice and last slice + 1 occupied by the label"""
+        if label not in self.z_counts:
+            raise NoLabelError
+        z0, z_nums = self.z_counts[label]
+        return z0, z0 + len(z_nums)
+
+    def occupied_slices(self, label: int) -> ndarray:
+        if label not in self.z_counts:
+            raise NoLabelError
+        z0, z_nums = self.z_counts[label]
+        return z0 + np.flatnonzero(z_nums)
+
+    def count_in_slice(self, label: int, z: int) -> int:
+        z0, z_nums = self.z_counts.get(label, (0, np.zeros(0, dtype=np.int64)))
+        return int(z_nums[z - z0]) if 0 <= z - z0 < len(z_nums) else 0
+
+    def save(self, stats_path: Path):
+        stats_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(stats_path, 'wb') as f:
+            pickle.dump({"counts": self.counts, "coord_sums": self.coord_sums, "z_counts": self.z_counts},
+                        f, pickle.HIGHEST_PROTOCOL)
+
+    def load(self, stats_path: Path):
+        with open(stats_path, 'rb') as f:
+            stats = pickle.load(f)
+        self.counts, self.coord_sums, self.z_counts = stats["counts"], stats["coord_sums"], stats["z_counts"]
+        self._max_label = None
+
+
 def pad_range(lower: int, upper: int, pad_size: int, max_range: int):
     lower_ = lower - pad_size if lower - pad_size >= 0 else 0
     upper_ = upper + pad_size if upper + pad_size <= max_range else max_range
     return lower_, upper_
 
 
+def bboxes_overlap(bbox1: Bbox, bbox2: Bbox) -> bool:
+    return all(s1.start < s2.stop and s2.start < s1.stop for s1, s2 in zip(bbox1, bbox2))
+
+
 def merge_bbox(bboxes: List[Bbox]):
     x0_ = min([bbox[0].start for bbox in bboxes])
     y0_ = min([bbox[1].start for bbox in bboxes])
@@ -0,0 +1,146 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from itertools import product
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import dask.array as da
+import numpy as np
+from numpy import ndarray
+
+ChunkIndex = Tuple[int, int, int]
+
+
+class ChunkReader:
+    """Read regions (H, W, Z) of a chunked dataset (Z, Y, X) such as a Zarr array or a HDF5 dataset, with a LRU cache
+    of the decoded chunks limited by the memory usage
+
+    Notes
+    -----
+    A requested region is mapped onto the chunk grid of the dataset. The missing chunks are read and decoded by a
+    thread pool in parallel and then cached, so that the following slices in the same chunks are not decoded again.
+    A dataset without chunks (contiguous HDF5 dataset) is read slice by slice.
+    """
+
+    def __init__(self, dataset, max_bytes: int, workers: Optional[int] = None):
+        self.dataset = dataset
+        depth, h, w = dataset.shape
+        self.shape = (h, w, depth)
+        self.ndim = 3
+        self.dtype = np.dtype(dataset.dtype)
+        self.chunks = tuple(dataset.chunks) if dataset.chunks else (1, h, w)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._chunks: "OrderedDict[ChunkIndex, ndarray]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = Lock()
+        self._pending: Dict[ChunkIndex, Future] = {}
+        workers = min(8, (os.cpu_count() or 1) + 4) if workers is None else workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk_reader")
+
+    def __repr__(self):
+        return (f"ChunkReader: chunks {self.chunks}, {len(self._chunks)} cached, "
+                f"{self._nbytes / 2 ** 20:.1f}/{self.max_bytes / 2 ** 20:.0f} MB, hits: {self.hits}, "
+                f"misses: {self.misses}, evictions: {self.evictions}, hit rate: {self.hit_rate:.1%}")
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def __getitem__(self, key) -> ndarray:
+        """Region (H, W, Z) indexed by integers and/or slices (step 1) as a numpy array"""
+        ranges, squeezed = self._ranges(key)
+        (y0, y1), (x0, x1), (z0, z1) = ranges
+        region = np.empty((y1 - y0, x1 - x0, z1 - z0), dtype=self.dtype)
+        if region.size > 0:
+            cz, cy, cx = self.chunks
+            indexes = list(product(range(z0 // cz, (z1 - 1) // cz + 1),
+                                   range(y0 // cy, (y1 - 1) // cy + 1),
+                                   range(x0 // cx, (x1 - 1) // cx + 1)))
+            for (iz, iy, ix), chunk in zip(indexes, self.get_chunks(indexes)):
+                zs, ys, xs = iz * cz, iy * cy, ix * cx
+                za, zb = max(z0, zs), min(z1, zs + chunk.shape[0])
+                ya, yb = max(y0, ys), min(y1, ys + chunk.shape[1])
+                xa, xb = max(x0, xs), min(x1, xs + chunk.shape[2])
+                region[ya - y0:yb - y0, xa - x0:xb - x0, za - z0:zb - z0] = \
+                    chunk[za - zs:zb - zs, ya - ys:yb - ys, xa - xs:xb - xs].transpose((1, 2, 0))
+        return region.squeeze(axis=tuple(squeezed)) if squeezed else region
+
+    def _ranges(self, key) -> Tuple[List[Tuple[int, int]], List[int]]:
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        ranges, squeezed = [], []
+        for axis, k in enumerate(key):
+            size = self.shape[axis]
+            if isinstance(k, (int, np.integer)):
+                k = int(k) + size if k < 0 else int(k)
+                if not 0 <= k < size:
+                    raise IndexError(f"Index {k} is out of bounds for axis {axis} with size {size}")
+                ranges.append((k, k + 1))
+                squeezed.append(axis)
+            elif isinstance(k, slice) and k.step in (None, 1):
+                start, stop, _ = k.indices(size)
+                ranges.append((start, max(start, stop)))
+            else:
+                raise IndexError(f"ChunkReader only supports integers and slices with step 1, got {k}")
+        return ranges, squeezed
+
+    def get_chunks(self, indexes: List[ChunkIndex]) -> List[ndarray]:
+        """Get the decoded chunks, reading the missing ones in parallel"""
+        cached, futures = {}, {}
+        with self._lock:
+            for index in indexes:
+                if index in self._chunks:
+                    self.hits += 1
+                    self._chunks.move_to_end(index)
+                    cached[index] = self._chunks[index]
+                elif index in self._pending:
+                    self.hits += 1
+                    futures[index] = self._pending[index]
+                else:
+                    self.misses += 1
+                    futures[index] = self._pending[index] = self._executor.submit(self._load, index)
+        return [cached[index] if index in cached else futures[index].result() for index in indexes]
+
+    def _load(self, index: ChunkIndex) -> ndarray:
+        region = tuple(slice(i * c, (i + 1) * c) for i, c in zip(index, self.chunks))
+        try:
+            chunk = np.asarray(self.dataset[region])
+        except BaseException:
+            with self._lock:
+                self._pending.pop(index, None)
+            raise
+        with self._lock:
+            self._pending.pop(index, None)
+            self._put(index, chunk)
+        return chunk
+
+    def _put(self, index: ChunkIndex, chunk: ndarray):
+        self._chunks[index] = chunk
+        self._nbytes += chunk.nbytes
+        while self._nbytes > self.max_bytes and len(self._chunks) > 1:
+            _, chunk_evicted = self._chunks.popitem(last=False)
+            self._nbytes -= chunk_evicted.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self._nbytes = 0
+
+    def to_dask(self, name: Optional[str] = None) -> da.Array:
+        """Lazy array (H, W, Z) with one dask chunk per slice, read through this reader"""
+        name = f"chunk-reader-{id(self)}" if name is None else name
+        return da.from_array(self, chunks=(self.shape[0], self.shape[1], 1), name=name, lock=False, fancy=False,
+                             meta=np.empty((0, 0, 0), dtype=self.dtype))
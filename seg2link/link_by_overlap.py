@@ -1,5 +1,5 @@
 import copy
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, Optional
 
 import numpy as np
 from numpy import ndarray
@@ -21,9 +21,10 @@ def link_round2(seg_s1: ndarray, seg_s2: ndarray, max_label: int, minimum_ratio_
     """
     seg_s2[seg_s2!=0] += max_label
 
-    labels_and_area_s1 = {label1: area for label1, area in zip(*labels_and_areas(seg_s1))}
-    labels_and_area_s2 = {label1: area for label1, area in zip(*labels_and_areas(seg_s2))}
-    links_between_s1_and_s2 = extract_links_from_matching(seg_s1, seg_s2, labels_and_area_s1, labels_and_area_s2, minimum_ratio_overlap)
+    overlaps = OverlapTable(seg_s1, seg_s2)
+    labels_and_area_s1 = overlaps.labels_and_area_s1
+    labels_and_area_s2 = overlaps.labels_and_area_s2
+    links_between_s1_and_s2 = extract_links_from_matching(overlaps, minimum_ratio_overlap)
 
     original_and_transformed_labels_s2 = {label1: label1 for label1 in labels_and_area_s2.keys()}
     for label_i_in_s1, label_in_s2 in links_between_s1_and_s2:
@@ -37,22 +38,22 @@ def link_round2(seg_s1: ndarray, seg_s2: ndarray, max_label: int, minimum_ratio_
     return targets_s2[seg_s2]
 
 
-def link_previous_slices_round1(seg_s1: ndarray, seg_s2: ndarray, labels_s1: ndarray, labels_s2: ndarray,
-                                minimum_ratio_overlap: float) -> Tuple[List[int], List[int]]:
-    """Match the segmentation in slice 2 with slice 1 and return the modified label list in s1 and s2
+def link_previous_slices_round1(seg_s1: ndarray, seg_s2: ndarray, labels_s2: ndarray,
+                                minimum_ratio_overlap: float) -> Tuple[Dict[int, int], ndarray]:
+    """Match the segmentation in slice 2 with slice 1 and return the modified labels in s1 (as a mapping
+    {original: transformed} including only the modified labels) and the modified label array in s2
 
     Notes
     -----
-    labels_s1 is the flatten label list of all previous slices.
     The labels in s2 should have been modified to values higher than all labels in previous slices
     Note: Any value of seg_s2 should be higher than values in seg_s1
     """
-    labels_and_area_s1 = {label1: area for label1, area in zip(*labels_and_areas(seg_s1))}
-    labels_and_area_s2 = {label1: area for label1, area in zip(*labels_and_areas(seg_s2))}
-    links_between_s1_and_s2 = extract_links_from_matching(seg_s1, seg_s2, labels_and_area_s1, labels_and_area_s2,
-                                                          minimum_ratio_overlap)
+    overlaps = OverlapTable(seg_s1, seg_s2)
+    labels_and_area_s1 = overlaps.labels_and_area_s1
+    labels_and_area_s2 = overlaps.labels_and_area_s2
+    links_between_s1_and_s2 = extract_links_from_matching(overlaps, minimum_ratio_overlap)
 
-    original_and_transformed_labels_s1 = {label1: label1 for label1 in labels_and_area_s1.keys()}
+    original_and_transformed_labels_s1 = {}
     original_and_transformed_labels_s2 = {label1: label1 for label1 in labels_and_area_s2.keys()}
     for label_i_in_s1, label_in_s2 in links_between_s1_and_s2:
         target_post_ori = original_and_transformed_labels_s2[label_in_s2]
@@ -60,37 +61,31 @@ def link_previous_slices_round1(seg_s1: ndarray, seg_s2: ndarray, labels_s1: nda
         original_and_transformed_labels_s1[label_i_in_s1] = target_new
         original_and_transformed_labels_s2[label_in_s2] = target_new
 
-    targets_s1 = np.arange(np.max(labels_s1) + 1)
-    for label, target in original_and_transformed_labels_s1.items():
-        targets_s1[label] = target
     targets_s2 = np.arange(np.max(seg_s2) + 1)
     for label, target in original_and_transformed_labels_s2.items():
         targets_s2[label] = target
 
-    labels_s1 = targets_s1[labels_s1]
-    labels_s2 = targets_s2[labels_s2]
-    return labels_s1.tolist(), labels_s2.tolist()
+    targets_s1 = {label: target for label, target in original_and_transformed_labels_s1.items() if label != target}
+    return targets_s1, targets_s2[labels_s2]
 
 
 def link_a_divided_label_round1(labels_pre_now: List[int], labels_s2_now: List[int], labels_pre_past: List[int],
                                 seg_s1_past: ndarray, seg_s2_now: ndarray, labels_divided: List[int],
-                                minimum_ratio_overlap: float) -> Tuple[List[int], List[int]]:
+                                minimum_ratio_overlap: float) -> Tuple[ndarray, ndarray]:
     seg_s2, _, _ = relabel_sequential(seg_s2_now)
     seg_s2[seg_s2 != 0] += max(labels_pre_past)
     labels_s2 = np.unique(seg_s2)
     labels_s2 = labels_s2[labels_s2 != 0]
     seg_s1 = seg_s1_past.view()
     labels_pre = labels_pre_past
-    labels_and_area_s1 = {label1: area for label1, area in zip(*labels_and_areas(seg_s1))}
-    labels_and_area_s2 = {label1: area for label1, area in zip(*labels_and_areas(seg_s2))}
+    overlaps = OverlapTable(seg_s1, seg_s2)
+    labels_and_area_s1 = overlaps.labels_and_area_s1
+    labels_and_area_s2 = overlaps.labels_and_area_s2
 
-    links_between_s1_and_s2 = link_by_overlapping(seg_s1,
-                                                  seg_s2,
+    links_between_s1_and_s2 = link_by_overlapping(overlaps,
                                                   labels_s2,
                                                   labels_divided,
                                                   labels_s2_now,
-                                                  labels_and_area_s1,
-                                                  labels_and_area_s2,
                                                   minimum_ratio_overlap)
     links_between_s1_and_s2 = link_by_old_matching(labels_pre_now,
                                                    labels_s2_now,
@@ -116,28 +111,18 @@ def link_a_divided_label_round1(labels_pre_now: List[int], labels_s2_now: List[i
 
     labels_pre = targets_s1[labels_pre]
     labels_s2 = targets_s2[labels_s2]
-    return labels_pre.tolist(), labels_s2.tolist()
+    return labels_pre, labels_s2
 
 
-def link_by_overlapping(seg_s1: ndarray,
-                        seg_s2: ndarray,
+def link_by_overlapping(overlaps: "OverlapTable",
                         labels_s2: List[int],
                         labels_divided: List[int],
                         labels_s2_now: List[int],
-                        labels_and_area_s1: Dict[int, int],
-                        labels_and_area_s2: Dict[int, int],
                         minimum_ratio_overlap: float) -> List[Tuple[int, int]]:
     links_between_s1_and_s2: List[Tuple[int, int]] = []
     for label_i_in_s2_now in labels_divided:
         label_i_in_s2 = labels_s2[labels_s2_now.index(label_i_in_s2_now)]
-        labels_s1_overlap_with_i_and_area = \
-            {label: area for label, area in zip(*_overlapped_labels(label_i_in_s2, seg_s2, seg_s1))}
-        if not labels_s1_overlap_with_i_and_area:
-            continue
-        label_i_area = labels_and_area_s2[label_i_in_s2]
-        for label_in_s1, area_overlap_with_i in labels_s1_overlap_with_i_and_area.items():
-            if area_overlap_with_i > minimum_ratio_overlap * min(label_i_area, labels_and_area_s1[label_in_s1]):
-                links_between_s1_and_s2.append((label_in_s1, label_i_in_s2))
+        links_between_s1_and_s2 += overlaps.links(minimum_ratio_overlap, label_s2=label_i_in_s2)
     return links_between_s1_and_s2
 
 
@@ -164,6 +149,28 @@ def labels_and_areas(label_img: ndarray) -> Tuple[ndarray, ndarray]:
     return labels[labels!=0], areas[labels!=0]
 
 
+def labels_and_areas_bincount(label_img: ndarray) -> Tuple[ndarray, ndarray]:
+    """Same as labels_and_areas but count the areas in one pass with np.bincount (labels are sorted)"""
+    if label_img.size == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    if label_img.max() > 4 * label_img.size + 2 ** 20:
+        labels, areas = labels_and_areas(label_img)
+        return labels.astype(np.int64), areas
+    areas = np.bincount(label_img.ravel())
+    areas[0] = 0
+    labels = np.flatnonzero(areas)
+    return labels, areas[labels]
+
+
+def _index_of_labels(labels_sorted: ndarray, values: ndarray) -> ndarray:
+    """Return the indexes of the values in the sorted labels, using a lookup table if it is not too large"""
+    if len(labels_sorted) == 0 or labels_sorted[-1] > 4 * values.size + 2 ** 20:
+        return np.searchsorted(labels_sorted, values)
+    lookup = np.zeros(labels_sorted[-1] + 1, dtype=np.int64)
+    lookup[labels_sorted] = np.arange(len(labels_sorted))
+    return lookup[values]
+
+
 def _del0(labels: ndarray, counts: ndarray) -> Tuple[ndarray, ndarray]:
     """Remove label with zero value and its count"""
     if len(labels) == 0:
@@ -177,8 +184,15 @@ def _overlapped_labels(label_s1_i: int, seg_1: ndarray, seg_2: ndarray) -> Tuple
     return _del0(labels_s2_overlap, areas_overlap)
 
 
-def extract_links_from_matching(seg_s1, seg_s2, labels_and_area_s1: Dict[int, int],
-                                labels_and_area_s2: Dict[int, int], minimum_ratio_overlap: float) -> List[Tuple[int, int]]:
+def extract_links_from_matching(overlaps: "OverlapTable", minimum_ratio_overlap: float) -> List[Tuple[int, int]]:
+    """Return all pairs (label in s1, label in s2) whose overlap is larger than the ratio of the smaller one"""
+    return overlaps.links(minimum_ratio_overlap)
+
+
+def extract_links_from_matching_deprecated(seg_s1, seg_s2, labels_and_area_s1: Dict[int, int],
+                                           labels_and_area_s2: Dict[int, int],
+                                           minimum_ratio_overlap: float) -> List[Tuple[int, int]]:
+    """Search the overlapped labels one by one (O(labels x pixels)). Replaced by OverlapTable"""
     links_between_s1_and_s2: List[Tuple[int, int]] = []
     for label_i_in_s1 in labels_and_area_s1.keys():
         labels_s2_overlap_with_i_and_area = {label: area for label, area in
@@ -192,6 +206,56 @@ def extract_links_from_matching(seg_s1, seg_s2, labels_and_area_s1: Dict[int, in
     return links_between_s1_and_s2
 
 
+class OverlapTable:
+    """Contingency table between the labels in two slices
+
+    Notes
+    -----
+    The areas of all labels and of all their intersections are counted in a single pass over the pixels:
+    each overlapped pixel is mapped to a key of the (label in s1, label in s2) pair, and the keys are counted
+    with np.bincount (or np.unique when there are too many possible pairs). Only pairs with overlap are stored,
+    sorted by the label in s1 and then by the label in s2.
+    """
+    max_dense_pairs = 2 ** 25
+
+    def __init__(self, seg_s1: ndarray, seg_s2: ndarray):
+        seg_s1, seg_s2 = seg_s1.ravel(), seg_s2.ravel()
+        self.labels_s1, self.areas_s1 = labels_and_areas_bincount(seg_s1)
+        self.labels_s2, self.areas_s2 = labels_and_areas_bincount(seg_s2)
+        self.pairs_s1, self.pairs_s2, self.areas_overlap = self._count_pairs(seg_s1, seg_s2)
+
+    @property
+    def labels_and_area_s1(self) -> Dict[int, int]:
+        return dict(zip(self.labels_s1.tolist(), self.areas_s1.tolist()))
+
+    @property
+    def labels_and_area_s2(self) -> Dict[int, int]:
+        return dict(zip(self.labels_s2.tolist(), self.areas_s2.tolist()))
+
+    def _count_pairs(self, seg_s1: ndarray, seg_s2: ndarray) -> Tuple[ndarray, ndarray, ndarray]:
+        overlapped = (seg_s1 != 0) & (seg_s2 != 0)
+        idx_s1 = _index_of_labels(self.labels_s1, seg_s1[overlapped])
+        idx_s2 = _index_of_labels(self.labels_s2, seg_s2[overlapped])
+        num_s2 = max(len(self.labels_s2), 1)
+        keys = idx_s1.astype(np.int64) * num_s2 + idx_s2
+        if len(self.labels_s1) * num_s2 <= self.max_dense_pairs:
+            counts = np.bincount(keys, minlength=len(self.labels_s1) * num_s2)
+            keys = np.flatnonzero(counts)
+            areas_overlap = counts[keys]
+        else:
+            keys, areas_overlap = np.unique(keys, return_counts=True)
+        return self.labels_s1[keys // num_s2], self.labels_s2[keys % num_s2], areas_overlap
+
+    def links(self, minimum_ratio_overlap: float, label_s2: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Return the pairs whose overlap > minimum_ratio_overlap * the area of the smaller label in the pair"""
+        area_s1 = self.areas_s1[np.searchsorted(self.labels_s1, self.pairs_s1)]
+        area_s2 = self.areas_s2[np.searchsorted(self.labels_s2, self.pairs_s2)]
+        linked = self.areas_overlap > minimum_ratio_overlap * np.minimum(area_s1, area_s2)
+        if label_s2 is not None:
+            linked &= self.pairs_s2 == label_s2
+        return list(zip(self.pairs_s1[linked].tolist(), self.pairs_s2[linked].tolist()))
+
+
 def update_target(target_post_ori: int, label_pre: int, labels_pre_area: Dict[int, int]):
     """choose a label with large area as target in case both pre and post label point to a pre label"""
     if target_post_ori in labels_pre_area and \
@@ -1,7 +1,13 @@
 import cProfile
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
 import pstats
+import shutil
 import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from inspect import signature
 from io import StringIO
 from pathlib import Path
@@ -21,10 +27,15 @@ from tifffile import tifffile
 
 from seg2link.parameters import DEBUG
 from seg2link import parameters
+from seg2link.chunk_reader import ChunkReader
+from seg2link.writers import ZarrWriter, write_slices
 
 if parameters.DEBUG:
     pass
 
+ZARR_SUFFIXES = (".zarr", ".n5")
+HDF5_SUFFIXES = (".h5", ".hdf5", ".hdf")
+
 
 def list_keys(f):
     """
@@ -38,7 +49,8 @@ def list_keys(f):
 
     def _recursive_find_keys(f, base: Path = Path('/')):
         _list_keys = []
-        for key, dataset in f.items():
+        # zarr>=3 groups list their children by members()
+        for key, dataset in (f.members() if hasattr(f, "members") else f.items()):
             if isinstance(dataset, zarr.Group):
                 new_base = base / key
                 _list_keys += _recursive_find_keys(dataset, new_base)
@@ -73,39 +85,266 @@ def load_zarr(path: Path, mode='r') -> ndarray or None:
     for ds in ds_in_f:
         # arrays are transposed since all other data convention seems to be in XYZ format
         img_array = da.from_zarr(path, component=ds)
-        dict_of_img_arrays[ds] = img_array.rechunk(chunks='auto')
+        # keep the native chunks of the arrays, so that each dask chunk is read from whole zarr chunks
+        dict_of_img_arrays[ds] = img_array
 
     return dict_of_img_arrays
 
 
-def load_image_pil(path: Path) -> ndarray:
+def load_image_pil(path: Path, show_info: Callable[[str], None] = print) -> ndarray:
     """Load image as ndarray into RAM"""
-    paths_list = get_files(path)
-    print(paths_list)
-    imread = lambda fname: np.array(Image.open(fname))
-    try:
-        sample = imread(paths_list[0])
-    except:
-        return load_image_tifffile(path)
-
-    img_array = np.zeros((sample.shape[0], sample.shape[1], len(paths_list)), dtype=sample.dtype)
-    for z, img_path in enumerate(paths_list):
-        img_array[..., z] = np.array(Image.open(img_path))
-    return img_array
+    return load_image_stack(path, show_info=show_info)
 
 
-def load_image_tifffile(path: Path) -> ndarray:
+def load_image_tifffile(path: Path, show_info: Callable[[str], None] = print) -> ndarray:
     """Load image as ndarray into RAM"""
-    paths_list = get_files(path)
-    # if it is a tiff then tifffile should be able to read it!
-    imread = lambda fname: np.array(tifffile.imread(fname))
-    sample = imread(paths_list[0])
-    img_array = np.zeros((sample.shape[0], sample.shape[1], len(paths_list)), dtype=sample.dtype)
-    for z, img_path in enumerate(paths_list):
-        img_array[..., z] = np.array(tifffile.imread(img_path))
+    return load_image_stack(path, imread=lambda fname: np.asarray(tifffile.imread(fname)), show_info=show_info)
+
+
+def _imread_pil(fname: str) -> ndarray:
+    return np.array(Image.open(fname))
+
+
+def load_image_stack(path: Path, transform: Optional[Callable[[ndarray], ndarray]] = None,
+                     out_path: Optional[Path] = None, imread: Optional[Callable[[str], ndarray]] = None,
+                     workers: Optional[int] = None, show_info: Callable[[str], None] = print, key: str = "") -> ndarray:
+    """Load the images in a folder (or the dataset key in a Zarr/N5/HDF5 container) as an array (H, W, slice)
+
+    Notes
+    -----
+    The slices are decoded by a thread pool and written directly into a preallocated array, or into a
+    Z-chunked cache (see save_volume_cache) if out_path is given, in which case the lazy cache is returned.
+    transform (e.g. comparing with the cell value) is applied to each slice before writing it.
+    The images are read by PIL, or by tifffile if PIL failed to read them.
+    """
+    if is_container(path):
+        dataset = open_dataset(path, key)
+        num_slices = dataset.shape[0]
+        read_slice = lambda z: np.asarray(dataset[z])
+    else:
+        paths_list = get_files(path)
+        num_slices = len(paths_list)
+        if imread is None:
+            try:
+                _imread_pil(paths_list[0])
+                imread = _imread_pil
+            except Exception:
+                imread = lambda fname: np.asarray(tifffile.imread(fname))
+        read_slice = lambda z: imread(paths_list[z])
+    transform = (lambda img: img) if transform is None else transform
+    sample = transform(read_slice(0))
+    shape = (sample.shape[0], sample.shape[1], num_slices)
+    if out_path is None:
+        path_tmp, writer = None, None
+        img_array = empty_volume(shape, sample.dtype)
+    else:
+        path_tmp = _tmp_cache_name(out_path)
+        writer = ZarrWriter(path_tmp, shape, sample.dtype, packbits=sample.dtype == bool)
+
+    def load_slice(z: int):
+        img = transform(read_slice(z))
+        if writer is None:
+            img_array[..., z] = img
+        else:
+            writer.write(z, img)
+
+    workers = min(8, (os.cpu_count() or 1) + 4) if workers is None else workers
+    interval = max(1, num_slices // 100)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image_loader") as executor:
+        futures = [executor.submit(load_slice, z) for z in range(num_slices)]
+        try:
+            for num_loaded, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                if num_loaded % interval == 0 or num_loaded == num_slices:
+                    show_info(f"Loading {path.name}: {num_loaded}/{num_slices} slices")
+        except Exception:
+            for future in futures:
+                future.cancel()
+            if path_tmp is not None:
+                shutil.rmtree(path_tmp, ignore_errors=True)
+            raise
+    if path_tmp is not None:
+        os.replace(path_tmp, out_path)
+        return load_volume_cache(out_path)
     return img_array
 
 
+def _tmp_cache_name(path_cache: Path) -> Path:
+    return path_cache.with_name(path_cache.stem + "_tmp" + path_cache.suffix)
+
+
+def save_volume_cache(path_cache: Path, array: ndarray, show_info: Callable[[str], None] = print,
+                      packbits: bool = True):
+    """Save a volume (H, W, Z) as a Zarr array (Z, H, W) with one compressed chunk per slice
+
+    Notes
+    -----
+    A boolean volume is bit-packed (8 voxels per byte) if packbits is True.
+    The cache is written into a temporary folder renamed to path_cache when finished, so that an interrupted
+    caching is never used later.
+    """
+    path_tmp = _tmp_cache_name(path_cache)
+    try:
+        with ZarrWriter(path_tmp, array.shape, array.dtype, packbits=packbits and array.dtype == bool) as writer:
+            write_slices(writer, lambda z: array[..., z], show_info=show_info)
+    except BaseException:
+        shutil.rmtree(path_tmp, ignore_errors=True)
+        raise
+    os.replace(path_tmp, path_cache)
+
+
+def load_volume_cache(path_cache: Path) -> da.Array:
+    """Lazy array (H, W, Z) of the cache saved by save_volume_cache. Each slice is read from a single chunk,
+    and unpacked when it is requested if the volume was bit-packed"""
+    array = zarr.open_array(str(path_cache), mode="r")
+    volume = da.from_zarr(array)
+    width = array.attrs.get("packed_width")
+    if width is not None:
+        volume = volume.map_blocks(unpack_bits, width, chunks=volume.chunks[:2] + ((width,),), dtype=bool)
+    return volume.transpose((1, 2, 0))
+
+
+def unpack_bits(packed: ndarray, width: int) -> ndarray:
+    """Unpack a boolean array bit-packed along the last axis by np.packbits"""
+    return np.unpackbits(packed, axis=-1, count=width).view(bool)
+
+
+class VolumeCache:
+    """Cached variants (Zarr arrays saved by save_volume_cache) of the volume preprocessed from an image folder
+
+    Notes
+    -----
+    The variants are stored side by side in the folder <image folder>_cache, and listed in its manifest.json with
+    the preprocessing parameters (e.g. cell value, fill holes, kernel of the closing) they were computed with.
+    The manifest also stores a fingerprint of the images (names, sizes and modification times). When the images
+    were changed, all variants are removed. For a dataset in a Zarr/N5 container, only the metadata of the dataset
+    is checked, i.e. chunks modified in place are not detected.
+    """
+
+    def __init__(self, path_images: Path, key: str = ""):
+        self.path_images = path_images
+        self.key_dataset = key
+        key_name = key.strip("/").replace("/", "_")
+        self.path_cache = _cache_name(path_images, "_" + key_name if key_name else "")
+        self._manifest: Optional[dict] = None
+
+    def fingerprint(self) -> str:
+        if not is_container(self.path_images):
+            files = get_files(self.path_images)
+        elif self.path_images.is_file():
+            files = [str(self.path_images)]
+        else:
+            path_dataset = self.path_images / self.key_dataset.strip("/")
+            files = [str(path_dataset / name) for name in ("zarr.json", ".zarray", "attributes.json")
+                     if (path_dataset / name).exists()]
+        files = [(Path(f).name, os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files]
+        return hashlib.sha1(json.dumps([self.key_dataset, files]).encode()).hexdigest()
+
+    @property
+    def manifest(self) -> dict:
+        if self._manifest is None:
+            path_manifest = self.path_cache / parameters.manifest_filename
+            try:
+                with open(path_manifest, 'r') as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = {"fingerprint": None, "variants": {}}
+            fingerprint = self.fingerprint()
+            if manifest["fingerprint"] != fingerprint:
+                if manifest["variants"]:
+                    print(f"Images in {self.path_images} were changed. Removing the cached data")
+                # Also removes the variants left without a manifest by an interrupted run
+                shutil.rmtree(self.path_cache, ignore_errors=True)
+                manifest = {"fingerprint": fingerprint, "variants": {}}
+            self._manifest = manifest
+        return self._manifest
+
+    @staticmethod
+    def key(name: str, pars: dict) -> str:
+        return hashlib.sha1(json.dumps([name, pars], sort_keys=True).encode()).hexdigest()[:16]
+
+    def get(self, name: str, pars: dict) -> Optional[Path]:
+        """Path of the variant computed by the function name with the parameters pars, or None if not cached"""
+        entry = self.manifest["variants"].get(self.key(name, pars))
+        if entry is None or not (self.path_cache / entry["file"]).exists():
+            return None
+        return self.path_cache / entry["file"]
+
+    def new_path(self, name: str, pars: dict) -> Path:
+        """Path for computing a variant not cached yet. A variant left there by an interrupted run (moved into place
+        but not added to the manifest) is removed, so that the new one can replace it"""
+        path_variant = self.path_cache / f"{name}_{self.key(name, pars)}.zarr"
+        shutil.rmtree(path_variant, ignore_errors=True)
+        return path_variant
+
+    def add(self, name: str, pars: dict, path_variant: Path):
+        self.manifest["variants"][self.key(name, pars)] = {"file": path_variant.name, "function": name,
+                                                           "parameters": pars}
+        self._write_manifest()
+
+    def clear(self):
+        """Remove all variants (and the caches of previous versions)"""
+        shutil.rmtree(self.path_cache, ignore_errors=True)
+        _npy_name(self.path_images).unlink(missing_ok=True)
+        self._manifest = None
+
+    def _write_manifest(self):
+        self.path_cache.mkdir(parents=True, exist_ok=True)
+        path_manifest = self.path_cache / parameters.manifest_filename
+        path_tmp = path_manifest.with_suffix(".tmp")
+        with open(path_tmp, 'w') as f:
+            json.dump({"version": 1, **self._manifest}, f, indent=1)
+        os.replace(path_tmp, path_manifest)
+
+    def migrate_legacy(self, name: str, pars: dict) -> Optional[Path]:
+        """Convert the cache of previous versions (<image folder>.npy) into the variant computed by the function name
+        with the parameters pars, and return its path. None if there is no such cache or it is not migrated
+
+        Notes
+        -----
+        The parameters of the .npy cache were not saved, but previous versions reused it with any parameters.
+        It is thus migrated (only once, at the first run of this version) with the current parameters.
+        It is kept if the cache already has variants or if it does not match the images.
+        """
+        path_npy = _npy_name(self.path_images)
+        if not path_npy.exists():
+            return None
+        legacy = np.load(str(path_npy), mmap_mode="r")
+        if self.manifest["variants"] or legacy.dtype != bool or legacy.ndim != 3 \
+                or legacy.shape[2] != len(get_files(self.path_images)):
+            print(f"The cache of a previous version {path_npy} is not used and can be removed")
+            return None
+        print(f"Migrating the cache of a previous version {path_npy}, assuming it was computed with the current "
+              f"parameters {pars}. If not, remove {self.path_cache} to recompute it")
+        path_variant = self.new_path(name, pars)
+        self.path_cache.mkdir(parents=True, exist_ok=True)
+        save_volume_cache(path_variant, legacy)
+        del legacy
+        self.add(name, pars, path_variant)
+        path_npy.unlink()
+        return path_variant
+
+
+def empty_volume(shape: Tuple[int, int, int], dtype: type, out_path: Optional[Path] = None) -> ndarray:
+    """Create a zero volume (H, W, Z) in RAM, or memory-mapped to a .npy file if out_path is given
+
+    Notes
+    -----
+    With parameters.pars.z_first_layout, the volume is in Fortran order, i.e. each slice [..., z] is contiguous
+    """
+    fortran_order = parameters.pars.z_first_layout
+    if out_path is None:
+        return np.zeros(shape, dtype=dtype, order="F" if fortran_order else "C")
+    return np.lib.format.open_memmap(str(out_path), mode="w+", dtype=dtype, shape=shape, fortran_order=fortran_order)
+
+
+def to_volume_layout(array: ndarray) -> ndarray:
+    """Convert a volume (H, W, Z) into the layout set by parameters.pars.z_first_layout (no copy if it is already)"""
+    if parameters.pars.z_first_layout:
+        return np.asfortranarray(array)
+    return np.ascontiguousarray(array)
+
+
 def load_image_lazy(path: Path) -> ndarray:
     """Lazy imread with dask"""
     paths_list = get_files(path)
@@ -121,6 +360,56 @@ def load_image_lazy(path: Path) -> ndarray:
     return da.stack(dask_arrays, axis=-1)
 
 
+def is_container(path: Path) -> bool:
+    """Whether the path is a Zarr/N5 container or a HDF5 file (otherwise a folder of TIFF images)"""
+    return path.suffix.lower() in ZARR_SUFFIXES + HDF5_SUFFIXES
+
+
+def open_dataset(path: Path, key: str):
+    """Open the dataset key (an array (Z, Y, X)) in a Zarr/N5 container or a HDF5 file, without loading it"""
+    if path.suffix.lower() == ".n5" and int(zarr.__version__.split(".")[0]) >= 3:
+        raise ValueError(f"Reading the N5 container {path.name} requires zarr<3")
+    try:
+        if path.suffix.lower() in HDF5_SUFFIXES:
+            dataset = h5py.File(path, "r")[key]
+            if not isinstance(dataset, h5py.Dataset):
+                raise KeyError(key)
+        else:
+            dataset = zarr.open_array(str(path), path=key.strip("/"), mode="r")
+    except (KeyError, ValueError) as e:
+        raise ValueError(f'Dataset "{key}" was not found in {path.name}. '
+                         f'Available datasets: {", ".join(list_datasets(path))}') from e
+    if dataset.ndim != 3:
+        raise ValueError(f'Dataset "{key}" in {path.name} should be a 3D array (Z, Y, X), but has shape {dataset.shape}')
+    return dataset
+
+
+def list_datasets(path: Path) -> List[str]:
+    """Keys of all arrays in a Zarr/N5 container or a HDF5 file"""
+    if path.suffix.lower() in HDF5_SUFFIXES:
+        with h5py.File(path, "r") as f:
+            return list_keys(f)
+    return list_keys(zarr.open_group(str(path), mode="r"))
+
+
+def load_container_lazy(path: Path, key: str) -> da.Array:
+    """Lazy array (H, W, Z) of a dataset (Z, Y, X) in a Zarr/N5 container or a HDF5 file
+
+    Notes
+    -----
+    The slices are read through a ChunkReader, so the chunks of the dataset shared by neighbouring slices are
+    decoded only once (see parameters.pars.cache_chunks_mb)
+    """
+    return load_zarr_lazy(open_dataset(path, key), name=f"dataset-{path}-{key}")
+
+
+def load_volume_lazy(path: Path, key: str = "") -> da.Array:
+    """Lazy array (H, W, Z) of a folder of TIFF images, or of a dataset in a Zarr/N5/HDF5 container"""
+    if is_container(path):
+        return load_container_lazy(path, key)
+    return load_image_lazy(path)
+
+
 def load_array_lazy(path: Path):
     """Lazy array load with dask"""
     mask = np.load(path, mmap_mode="r")
@@ -136,21 +425,16 @@ def load_array_lazy(path: Path):
     return da.stack(dask_arrays, axis=-1)
 
 
-def load_zarr_lazy(zarr_array):
-    """Lazy array load with dask from Zarr array.
-     Test date: Feb 2, 2024
-     This can be incredibly slow"""
-    imread = lambda z: zarr_array[..., z]  # indexing is zyx here????
-    sample = imread(0)
-
-    lazy_reader = delayed(imread)
-    lazy_arrays = [lazy_reader(z) for z in range(zarr_array.shape[2])]
+def load_zarr_lazy(zarr_array, name: Optional[str] = None) -> da.Array:
+    """Lazy array (H, W, Z) of a Zarr array (or HDF5 dataset) of shape (Z, Y, X), with one dask chunk per slice
 
-    dask_arrays = [
-        da.from_delayed(delayed_reader, shape=sample.shape, dtype=sample.dtype)
-        for delayed_reader in lazy_arrays
-    ]
-    return da.stack(dask_arrays, axis=-1)
+    Notes
+    -----
+    The slices are mapped onto the chunk grid of the array, and the decoded chunks are cached (LRU) by a ChunkReader,
+    so consecutive slices in the same chunks are not decoded again. See utils/benchmark_chunk_reader.py
+    """
+    reader = ChunkReader(zarr_array, parameters.pars.cache_chunks_mb * 2 ** 20)
+    return reader.to_dask(name)
 
 
 def get_files(path: Path) -> List[str]:
@@ -172,13 +456,248 @@ def dilation_scipy(label_image: ndarray, filter_size: Tuple[int, int, int]) -> n
 def fill_holes_scipy(label_image: ndarray, filter_size: Tuple[int, int, int]) -> ndarray:
     """fill holes after closing using scipy"""
     print("Closing... Please wait")
-    closed_img = grey_closing(label_image, filter_size)
+    closed_img = grey_closing(label_image, filter_size, output=empty_volume(label_image.shape, label_image.dtype))
     print("Filling holes... Please wait")
     for z in range(closed_img.shape[2]):
         closed_img[..., z] = binary_fill_holes(closed_img[..., z])
     return closed_img
 
 
+def closing_separable(image: ndarray, filter_size: Tuple[int, ...]) -> ndarray:
+    """Same as grey_closing(image, filter_size) (flat box, mode "reflect"), computed by 1D maximum filters and then
+    1D minimum filters along each axis. A boolean image is filtered with logical or/and (see _filter1d_bool)"""
+    closed = image
+    for axis, size in enumerate(filter_size):
+        origin = 0 if size % 2 else -1
+        if image.dtype == bool:
+            closed = _filter1d_bool(closed, size, axis, np.logical_or, size // 2 + origin)
+        else:
+            closed = ndi.maximum_filter1d(closed, size, axis=axis, origin=origin)
+    for axis, size in enumerate(filter_size):
+        if image.dtype == bool:
+            closed = _filter1d_bool(closed, size, axis, np.logical_and, size // 2)
+        else:
+            closed = ndi.minimum_filter1d(closed, size, axis=axis)
+    return closed
+
+
+def _filter1d_bool(image: ndarray, size: int, axis: int, ufunc: np.ufunc, left: int) -> ndarray:
+    """Maximum (ufunc: np.logical_or) or minimum (np.logical_and) filter of a boolean image along the axis, over the
+    windows of size pixels starting left pixels before each pixel (the boundary is reflected as in scipy)
+
+    Notes
+    -----
+    The windows of 1, 2, 4... pixels are combined from two windows of half size, and the window of size pixels from
+    two overlapping windows, i.e. about log2(size) vectorized operations instead of a loop over the lines
+    """
+    if size == 1:
+        return image
+    pad_width = [(0, 0)] * image.ndim
+    pad_width[axis] = (left, size - 1 - left)
+    result = np.pad(image, pad_width, mode="symmetric")
+    take = lambda array, start, length: array[(slice(None),) * axis + (slice(start, start + length),)]
+    window = 1
+    while window * 2 <= size:
+        length = result.shape[axis] - window
+        result = ufunc(take(result, 0, length), take(result, window, length))
+        window *= 2
+    return ufunc(take(result, 0, image.shape[axis]), take(result, size - window, image.shape[axis]))
+
+
+def _fill_holes_block(path_mask: str, path_filled: str, z_range: Tuple[int, int],
+                      filter_size: Optional[Tuple[int, int, int]], tile_size: int) -> int:
+    """Close and fill holes in the slices z_range of a cached mask, and write them into the cache path_filled.
+    Run in a worker process by fill_holes_blockwise"""
+    mask = load_volume_cache(Path(path_mask))
+    h, w, depth = mask.shape
+    z0, z1 = z_range
+    halo_z = 0 if filter_size is None else filter_size[2]
+    za, zb = max(z0 - halo_z, 0), min(z1 + halo_z, depth)
+    block = np.asarray(mask[..., za:zb])
+    if filter_size is None:
+        closed = block[..., z0 - za:z1 - za]
+    else:
+        closed = np.empty((h, w, z1 - z0), dtype=bool)
+        halo_y, halo_x = filter_size[:2]
+        for y0, x0 in itertools.product(range(0, h, tile_size), range(0, w, tile_size)):
+            y1, x1 = min(y0 + tile_size, h), min(x0 + tile_size, w)
+            ya, yb = max(y0 - halo_y, 0), min(y1 + halo_y, h)
+            xa, xb = max(x0 - halo_x, 0), min(x1 + halo_x, w)
+            tile = closing_separable(block[ya:yb, xa:xb], filter_size)
+            closed[y0:y1, x0:x1] = tile[y0 - ya:y1 - ya, x0 - xa:x1 - xa, z0 - za:z1 - za]
+    writer = ZarrWriter.open_existing(path_filled)
+    for i, z in enumerate(range(z0, z1)):
+        writer.write(z, binary_fill_holes(closed[..., i]))
+    return z1 - z0
+
+
+def fill_holes_blockwise(path_mask: Path, path_filled: Path, filter_size: Optional[Tuple[int, int, int]],
+                         block_depth: int = 16, tile_size: int = 1024, workers: Optional[int] = None,
+                         show_info: Callable[[str], None] = print):
+    """Close (as fill_holes_scipy) and fill holes in a cached mask (see save_volume_cache) block by block in a
+    process pool, and save the result into the cache path_filled. If filter_size is None, skip the closing
+
+    Notes
+    -----
+    The volume is split into blocks of block_depth slices, extended by halos of filter_size[2] slices. Each worker
+    closes a block tile by tile (tile_size x tile_size pixels with halos of filter_size[:2] pixels) with separable
+    1D filters, fills the holes slice by slice, and writes the slices into the cache. The result is the same as
+    fill_holes_scipy, but only a few blocks are in RAM at the same time.
+    """
+    shape = load_volume_cache(path_mask).shape
+    depth = shape[2]
+    path_tmp = _tmp_cache_name(path_filled)
+    ZarrWriter(path_tmp, shape, bool, packbits=True).close()
+    filter_size = None if filter_size is None else tuple(filter_size)
+    workers = min(8, os.cpu_count() or 1) if workers is None else workers
+    z_ranges = [(z, min(z + block_depth, depth)) for z in range(0, depth, block_depth)]
+    print("Closing and filling holes... Please wait")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(_fill_holes_block, str(path_mask), str(path_tmp), z_range, filter_size, tile_size)
+                   for z_range in z_ranges]
+        try:
+            num_filled = 0
+            for future in as_completed(futures):
+                num_filled += future.result()
+                show_info(f"Closing and filling holes: {num_filled}/{depth} slices... Please wait")
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            shutil.rmtree(path_tmp, ignore_errors=True)
+            raise
+    os.replace(path_tmp, path_filled)
+
+
+def cache_images_lazy(*advanced_pars: str) -> Callable:
+    """Cache the returned volume in a VolumeCache and load it lazily.
+
+    The variant is keyed by the arguments of the decorated function (except paths, out_path and show_info) and
+    the given advanced parameters (parameters.pars). The decorated function can also write the volume directly
+    into the cache given by out_path and return the lazy cache."""
+    def decorator(func):
+        def wrapper(*args, file_cached: Optional[VolumeCache], **kwargs) -> ndarray:
+            if file_cached is None:
+                array = func(*args, **kwargs)
+            else:
+                arguments = signature(func).bind_partial(*args, **kwargs).arguments
+                pars = {key: value for key, value in arguments.items()
+                        if key not in ("out_path", "show_info") and not isinstance(value, Path)}
+                pars.update({key: getattr(parameters.pars, key) for key in advanced_pars})
+                pars = json.loads(json.dumps(pars))
+                path_variant = file_cached.get(func.__name__, pars)
+                if path_variant is None:
+                    path_variant = file_cached.migrate_legacy(func.__name__, pars)
+                if path_variant is None:
+                    print("Caching data... Please wait")
+                    path_variant = file_cached.new_path(func.__name__, pars)
+                    file_cached.path_cache.mkdir(parents=True, exist_ok=True)
+                    array = func(*args, out_path=path_variant, **kwargs)
+                    if isinstance(array, ndarray):
+                        save_volume_cache(path_variant, array)
+                    del array
+                    file_cached.add(func.__name__, pars, path_variant)
+                array = load_volume_cache(path_variant)
+            print("Image shape:", array.shape)
+            return array
+
+        return wrapper
+
+    return decorator
+
+
+@cache_images_lazy()
+def load_cells(cell_value, path_cells, key: str = "", out_path: Optional[Path] = None,
+               show_info: Callable[[str], None] = print):
+    return load_image_stack(path_cells, transform=lambda img: img == cell_value, out_path=out_path,
+                            show_info=show_info, key=key)
+
+
+@cache_images_lazy("mask_dilate_kernel")
+def load_mask(mask_value: int, path_mask: Path, fill_holes: bool, key: str = "", out_path: Optional[Path] = None,
+              show_info: Callable[[str], None] = print) -> ndarray:
+    # With a cache file, the mask before the closing is cached temporarily, and closed block by block into the cache
+    path_unfilled = None if out_path is None or not fill_holes else out_path.with_name(out_path.stem + "_unfilled.zarr")
+    mask_images = load_image_stack(path_mask, transform=lambda img: img == mask_value,
+                                   out_path=path_unfilled if fill_holes else out_path, show_info=show_info, key=key)
+    if not mask_images.any():
+        if not isinstance(mask_images, ndarray):
+            shutil.rmtree(path_unfilled if fill_holes else out_path, ignore_errors=True)
+        raise ValueError("No cell region found in Mask images. Check if the value for mask regions is correct!")
+    if not fill_holes:
+        return mask_images
+    if path_unfilled is None:
+        return fill_holes_scipy(mask_images, filter_size=parameters.pars.mask_dilate_kernel)
+    try:
+        fill_holes_blockwise(path_unfilled, out_path, parameters.pars.mask_dilate_kernel, show_info=show_info)
+    finally:
+        shutil.rmtree(path_unfilled, ignore_errors=True)
+    return load_volume_cache(out_path)
+
+
+def load_cell_region(cell_value: int, path_cells: Path, key: str = "",
+                     show_info: Callable[[str], None] = print) -> da.Array:
+    """Cell regions of a folder of TIFF images (cached, see load_cells), or of a dataset in a container
+    (compared lazily slice by slice, without a cache)"""
+    if is_container(path_cells):
+        cells = load_container_lazy(path_cells, key) == cell_value
+        print("Image shape:", cells.shape)
+        return cells
+    return load_cells(cell_value, path_cells, file_cached=VolumeCache(path_cells), show_info=show_info)
+
+
+def load_mask_region(mask_value: int, path_mask: Path, fill_holes: bool, key: str = "", update_cache: bool = False,
+                     show_info: Callable[[str], None] = print) -> da.Array:
+    """Mask regions of a folder of TIFF images or of a dataset in a container (see load_cell_region).
+    The mask with holes filled is always cached"""
+    if is_container(path_mask) and not fill_holes:
+        mask = load_container_lazy(path_mask, key) == mask_value
+        print("Image shape:", mask.shape)
+        return mask
+    cache = VolumeCache(path_mask, key)
+    if update_cache:
+        cache.clear()
+    return load_mask(mask_value, path_mask, fill_holes, key=key, file_cached=cache, show_info=show_info)
+
+
+def downsample_mean(volume: da.Array) -> da.Array:
+    """Volume (H, W, Z) downsampled by 2 along H and W, averaged over blocks of 2 x 2 pixels.
+    A last odd row/column is dropped"""
+    return da.coarsen(np.mean, volume, {0: 2, 1: 2}, trim_excess=True).astype(volume.dtype)
+
+
+def load_raw_levels(raw: da.Array, path_raw: Path, key: str = "",
+                    show_info: Callable[[str], None] = print) -> List[da.Array]:
+    """Downsampled levels of the raw images (H / 2 ** i, W / 2 ** i, Z), i = 1..parameters.pars.multiscale_levels,
+    for showing them as multiscale layers
+
+    Notes
+    -----
+    Each level is averaged from the previous one slice by slice in parallel, and stored in the VolumeCache of the
+    raw images, so it is built only once.
+    """
+    cache = VolumeCache(path_raw, key)
+    levels = [raw]
+    for level in range(1, parameters.pars.multiscale_levels + 1):
+        pars = {"level": level}
+        path_level = cache.get("raw_pyramid", pars)
+        if path_level is None:
+            show_info(f"Building the level {level} of the multiscale raw images... Please wait")
+            path_level = cache.new_path("raw_pyramid", pars)
+            cache.path_cache.mkdir(parents=True, exist_ok=True)
+            save_volume_cache(path_level, downsample_mean(levels[-1]), show_info=show_info)
+            cache.add("raw_pyramid", pars, path_level)
+        levels.append(load_volume_cache(path_level))
+    return levels[1:]
+
+
+def _npy_name(path_cells: Path, addi_str: str = "") -> Path:
+    return Path(*path_cells.parts[:-1], path_cells.parts[-1] + addi_str + ".npy")
+
+
+def _cache_name(path_cells: Path, addi_str: str = "") -> Path:
+    return Path(*path_cells.parts[:-1], path_cells.parts[-1] + addi_str + "_cache")
+
+
 def add_blank_lines(string: str, max_lines: int) -> str:
     num_lines = string.count("\n") + 1
     if num_lines < max_lines:
@@ -218,15 +737,35 @@ def make_folder(path_i: Path) -> Path:
 
 
 class TinyCells:
+    """Sort the cells by areas (descending), and remove the smallest cells
+
+    Notes
+    -----
+    The areas are counted with np.bincount and the lookup table (old label -> new label) is built with one argsort,
+    so the time is linear in the number of voxels and nearly independent of the number of labels.
+    The volumes are processed in contiguous chunks to limit the temporary memory.
+    """
 
     def __init__(self):
         pass
 
     def sort_by_areas(self, label_image: ndarray):
-        labels, areas = np.unique(label_image, return_counts=True)
-        idxes_sorted = sorted(range(1, len(labels)), key=lambda i: areas[i], reverse=True)
+        self.sort_by_label_areas(label_areas(label_image))
+
+    def sort_by_label_areas(self, areas: ndarray):
+        """Same as sort_by_areas, but from the areas indexed by the labels (e.g. accumulated slice by slice)"""
+        labels = np.flatnonzero(areas)
+        labels = labels[labels != 0]
+        idxes_sorted = np.lexsort((labels, -areas[labels]))
         self.sorted_labels = labels[idxes_sorted]
-        self.sorted_areas = areas[idxes_sorted]
+        self.sorted_areas = areas[self.sorted_labels]
+
+    def relabel_table(self, max_label: int, dtype: type, max_cell_num: Optional[int] = None) -> ndarray:
+        """Lookup table (old label -> new label) for removing the smallest cells and relabeling by areas"""
+        sorted_labels = self.sorted_labels if max_cell_num is None else self.sorted_labels[:max_cell_num]
+        table = np.zeros(max_label + 1, dtype=dtype)
+        table[sorted_labels] = np.arange(1, len(sorted_labels) + 1)
+        return table
 
     def min_area(self, max_cell_num: int = 65535) -> Tuple[int, int]:
         """Return the minimum areas and the number of labels to be deleted"""
@@ -239,15 +778,27 @@ class TinyCells:
         return max_area_delete, num_delete
 
     def remove_and_relabel(self, image3d: ndarray, max_cell_num: Optional[int] = None) -> ndarray:
+        """Relabel image3d by the sorted areas. The labels not in sorted_labels (e.g. painted later) are removed"""
+        max_label = int(np.max(image3d)) if image3d.size else 0
+        return apply_lookup_table(self.relabel_table(max_label, image3d.dtype, max_cell_num), image3d)
+
+    def sort_by_areas_deprecated(self, label_image: ndarray):
+        labels, areas = np.unique(label_image, return_counts=True)
+        idxes_sorted = sorted(range(1, len(labels)), key=lambda i: areas[i], reverse=True)
+        self.sorted_labels = labels[idxes_sorted]
+        self.sorted_areas = areas[idxes_sorted]
+
+    def remove_and_relabel_deprecated(self, image3d: ndarray, max_cell_num: Optional[int] = None) -> ndarray:
         maps = np.arange(0, np.max(self.sorted_labels) + 1, dtype=image3d.dtype)
         if max_cell_num is None:
-            self.relabel_sorted_labels(maps, self.sorted_labels)
+            self.relabel_sorted_labels_deprecated(maps, self.sorted_labels)
         else:
             maps[np.isin(maps, self.sorted_labels[max_cell_num:])] = 0
-            self.relabel_sorted_labels(maps, self.sorted_labels[:max_cell_num])
+            self.relabel_sorted_labels_deprecated(maps, self.sorted_labels[:max_cell_num])
         return maps[image3d]
 
-    def relabel_sorted_labels(self, maps: ndarray, sorted_labels: ndarray) -> int:
+    @staticmethod
+    def relabel_sorted_labels_deprecated(maps: ndarray, sorted_labels: ndarray):
         """Relabel according to areas (descending)"""
         cell_num = len(sorted_labels)
         ori_labels = sorted_labels.tolist()
@@ -258,6 +809,47 @@ class TinyCells:
                 maps[maps_ == o] = t
 
 
+def _chunks(image: ndarray, chunk_voxels: int) -> List[Tuple]:
+    """Indexes of the chunks along the outermost axis in memory (the last axis for the Fortran ordered arrays),
+    so that each chunk is contiguous"""
+    if image.ndim == 0:
+        return [Ellipsis]
+    axis = image.ndim - 1 if image.flags.f_contiguous and not image.flags.c_contiguous else 0
+    step = max(1, chunk_voxels * image.shape[axis] // max(image.size, 1))
+    return [(slice(None),) * axis + (slice(i, i + step),) for i in range(0, image.shape[axis], step)]
+
+
+def label_areas(label_image: ndarray, chunk_voxels: int = 2 ** 24) -> ndarray:
+    """Areas (voxel numbers) of all labels, indexed by the labels"""
+    areas = np.zeros(1, dtype=np.int64)
+    for idx in _chunks(label_image, chunk_voxels):
+        counts = np.bincount(np.asarray(label_image[idx]).ravel(order="K"))
+        if len(counts) > len(areas):
+            counts[:len(areas)] += areas
+            areas = counts
+        else:
+            areas[:len(counts)] += counts
+    return areas
+
+
+def apply_lookup_table(table: ndarray, image: ndarray, chunk_voxels: int = 2 ** 22,
+                       workers: Optional[int] = None) -> ndarray:
+    """Return table[image]. The chunks are transformed in parallel"""
+    result = np.empty_like(image, dtype=table.dtype)
+    chunks = _chunks(image, chunk_voxels)
+    workers = min(4, os.cpu_count() or 1) if workers is None else workers
+    if workers == 1 or len(chunks) == 1:
+        np.take(table, image, out=result)
+        return result
+
+    def transform(idx):
+        result[idx] = table[image[idx]]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(transform, chunks))
+    return result
+
+
 def replace(labels_old: Union[int, Set[int]], label_new: int, array: ndarray) -> ndarray:
     if isinstance(labels_old, set):
         array[np.isin(array, list(labels_old))] = label_new
@@ -280,19 +872,12 @@ def mask_cells(label_img: ndarray, mask: ndarray, ratio_mask: float) -> ndarray:
 
 def get_unused_labels_quick(used_labels: Iterable, max_num: Optional[int] = None) -> List[int]:
     def get_unused_labels_init_quick(labels_array_, label_max_):
-        """labels_array_: array of positive int"""
-        pointer = 0
-        new_labels_ = []
-        for label in range(1, label_max_ + 1):
-            if labels_array_[pointer] != label:
-                new_labels_.append(label)
-            else:
-                pointer += 1
-        return new_labels_
+        """labels_array_: sorted array of unique positive int"""
+        return np.setdiff1d(np.arange(1, label_max_ + 1), labels_array_, assume_unique=True).tolist()
 
-    labels_array = np.unique(list(used_labels))
+    labels_array = np.unique(used_labels if isinstance(used_labels, ndarray) else list(used_labels))
     labels_array = labels_array[labels_array > 0]
-    label_max = labels_array[-1]
+    label_max = int(labels_array[-1])
     new_labels = get_unused_labels_init_quick(labels_array, label_max)
     if max_num is None:
         return new_labels
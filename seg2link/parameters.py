@@ -16,20 +16,34 @@ if DEBUG:
 @dataclass
 class Seg2LinkPara:
     # Cache
-    cache_length_r1: int = 10
+    cache_length_r1: int = 200
     cache_length_r2: int = 5
+    # Memory used for caching the segmentation results of the slices in round 1 (unit: MB)
+    cache_seg_mb_r1: int = 2048
+    # A checkpoint of the labels (all slices) is archived every N slices, other slices store the differences
+    checkpoint_interval_r1: int = 50
+    # Memory used for caching the decoded chunks of each Zarr/N5/HDF5 dataset (unit: MB)
+    cache_chunks_mb: int = 512
+    # Memory used for caching the decoded slices of each image (raw/cell/mask) shown in round 1 and 2 (unit: MB)
+    cache_images_mb: int = 1024
 
     # Data
     raw_bit: int = 8
     seg_bit_r2: int = 16
     upper_limit_labels_r2: int = 64000
+    # Store the volumes (H, W, Z) slice by slice in memory/cache files (Fortran order), so that each slice is contiguous
+    z_first_layout: bool = True
 
     # Visualization
     max_draw_layers_r1: int = 100
     scale_xyz: Tuple[int, int, int] = (1, 1, 10)
+    # Number of downsampled levels (by 2 along x and y) of the images shown as multiscale layers. 0: single resolution
+    multiscale_levels: int = 0
 
     # Segmentation
     h_watershed: int = 5
+    # Number of the following slices segmented in background during round 1. 0: no prefetch
+    prefetch_depth_r1: int = 2
     # For adding boundary. '2D' or '3D'
     add_boundary_mode: str = '2D'
     # For removing boundary. Kernel along x, y, z axis. unit: voxels
@@ -84,5 +98,12 @@ label_filename_v1 = 'label%04i.pickle'  # Deprecated. Will be removed in future
 label_filename_v2 = 'labels_list_%04i.pickle'
 re_filename_v1 = r'label\d+.pickle'  # Deprecated. Will be removed in future
 re_filename_v2 = r'labels_list_\d+.pickle'
+label_delta_filename = 'labels_delta_%04i.pickle'
+re_delta_filename = r'labels_delta_\d+.pickle'
+manifest_filename = 'manifest.json'
+manifest_journal_filename = 'manifest_journal.jsonl'
+seg_filename_v1 = 'segmentation_slice%04i.npz'  # Deprecated. Converted into seg_store_v2 when found
+re_seg_filename_v1 = r'segmentation_slice(\d+).npz'
+seg_store_v2 = 'segmentation.zarr'
 
 
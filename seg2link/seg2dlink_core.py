@@ -1,23 +1,33 @@
 from __future__ import annotations
 
-import copy
+import atexit
+import bisect
 import itertools
+import json
 import os
 import pickle
 import re
-from collections import OrderedDict
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from pathlib import Path
-from typing import List, Tuple, Optional, Union, Set, TYPE_CHECKING, Iterable
+from threading import Condition, RLock, Thread
+from weakref import WeakSet
+from typing import List, Tuple, Optional, Union, Set, TYPE_CHECKING, Iterable, Callable, Dict, NamedTuple, Deque
 
 import numpy as np
 import skimage as ski
+import zarr
 from numpy import ndarray
 from skimage.segmentation import relabel_sequential
 
 from seg2link import parameters
 from seg2link.link_by_overlap import link_previous_slices_round1, link_a_divided_label_round1
-from seg2link.misc import make_folder, replace, mask_cells, flatten_2d_list, get_unused_labels_quick
+from seg2link.misc import make_folder, mask_cells, flatten_2d_list, get_unused_labels_quick, TinyCells, \
+    empty_volume
+from seg2link.slice_cache import SliceCache
 from seg2link.watersheds import dist_watershed
+from seg2link.writers import get_writer, write_slices
 
 if TYPE_CHECKING:
     from seg2link.seg2link_round1 import Seg2LinkR1
@@ -25,65 +35,291 @@ if TYPE_CHECKING:
 if parameters.DEBUG:
     from seg2link.parameters import lprofile
 
+class FlatLabels(NamedTuple):
+    """A copy of the labels in all slices, used for caching the states"""
+    labels1d: ndarray
+    label_nums: List[int]
+
+
+class LabelsSnapshot(NamedTuple):
+    """An immutable state of the labels, used for undo/redo.
+
+    The arrays of the union-find are stored per slice (parent, label of the root), and the blocks of unchanged slices
+    are shared with the previous snapshot, so a snapshot only copies the slices modified since then.
+    """
+    blocks: Tuple[Tuple[ndarray, ndarray], ...]
+    label_nums: List[int]
+
+
+class LabelUnionFind:
+    """Disjoint sets of the nodes (positions in the flat label list of all slices) sharing a same label
+
+    Notes
+    -----
+    The root of each set is always the node with the lowest index, and only the roots store the label.
+    Thus a merge/delete/link only changes the labels of a few roots or unions two roots (the one with larger
+    index points to the other one), instead of rewriting every occurrence of the labels in all slices.
+    Removing the last nodes never removes the root of a remaining node (used for replacing the last slice).
+    The nodes modified since the last call of pop_modified() are tracked for the snapshots. The path compression
+    is not tracked because an old parent is still an ancestor of the node.
+    """
+
+    __slots__ = ['_parent', '_root_label', '_label_root', '_size', '_modified_roots', '_unmodified_size']
+
+    def __init__(self, labels1d: Union[ndarray, List[int]] = ()):
+        labels1d = np.asarray(labels1d, dtype=np.int64)
+        labels, first_nodes, inverse = np.unique(labels1d, return_index=True, return_inverse=True)
+        self._parent = first_nodes[inverse.ravel()].astype(np.int64)
+        self._root_label = labels1d.copy()
+        self._label_root: Dict[int, int] = dict(zip(labels.tolist(), first_nodes.tolist()))
+        self._size = len(labels1d)
+        self._modified_roots: Set[int] = set()
+        self._unmodified_size = 0
+
+    @classmethod
+    def from_arrays(cls, parent: ndarray, root_label: ndarray) -> "LabelUnionFind":
+        """Restore the sets from the parents and the labels of the roots (e.g. from a snapshot)"""
+        sets = cls()
+        sets._parent = parent
+        sets._root_label = root_label
+        sets._size = len(parent)
+        roots = np.flatnonzero(parent == np.arange(len(parent)))
+        sets._label_root = dict(zip(root_label[roots].tolist(), roots.tolist()))
+        sets._unmodified_size = sets._size
+        return sets
+
+    def arrays(self, start: int, stop: int) -> Tuple[ndarray, ndarray]:
+        """Copies of the parents and the labels of the roots of the nodes from start to stop"""
+        return self._parent[start:stop].copy(), self._root_label[start:stop].copy()
+
+    def pop_modified(self) -> Tuple[Set[int], int]:
+        """The roots relabeled/unioned and the number of leading nodes not appended/removed since the last call"""
+        modified = self._modified_roots, self._unmodified_size
+        self._modified_roots = set()
+        self._unmodified_size = self._size
+        return modified
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def labels(self):
+        """All labels in use"""
+        return self._label_root.keys()
+
+    def labels_before(self, node: int) -> ndarray:
+        """Labels used by the nodes with index < node"""
+        return np.fromiter((label for label, root in self._label_root.items() if root < node), dtype=np.int64)
+
+    def _reserve(self, size: int):
+        if size > len(self._parent):
+            capacity = max(size, 2 * len(self._parent))
+            for name in ("_parent", "_root_label"):
+                buffer = np.zeros(capacity, dtype=np.int64)
+                buffer[:self._size] = getattr(self, name)[:self._size]
+                setattr(self, name, buffer)
+
+    def append(self, labels: ndarray):
+        """Add nodes with the labels. Nodes with an existing label join its set"""
+        start = self._size
+        self._reserve(start + len(labels))
+        labels_, first_nodes, inverse = np.unique(labels, return_index=True, return_inverse=True)
+        roots = np.array([self._label_root.setdefault(label, start + node)
+                          for label, node in zip(labels_.tolist(), first_nodes.tolist())], dtype=np.int64)
+        self._parent[start:start + len(labels)] = roots[inverse.ravel()]
+        self._root_label[start:start + len(labels)] = labels
+        self._size += len(labels)
+
+    def truncate(self, size: int):
+        """Remove the nodes with index >= size"""
+        for label in [label for label, root in self._label_root.items() if root >= size]:
+            del self._label_root[label]
+        self._size = min(size, self._size)
+        self._unmodified_size = min(size, self._unmodified_size)
+
+    def find(self, nodes: ndarray) -> ndarray:
+        """Roots of the nodes. The nodes are then pointed to their roots directly (path compression)"""
+        parent = self._parent
+        roots = parent[nodes]
+        grandparents = parent[roots]
+        while not np.array_equal(roots, grandparents):
+            roots = grandparents
+            grandparents = parent[roots]
+        parent[nodes] = roots
+        return roots
+
+    def resolve(self, start: int = 0, stop: Optional[int] = None) -> ndarray:
+        """The labels of the nodes from start to stop"""
+        stop = self._size if stop is None else stop
+        return self._root_label[self.find(np.arange(start, stop))]
+
+    def relabel(self, mapping: Dict[int, int]):
+        """Change the labels simultaneously (old -> new). Sets with a same new label are unioned"""
+        roots = {old: self._label_root.pop(old) for old, new in mapping.items()
+                 if old != new and old in self._label_root}
+        for old, root in roots.items():
+            new = int(mapping[old])
+            root_other = self._label_root.get(new)
+            if root_other is not None:
+                root, root_child = min(root, root_other), max(root, root_other)
+                self._parent[root_child] = root
+                self._modified_roots.add(root_child)
+            self._label_root[new] = root
+            self._root_label[root] = new
+            self._modified_roots.add(root)
+
+
 class Labels:
-    """Labels are stored as a python list corresponding to the values in the segmented images"""
+    """Labels are stored as disjoint sets corresponding to the values in the segmented images
+
+    Notes
+    -----
+    The labels of all slices are concatenated in a flat list, the position of the labels of slice z is given by the
+    offsets: labels1d[_offsets[z - 1]:_offsets[z]]. The equivalence of the positions sharing a label is stored in
+    a LabelUnionFind, so that merging/deleting/linking do not depend on the number of processed slices.
+    The flat array (labels1d) is resolved and cached when needed, and the nested lists (_labels) are only
+    created for archiving.
+    """
 
-    __slots__ = ['emseg1', '_labels', 'ratio_overlap', '_label_nums']
+    __slots__ = ['emseg1', 'ratio_overlap', '_label_nums', '_sets', '_offsets', '_max_label', '_resolved',
+                 '_snapshot']
 
-    _labels: List[List[int]]
     _label_nums: List[int]
+    _sets: LabelUnionFind
+    _offsets: List[int]
 
     def __init__(self, emseg1: "Seg2LinkR1", ratio_overlap: float = 0.5):
-        self._labels = []
         self.emseg1 = emseg1
         self.ratio_overlap = ratio_overlap
         self._label_nums = []
+        self.reset()
 
     def __repr__(self):
         return "Current slice number: " + str(self.emseg1.current_slice) + ";   Current label number: " + str(self._cell_num)
 
     def reset(self):
-        self._labels.clear()
+        self.set_flat(np.zeros(0, dtype=np.int64), [])
+
+    @property
+    def _labels(self) -> List[List[int]]:
+        """The labels as a list of lists (one list per slice), the format stored in the archive"""
+        return self._to_labels2d(self.labels1d.tolist(), self.label_nums)
+
+    @_labels.setter
+    def _labels(self, labels2d: List[List[int]]):
+        labels1d, label_nums = flatten_2d_list(labels2d)
+        self.set_flat(np.asarray(labels1d, dtype=np.int64), label_nums)
+
+    def set_flat(self, labels1d: ndarray, label_nums: List[int]):
+        """Set the labels of all slices from the flat array and the label numbers in each slice"""
+        self._sets = LabelUnionFind(labels1d)
+        self._offsets = list(itertools.accumulate([0] + list(label_nums)))
+        self._snapshot = None
+        self._modified()
+
+    def copy_flat(self) -> FlatLabels:
+        return FlatLabels(self.labels1d.copy(), self.label_nums)
+
+    def snapshot(self) -> LabelsSnapshot:
+        """Save the current state. Only the slices modified since the last snapshot are copied"""
+        modified_roots, unmodified_size = self._sets.pop_modified()
+        previous = self._snapshot.blocks if self._snapshot is not None else ()
+        modified_slices = {bisect.bisect_right(self._offsets, node) for node in modified_roots}
+        label_nums = self.label_nums
+        # A previous block is reused only if its slice was neither modified nor truncated (e.g. replaced by an empty
+        # slice, whose offset is still <= unmodified_size)
+        blocks = tuple(
+            previous[z - 1] if z <= len(previous) and self._offsets[z] <= unmodified_size and z not in modified_slices
+            and len(previous[z - 1][0]) == label_nums[z - 1]
+            else self._sets.arrays(self._offsets[z - 1], self._offsets[z]) for z in range(1, len(self._offsets)))
+        self._snapshot = LabelsSnapshot(blocks, label_nums)
+        return self._snapshot
+
+    def set_snapshot(self, snapshot: LabelsSnapshot):
+        """Restore the state saved by snapshot()"""
+        if snapshot.blocks:
+            parent, root_label = (np.concatenate(arrays) for arrays in zip(*snapshot.blocks))
+            self._sets = LabelUnionFind.from_arrays(parent, root_label)
+        else:
+            self._sets = LabelUnionFind()
+        self._offsets = list(itertools.accumulate([0] + list(snapshot.label_nums)))
+        self._snapshot = snapshot
+        self._modified()
+
+    def _modified(self):
+        """Invalidate the cached results after the labels were modified"""
+        self._max_label = None
+        self._resolved = None
+
+    def _append_slice(self, labels: ndarray):
+        self._sets.append(np.asarray(labels, dtype=np.int64))
+        self._offsets.append(len(self._sets))
+        self._modified()
+
+    def _relabel(self, mapping: Dict[int, int]):
+        self._sets.relabel(mapping)
+        self._modified()
+
+    @property
+    def labels1d(self) -> ndarray:
+        """Labels of all slices (read-only)"""
+        if self._resolved is None:
+            self._resolved = self._sets.resolve()
+            self._resolved.setflags(write=False)
+        return self._resolved
+
+    @property
+    def label_nums(self) -> List[int]:
+        return np.diff(self._offsets).tolist()
+
+    @property
+    def slice_num(self) -> int:
+        return len(self._offsets) - 1
+
+    def slice_labels(self, layer: int) -> ndarray:
+        """Labels in the slice (starting from 1)"""
+        if not 1 <= layer <= self.slice_num:
+            raise IndexError(f"Slice {layer} is out of the range 1-{self.slice_num}")
+        if self._resolved is not None:
+            return self._resolved[self._offsets[layer - 1]:self._offsets[layer]]
+        return self._sets.resolve(self._offsets[layer - 1], self._offsets[layer])
+
+    def set_last_labels(self, labels: Union[ndarray, List[int]]):
+        """Replace the labels in the last slice"""
+        self._offsets.pop()
+        self._sets.truncate(self._offsets[-1])
+        self._append_slice(labels)
 
     def cal_unused_labels(self) -> Set[int]:
-        return set(get_unused_labels_quick(self.flatten()[0]))
+        return set(get_unused_labels_quick(self.labels1d))
 
     @property
     def unused_labels(self) -> str:
-        return str(f"{self.cal_unused_labels()}, and {np.max(self.flatten()[0]) + 1}...")
+        return str(f"{self.cal_unused_labels()}, and {np.max(self.labels1d) + 1}...")
 
     def rollback(self):
-        if len(self._labels) > 0:
+        if self.slice_num > 0:
             labels = self.emseg1.archive.read_labels(self.emseg1.current_slice - 1)
             if isinstance(labels, Labels):
-                self._labels = labels._labels
+                self.set_flat(*labels.flatten())
             else:
-                self._labels = labels
+                self.set_flat(*labels)
             self.emseg1.current_slice -= 1
 
-    def flatten(self) -> Tuple[List[int], List[int]]:
-        return flatten_2d_list(self._labels)
+    def flatten(self) -> Tuple[ndarray, List[int]]:
+        return self.labels1d, self.label_nums
 
     def delete(self, delete_list: Union[int, Set[int]]):
-        """Delete a label (modify the value in self._labels to 0)"""
-        labels1d, label_nums = self.flatten()
-        labels1d_array = np.asarray(labels1d, dtype=int)
-        labels1d_array = replace(delete_list, 0, labels1d_array)
-        self._labels = self._to_labels2d(labels1d_array.tolist(), label_nums)
+        """Delete a label (modify the label of its set to 0)"""
+        delete_list = {delete_list} if isinstance(delete_list, (int, np.integer)) else delete_list
+        self._relabel({label: 0 for label in delete_list})
 
     def merge(self):
         """Merge the cells in the label_list and modify the transformation list"""
-        labels1d, label_nums = self.flatten()
-        labels1d_array = np.asarray(labels1d, dtype=int)
-
         target = min(self.emseg1.label_list)
-        if not np.isin(target, labels1d_array):
+        if target not in self._sets.labels:
             raise ValueError("Label ", target, " not exist")
-        for label in self.emseg1.label_list:
-            if label != target:
-                labels1d_array = replace(label, target, labels1d_array)
-        self._labels = self._to_labels2d(labels1d_array.tolist(), label_nums)
-
+        self._relabel({label: target for label in self.emseg1.label_list})
 
     @staticmethod
     def _to_labels2d(labels1d: List[int], label_nums: List[int]) -> List[List[int]]:
@@ -92,72 +328,115 @@ class Labels:
 
     @property
     def _cell_num(self) -> int:
-        return len(set([item for sublist in self._labels for item in sublist]))
+        return len(self._sets.labels)
 
     @property
     def max_label(self) -> int:
-        if len(self._labels) == 0:
-            return 0
-        label_lists = [item for sublist in self._labels for item in sublist]
-        if not label_lists:
-            return 0
-        return max(label_lists)
+        if self._max_label is None:
+            self._max_label = max(self._sets.labels, default=0)
+        return self._max_label
 
     def append_labels(self, initial_seg: Segmentation):
         _labels = np.unique(initial_seg.current_seg)
-        labels = _labels[_labels != 0].tolist()
-        self._labels.append(labels)
+        self._append_slice(_labels[_labels != 0])
 
-    def to_labels_img(self, layer: int, seg_img_cache: OrderedDict) -> ndarray:
+    def to_labels_img(self, layer: int, seg_img_cache: SliceCache) -> ndarray:
+        labels_pre_slice = np.concatenate(([0], self.slice_labels(layer)))
+        seg_img = self.emseg1.archive.read_seg_img(seg_img_cache, layer)
         try:
-            labels_pre_slice = np.asarray([0] + self._labels[layer - 1])
-            seg_img = self.emseg1.archive.read_seg_img(seg_img_cache, layer)
             return labels_pre_slice[seg_img]
         except IndexError:
             raise IndexError(f"{labels_pre_slice.max()=}, {seg_img.max()=}, {layer=}")
 
-    def get_seg_and_labels_tolink(self) \
-            -> Tuple[ndarray, ndarray, ndarray, ndarray]:
+    def get_seg_and_labels_tolink(self) -> Tuple[ndarray, ndarray, ndarray]:
         """Prepare the segmentations and label for linking"""
         seg_pre = self.to_labels_img(self.emseg1.current_slice - 1, self.emseg1.seg_img_cache)
 
-        labels1d, self._label_nums = self.flatten()
-        labels_pre_1d = np.asarray(labels1d)
-
         seg_post = self.emseg1.seg.current_seg.copy()
-        if labels1d:
-            seg_post[seg_post != 0] += max(labels1d)
+        if len(self._sets) > 0:
+            seg_post[seg_post != 0] += self.max_label
 
         labels_post = np.unique(seg_post)
         labels_post = labels_post[labels_post != 0]
 
-        return seg_pre, seg_post, labels_post, labels_pre_1d
+        return seg_pre, seg_post, labels_post
 
     def to_multiple_labels(self, layers: slice) -> ndarray:
         """Get segmentation results (images) around current slice"""
         layer_num = layers.stop - layers.start
         h, w = self.emseg1.seg.current_seg.shape
-        labels_img = np.zeros((layer_num, h, w), dtype=np.uint32)
+        labels_img = empty_volume((h, w, layer_num), np.uint32)
+        self.emseg1.seg_img_cache.load_many(list(range(layers.start + 1, min(layers.stop, self.emseg1.current_slice) + 1)))
         for i, z in enumerate(range(layers.start, layers.stop)):
             if (z + 1) <= self.emseg1.current_slice:
-                labels_img[i, ...] = self.to_labels_img(z + 1, self.emseg1.seg_img_cache)
+                labels_img[..., i] = self.to_labels_img(z + 1, self.emseg1.seg_img_cache)
             else:
                 break
-        return labels_img.transpose((1, 2, 0))
+        self.prefetch_seg_img(layers)
+        return labels_img
+
+    def label_areas(self) -> ndarray:
+        """Areas of all labels (indexed by the labels), accumulated slice by slice"""
+        areas = np.zeros(self.max_label + 1, dtype=np.int64)
+        for z, seg_img in self._iter_seg_imgs():
+            labels_z = self.slice_labels(z)
+            counts = np.bincount(seg_img.ravel(), minlength=len(labels_z) + 1)
+            np.add.at(areas, labels_z, counts[1:len(labels_z) + 1])
+        areas[0] = 0
+        return areas
+
+    def export_sorted(self, path: Union[str, Path], dtype: type, max_cell_num: Optional[int] = None,
+                      show_info: Callable[[str], None] = print):
+        """Save the labels images of all slices (H, W, slice), sorted by areas (descending).
+        Cells smaller than the largest max_cell_num cells are removed. The format is chosen by the file name
+        (see writers.get_writer)
+
+        Notes
+        -----
+        The volume is never created in RAM: the areas are counted slice by slice, and the relabeled slices are
+        written one by one into the file
+        """
+        show_info("Counting the areas of cells... Please wait")
+        tc = TinyCells()
+        tc.sort_by_label_areas(self.label_areas())
+        table = tc.relabel_table(self.max_label, dtype, max_cell_num)
+
+        def relabeled_slice(z: int) -> ndarray:
+            return table[np.concatenate(([0], self.slice_labels(z + 1)))][self.emseg1.archive.load_seg_img(z + 1)]
+
+        self.labels1d  # Resolve the labels before reading them in parallel
+        h, w = self.emseg1.seg.current_seg.shape
+        with get_writer(path, (h, w, self.slice_num), dtype) as writer:
+            write_slices(writer, relabeled_slice, show_info=show_info)
+
+    def _iter_seg_imgs(self, batch_size: int = 8) -> Iterable[Tuple[int, ndarray]]:
+        """Load the segmentations of all slices, a few slices at a time"""
+        archive = self.emseg1.archive
+        archive.flush()
+        for start in range(1, self.slice_num + 1, batch_size):
+            slice_nums = list(range(start, min(start + batch_size, self.slice_num + 1)))
+            yield from zip(slice_nums, archive.load_seg_imgs(slice_nums))
+
+    def prefetch_seg_img(self, layers: slice):
+        """Load the segmentations of the slices next to the displayed ones in background"""
+        cache = self.emseg1.seg_img_cache
+        neighbours = itertools.chain(range(layers.start, layers.start - cache.margin, -1),
+                                     range(layers.stop + 1, layers.stop + cache.margin + 1))
+        cache.prefetch(z for z in neighbours if 1 <= z <= self.emseg1.current_slice)
 
     def link_or_append_labels(self):
         if self.emseg1.current_slice == 1:
             self.append_labels(self.emseg1.seg)
             return False
 
-        seg_pre, seg_post, list_post, list_pre_1d = self.get_seg_and_labels_tolink()
+        seg_pre, seg_post, list_post = self.get_seg_and_labels_tolink()
         if np.max(seg_pre) == 0:
-            max_label = np.max(list_pre_1d) if list_pre_1d.tolist() else 0
-            self._labels.append((list_post + max_label).tolist())
+            self._append_slice(list_post + self.max_label)
             return False
-        list_pre_1d_linked, list_post_linked = link_previous_slices_round1(
-            seg_pre, seg_post, list_pre_1d, list_post, self.ratio_overlap)
-        self._labels = self._to_labels2d(list_pre_1d_linked, self._label_nums) + [list_post_linked]
+        targets_pre, list_post_linked = link_previous_slices_round1(
+            seg_pre, seg_post, list_post, self.ratio_overlap)
+        self._relabel(targets_pre)
+        self._append_slice(list_post_linked)
         return True
 
     def relink_or_append_labels(self):
@@ -166,56 +445,72 @@ class Labels:
         list_pre_1d_linked, list_post_linked = link_a_divided_label_round1(
             labels_pre_now, labels_s2_now, labels_pre_past, seg_s1_past, seg_s2_now,
             self.emseg1.labels_divided, self.ratio_overlap)
-        self._labels = self._to_labels2d(list_pre_1d_linked, self._label_nums) + [list_post_linked]
+        self.set_flat(np.concatenate((list_pre_1d_linked, list_post_linked)),
+                      self._label_nums + [len(list_post_linked)])
 
     def get_seg_and_labels_to_relink(self) -> Tuple[List[int], List[int], List[int], ndarray, ndarray]:
         """Prepare the segmentations and label for relinking"""
-        current_labels_pre, _ = flatten_2d_list(self._labels[:-1])  # For linking by searching for same labels: (1)
-        current_labels_s2 = copy.deepcopy(self._labels[-1])  # (1)
+        current_labels_pre = self.labels1d[:self._offsets[-2]].tolist()  # For linking by searching for same labels: (1)
+        current_labels_s2 = self.slice_labels(self.slice_num).tolist()  # (1)
         current_seg_s2 = self.emseg1.seg.current_seg.copy()  # For linking by overlapping seg1 and seg2: (2)
         self.rollback()
         history_labels_pre, self._label_nums = self.flatten()  # (1) and (2)
         history_seg_s1 = self.to_labels_img(self.emseg1.current_slice, self.emseg1.seg_img_cache)  # (2)
         self.emseg1.current_slice += 1
-        return current_labels_pre, current_labels_s2, history_labels_pre, history_seg_s1, current_seg_s2
+        return current_labels_pre, current_labels_s2, history_labels_pre.tolist(), history_seg_s1, current_seg_s2
 
     def relabel(self):
-        """Relabel all N cells with label from 1 to N and save the current state"""
-        labels1d, label_nums = self.flatten()
-        labels1d_re = relabel_min_change(np.asarray(labels1d), labels1d[:-label_nums[-1]])
-        self._labels = self._to_labels2d(labels1d_re.tolist(), label_nums)
+        """Relabel the new labels in the last slice with the unused labels"""
+        self._relabel(relabel_min_change_mapping(self.slice_labels(self.slice_num),
+                                                 self._sets.labels_before(self._offsets[-2])))
 
     def relabel_deprecated(self):
         """Relabel all N cells with label from 1 to N and save the current state (use skimage.relabel_sequential)"""
-        labels1d, label_nums = self.flatten()
-        labels1d_re, fw, _ = relabel_sequential(np.asarray(labels1d))
-        self._labels = self._to_labels2d(labels1d_re.tolist(), label_nums)
+        labels1d_re, fw, _ = relabel_sequential(self.labels1d)
+        self.set_flat(labels1d_re, self.label_nums)
 
 
-def relabel_min_change(labels_array: ndarray, used_labels_1d: Iterable) -> ndarray:
+def map_labels(labels_array: ndarray, mapping: Dict[int, int]) -> ndarray:
+    """Replace the labels simultaneously according to the mapping {old: new}"""
+    if not mapping:
+        return labels_array
+    labels_old = np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping))
+    labels_new = np.fromiter(mapping.values(), dtype=np.int64, count=len(mapping))
+    order = np.argsort(labels_old)
+    labels_old, labels_new = labels_old[order], labels_new[order]
+    idx = np.minimum(np.searchsorted(labels_old, labels_array), len(labels_old) - 1)
+    return np.where(labels_old[idx] == labels_array, labels_new[idx], labels_array)
+
+
+def relabel_min_change_mapping(labels_array: ndarray, used_labels_1d: Iterable) -> Dict[int, int]:
     """
-    Relabel the new labels with unused labels
+    Map the new labels (larger than the used labels) to unused labels
     """
     labels = np.unique(labels_array)
     max_label_used = np.max(used_labels_1d)
     labels_new = labels[labels > max_label_used]
-    len_new = len(labels_new)
+    if len(labels_new) == 0:
+        return {}
+    return dict(zip(labels_new.tolist(), get_unused_labels_quick(used_labels_1d, len(labels_new))))
 
-    if len_new == 0:
-        return labels_array
 
-    ori = labels_new.tolist()
-    tgt = get_unused_labels_quick(used_labels_1d, len_new)
+def relabel_min_change(labels_array: ndarray, used_labels_1d: Iterable) -> ndarray:
+    """
+    Relabel the new labels with unused labels
+    """
+    mapping = relabel_min_change_mapping(labels_array, used_labels_1d)
+    if not mapping:
+        return labels_array
 
     labels_result = labels_array.copy()
-    for i, j in zip(ori, tgt):
+    for i, j in mapping.items():
         labels_result[labels_array == i] = j
     return labels_result
 
 
 class Segmentation:
     """Segment cells in each 2D slice"""
-    __slots__ = ['enable_mask', 'cell_region', 'mask', 'ratio_mask', 'current_seg']
+    __slots__ = ['enable_mask', 'cell_region', 'mask', 'ratio_mask', 'current_seg', 'prefetch']
 
     def __init__(self, cell_region: ndarray, enable_mask: bool, mask: Optional[ndarray], ratio_mask: float):
         self.cell_region = cell_region
@@ -223,15 +518,26 @@ class Segmentation:
         self.mask = mask
         self.ratio_mask = ratio_mask
         self.current_seg = np.array([], dtype=np.uint32)
+        self.prefetch = WatershedPrefetch(self._watershed, cell_region.shape[-1])
 
-    def watershed(self, layer_idx: int):
-        """Segment a 2D label regions and save the result"""
-        current_seg = dist_watershed(self.cell_region[..., layer_idx - 1].compute(),
-                                     h=parameters.pars.h_watershed)
-        if self.enable_mask:
-            self.current_seg = mask_cells(current_seg, self.mask[..., layer_idx - 1].compute(), self.ratio_mask)
+    @property
+    def para_watershed(self) -> tuple:
+        """Parameters affecting the watershed result of a slice. Prefetched results with other values are discarded"""
+        return parameters.pars.h_watershed, self.enable_mask, self.ratio_mask, id(self.mask)
+
+    def _watershed(self, layer_idx: int, para: tuple) -> ndarray:
+        h_watershed, enable_mask, ratio_mask, _ = para
+        current_seg = dist_watershed(self.cell_region[..., layer_idx - 1].compute(), h=h_watershed)
+        if enable_mask:
+            return mask_cells(current_seg, self.mask[..., layer_idx - 1].compute(), ratio_mask)
         else:
-            self.current_seg = current_seg
+            return current_seg
+
+    def watershed(self, layer_idx: int):
+        """Segment a 2D label regions and save the result. The following slices are then segmented in background"""
+        para = self.para_watershed
+        self.current_seg = self.prefetch.get(layer_idx, para)
+        self.prefetch.schedule(layer_idx, para)
 
     def reseg(self, label_img: ndarray, layer_idx: int):
         """Resegment based on the modified segmentation"""
@@ -242,17 +548,191 @@ class Segmentation:
             self.current_seg = current_seg
 
 
+class WatershedPrefetch:
+    """Segment the next slices in worker threads while the user is correcting the current slice
+
+    Notes
+    -----
+    The watershed of a slice does not depend on any correction by the user, so the results of the next
+    parameters.pars.prefetch_depth_r1 slices are computed in advance and handed to the next_slice operation.
+    Each result is stored with the parameters of the watershed (see Segmentation.para_watershed), so a result
+    computed before the inputs were changed is discarded by get/schedule instead of being used.
+    Threads are used instead of processes because the lazy (dask) images cannot be pickled.
+    """
+
+    def __init__(self, segment: Callable[[int, tuple], ndarray], layer_num: int):
+        self.segment = segment
+        self.layer_num = layer_num
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._futures: Dict[int, Tuple[tuple, Future]] = {}
+
+    @property
+    def depth(self) -> int:
+        return max(parameters.pars.prefetch_depth_r1, 0)
+
+    def get(self, layer_idx: int, para: tuple) -> ndarray:
+        """Return the prefetched result if it was computed with the same parameters, otherwise segment it now"""
+        para_prefetched, future = self._futures.pop(layer_idx, (None, None))
+        if future is not None and para_prefetched == para and not future.cancelled():
+            try:
+                return future.result()
+            except Exception as e:
+                print(f"Prefetching slice {layer_idx} failed ({e!r}). Segmenting it again")
+        return self.segment(layer_idx, para)
+
+    def schedule(self, current_layer: int, para: tuple):
+        """Submit the slices after the current layer, and cancel the outdated ones"""
+        layers = range(current_layer + 1, min(current_layer + self.depth, self.layer_num) + 1)
+        for layer, (para_prefetched, future) in list(self._futures.items()):
+            if layer not in layers or para_prefetched != para:
+                future.cancel()
+                self._futures.pop(layer)
+        if not layers:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.depth, thread_name_prefix="seg2link-watershed")
+        for layer in layers:
+            if layer not in self._futures:
+                self._futures[layer] = (para, self._executor.submit(self.segment, layer, para))
+
+    def close(self):
+        """Cancel the pending slices and shut down the worker threads (when the viewer is closed)"""
+        for _, future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class ArchiveRecord(NamedTuple):
+    """The labels and the segmentation to be archived at a slice"""
+    slice_num: int
+    labels: FlatLabels
+    seg_img: ndarray
+
+
+class ArchiveWriter:
+    """Write the archive records in order in a background thread, so that the user does not wait for the disk
+
+    Notes
+    -----
+    Consecutive records of the same slice are coalesced (only the latest one is written). The queued records
+    (not written yet) can be read with pending(). Call flush() to wait until all records are written, which is
+    also done when the program exits. A failed write does not stop the thread: the first error is raised again
+    by the next flush().
+    """
+
+    def __init__(self, write: Callable[[ArchiveRecord], None]):
+        self._write = write
+        self._queue: Deque[ArchiveRecord] = deque()
+        self._writing: Optional[ArchiveRecord] = None
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+        self._error: Optional[Exception] = None
+
+    @property
+    def num_pending(self) -> int:
+        with self._condition:
+            return len(self._queue) + (self._writing is not None)
+
+    def put(self, record: ArchiveRecord):
+        with self._condition:
+            if self._queue and self._queue[-1].slice_num == record.slice_num:
+                self._queue[-1] = record
+            else:
+                self._queue.append(record)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="archive_writer", daemon=True)
+                self._thread.start()
+                _archive_writers.add(self)
+            self._condition.notify_all()
+
+    def pending(self, slice_num: int) -> Optional[ArchiveRecord]:
+        """The latest record of the slice not written yet"""
+        with self._condition:
+            for record in reversed(self._queue):
+                if record.slice_num == slice_num:
+                    return record
+            if self._writing is not None and self._writing.slice_num == slice_num:
+                return self._writing
+        return None
+
+    def flush(self):
+        with self._condition:
+            while self._queue or self._writing is not None:
+                self._condition.wait()
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                self._writing = self._queue.popleft()
+            error = None
+            try:
+                self._write(self._writing)
+            except Exception as e:
+                error = RuntimeError(f"Failed to archive slice {self._writing.slice_num}")
+                error.__cause__ = e
+            with self._condition:
+                if self._error is None:
+                    self._error = error
+                self._writing = None
+                self._condition.notify_all()
+
+
+_archive_writers: "WeakSet[ArchiveWriter]" = WeakSet()
+
+
+@atexit.register
+def _flush_archive_writers():
+    for writer in list(_archive_writers):
+        writer.flush()
+
+
 class Archive:
+    """Archive the labels (one pickle file per slice) and the segmentation results (a chunked zarr array)
+
+    Notes
+    -----
+    The labels at slice k are stored either as a checkpoint (labels_list_%04i.pickle: the labels of all slices),
+    or as a delta (labels_delta_%04i.pickle) from the labels stored at slice k - 1: the mapping of the modified
+    labels in the previous slices and the labels in slice k. A checkpoint is saved every
+    parameters.pars.checkpoint_interval_r1 slices, or when the modification can not be expressed as a mapping.
+    The labels at slice k are reconstructed by replaying the deltas after the nearest checkpoint.
+
+    The 2D segmentation results are stored in History_seg/segmentation.zarr with the shape (slice, h, w) and
+    one chunk per slice, so that a slice can be written/read without touching the other slices, and a range
+    of slices can be read (and decompressed) together. The .npz files (one per slice) saved by older versions
+    are converted into the zarr array when it does not exist yet (the .npz files are kept).
+
+    The label file of each slice (name, size, modification time and CRC32 checksum) is listed in
+    History_labels/manifest.json, so that finding the latest slice or the files to be replayed does not need to list
+    the folder. Each save only appends the entry to manifest_journal.jsonl, which is merged into manifest.json
+    (replaced atomically) when the manifest is loaded or files are deleted. The manifest is rebuilt from the folder
+    if it is missing or out of date. A file whose size or modification time differs from its entry (e.g. overwritten
+    by an older version) is loaded without checking the checksum.
+    """
     def __init__(self, emseg1: "Seg2LinkR1", path_save: Path):
         self.emseg1 = emseg1
         self._path_labels = path_save / "History_labels"
         self._path_seg = path_save / "History_seg"
+        self._seg_store: Optional[zarr.Array] = None
+        self._saved_labels: "OrderedDict[int, FlatLabels]" = OrderedDict()
+        self._manifest: Optional[Dict[int, dict]] = None
+        self._io_lock = RLock()
+        self.writer = ArchiveWriter(self._write_record)
 
     def make_folders(self):
         self._path_labels = make_folder(self._path_labels)
         self._path_seg = make_folder(self._path_seg)
 
-    def retrieve_history(self, target_slice: int, seg_img_cache: OrderedDict) -> Optional[Tuple[Labels, ndarray]]:
+    def retrieve_history(self, target_slice: int, seg_img_cache: SliceCache) \
+            -> Optional[Tuple[Union[FlatLabels, Labels], ndarray]]:
         latest_slice = self.latest_slice
         if latest_slice == 0:
             print("No label files found")
@@ -268,62 +748,275 @@ class Archive:
     @property
     def latest_slice(self) -> int:
         """Return the latest slice of the label stored in the hard disk"""
+        self.flush()
         if not self._path_labels.exists():
             return 0
-        list_files = self.get_file_list(parameters.re_filename_v2)
+        with self._io_lock:
+            return max(self.manifest, default=0)
 
-        if len(list_files) == 0:
-            list_files = self.get_file_list(parameters.re_filename_v1)
+    @property
+    def manifest(self) -> Dict[int, dict]:
+        """{slice: {"file": file name, "size": bytes, "mtime_ns": modification time, "crc32": checksum or None}}
+        of the label files"""
+        if self._manifest is None:
+            path_manifest = self._path_labels / parameters.manifest_filename
+            path_journal = self._path_labels / parameters.manifest_journal_filename
+            manifest = {}
+            try:
+                with open(path_manifest, 'r') as f:
+                    manifest = {int(z): entry for z, entry in json.load(f)["slices"].items()}
+                mtime_manifest = os.stat(path_manifest).st_mtime
+                if path_journal.exists():
+                    mtime_manifest = max(mtime_manifest, os.stat(path_journal).st_mtime)
+                    manifest.update(self._read_manifest_journal())
+                # Files added/removed by other programs (e.g. older versions) after the manifest was written
+                if os.stat(self._path_labels).st_mtime > mtime_manifest + 2:
+                    raise ValueError("The manifest is out of date")
+                self._manifest = manifest
+                if path_journal.exists():
+                    self._write_manifest()
+            except (FileNotFoundError, ValueError, KeyError):
+                self.rebuild_manifest(manifest)
+        return self._manifest
+
+    def _read_manifest_journal(self) -> Dict[int, dict]:
+        """The entries appended after the manifest was written. A line cut off by a crash is ignored"""
+        entries = {}
+        with open(self._path_labels / parameters.manifest_journal_filename, 'r') as f:
+            for line in f:
+                try:
+                    z, entry = json.loads(line)
+                except ValueError:
+                    break
+                entries[int(z)] = entry
+        return entries
+
+    def rebuild_manifest(self, manifest_old: Optional[Dict[int, dict]] = None):
+        """List the label files in the folder. The checksums in the old manifest are kept if the sizes and
+        modification times of the files match"""
+        self._manifest = {}
+        if not self._path_labels.exists():
+            return
+        files_old = {entry["file"]: entry for entry in (manifest_old or {}).values()}
+        regex_slice_num = re.compile(r'\d+')
+        for re_filename in (parameters.re_filename_v1, parameters.re_filename_v2, parameters.re_delta_filename):
+            for fn in self.get_file_list(re_filename):
+                entry = self._file_entry(fn, None)
+                entry_old = files_old.get(fn)
+                if entry_old is not None and self._entry_matches(entry_old, entry["size"], entry["mtime_ns"]):
+                    entry["crc32"] = entry_old["crc32"]
+                self._manifest[int(regex_slice_num.findall(fn)[0])] = entry
+        self._write_manifest()
+
+    def _write_manifest(self):
+        path_manifest = self._path_labels / parameters.manifest_filename
+        path_tmp = path_manifest.with_suffix(".tmp")
+        with open(path_tmp, 'w') as f:
+            json.dump({"version": 2, "slices": {str(z): self._manifest[z] for z in sorted(self._manifest)}}, f)
+        os.replace(path_tmp, path_manifest)
+        try:
+            os.remove(self._path_labels / parameters.manifest_journal_filename)
+        except FileNotFoundError:
+            pass
 
-        regex_slice_nums = re.compile(r'\d+')
-        list_slice_nums = [int(num) for fn in list_files for num in regex_slice_nums.findall(fn)]
+    def _append_manifest(self, slice_num: int):
+        """Record the entry of a saved file in the journal, instead of rewriting the whole manifest"""
+        with open(self._path_labels / parameters.manifest_journal_filename, 'a') as f:
+            f.write(json.dumps([slice_num, self._manifest[slice_num]]) + "\n")
 
-        if not list_slice_nums:
-            return 0
-        return max(list_slice_nums)
+    def _file_entry(self, filename: str, crc32: Optional[int]) -> dict:
+        stat = os.stat(self._path_labels / filename)
+        return {"file": filename, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "crc32": crc32}
+
+    @staticmethod
+    def _entry_matches(entry: dict, size: int, mtime_ns: int) -> bool:
+        """Whether the checksum of the entry applies to the file (not modified since the entry was recorded)"""
+        return entry["crc32"] is not None and entry["size"] == size and entry.get("mtime_ns") == mtime_ns
 
     def get_file_list(self, re_filename):
         return list(filter(re.compile(re_filename).search, os.listdir(self._path_labels)))
 
     def archive_labels_and_seg2d(self):
-        """Archive the label and segmented image"""
-        self.save_labels_v2()
-        self.save_seg_img()
-
-    def save_labels_v2(self):
-        """Save the labels"""
-        labels = self.emseg1.labels
-        if labels.emseg1.current_slice >= 1:
-            with open(self._path_labels / (parameters.label_filename_v2 % labels.emseg1.current_slice), 'wb') as f:
-                pickle.dump(labels._labels, f, pickle.HIGHEST_PROTOCOL)
-
-    def save_seg_img(self):
-        np.savez_compressed(self._path_seg / ('segmentation_slice%04i.npz' % self.emseg1.current_slice),
-                            segmentation=self.emseg1.seg.current_seg)
-        self.append_seg(self.emseg1.seg_img_cache, self.emseg1.seg.current_seg, self.emseg1.current_slice)
+        """Archive the label and segmented image (written by the writer thread)"""
+        slice_num = self.emseg1.current_slice
+        if slice_num < 1:
+            return
+        record = ArchiveRecord(slice_num, FlatLabels(*self.emseg1.labels.flatten()),
+                               self.emseg1.seg.current_seg.copy())
+        self.emseg1.seg_img_cache.put(slice_num, record.seg_img)
+        self.writer.put(record)
+
+    def _write_record(self, record: ArchiveRecord):
+        with self._io_lock:
+            self.save_labels_v2(record.slice_num, record.labels)
+            self.save_seg_img(record.slice_num, record.seg_img)
+
+    def flush(self):
+        """Wait until all archive records were written"""
+        self.writer.flush()
+
+    def save_labels_v2(self, slice_num: int, labels: FlatLabels):
+        """Save the labels as a delta from the previous slice, or as a checkpoint"""
+        self._checkpoint_next_delta(slice_num)
+        delta = self._delta_from_previous_slice(slice_num, labels)
+        if delta is None:
+            self._save_labels_file(slice_num, parameters.label_filename_v2,
+                                   Labels._to_labels2d(labels.labels1d.tolist(), labels.label_nums))
+        else:
+            self._save_labels_file(slice_num, parameters.label_delta_filename, delta)
+        self._cache_saved_labels(slice_num, labels)
+
+    def _save_labels_file(self, slice_num: int, filename: str, data):
+        """Save the checkpoint or delta, and remove the file of the other type for the same slice"""
+        data_bytes = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        with open(self._path_labels / (filename % slice_num), 'wb') as f:
+            f.write(data_bytes)
+        other = parameters.label_delta_filename if filename == parameters.label_filename_v2 \
+            else parameters.label_filename_v2
+        try:
+            os.remove(self._path_labels / (other % slice_num))
+        except FileNotFoundError:
+            pass
+        self.manifest[slice_num] = self._file_entry(filename % slice_num, zlib.crc32(data_bytes))
+        self._append_manifest(slice_num)
+
+    def _load_labels_file(self, slice_num: int, filename: str):
+        """Load a checkpoint or delta, and check it with the size/checksum in the manifest"""
+        with open(self._path_labels / (filename % slice_num), 'rb') as f:
+            data_bytes = f.read()
+            stat = os.fstat(f.fileno())
+        entry = self.manifest.get(slice_num)
+        if entry is not None and entry["file"] == filename % slice_num \
+                and self._entry_matches(entry, stat.st_size, stat.st_mtime_ns) \
+                and entry["crc32"] != zlib.crc32(data_bytes):
+            raise IOError(f"The label file {filename % slice_num} was corrupted")
+        try:
+            return pickle.loads(data_bytes)
+        except (pickle.UnpicklingError, EOFError, ValueError, AttributeError) as e:
+            raise IOError(f"The label file {filename % slice_num} was corrupted") from e
+
+    def _cache_saved_labels(self, slice_num: int, labels: FlatLabels):
+        """Keep the labels at the last stored slices, which are the bases of the next deltas"""
+        self._saved_labels[slice_num] = labels
+        self._saved_labels.move_to_end(slice_num)
+        while len(self._saved_labels) > 2:
+            self._saved_labels.popitem(last=False)
+
+    def _checkpoint_next_delta(self, slice_num: int):
+        """A delta at slice_num + 1 is based on the labels at slice_num, so save it as a checkpoint before
+        the labels at slice_num are overwritten"""
+        if (self._path_labels / (parameters.label_delta_filename % (slice_num + 1))).exists():
+            labels_next = self._read_labels_v2(slice_num + 1)
+            self._save_labels_file(slice_num + 1, parameters.label_filename_v2,
+                                   Labels._to_labels2d(labels_next.labels1d.tolist(), labels_next.label_nums))
+
+    def _delta_from_previous_slice(self, slice_num: int, labels: FlatLabels) -> Optional[dict]:
+        """Get the mapping of the labels in the previous slices and the labels in the last slice.
+        Return None when a checkpoint should be saved"""
+        if slice_num == 1 or slice_num % parameters.pars.checkpoint_interval_r1 == 0:
+            return None
+        labels_pre = self._read_labels_v2(slice_num - 1)
+        if labels_pre is None or labels_pre.label_nums != labels.label_nums[:-1]:
+            return None
+        labels_old = labels_pre.labels1d
+        labels_new = labels.labels1d[:len(labels_old)]
+        modified = labels_old != labels_new
+        pairs = np.unique(np.stack((labels_old[modified], labels_new[modified])), axis=1)
+        if len(np.unique(pairs[0])) != pairs.shape[1] or np.isin(pairs[0], labels_old[~modified]).any():
+            return None
+        return {"mapping": dict(zip(pairs[0].tolist(), pairs[1].tolist())),
+                "labels": labels.labels1d[len(labels_old):].tolist()}
 
-    @staticmethod
-    def append_seg(seg_img_cache: OrderedDict, seg: ndarray, z: int):
-        seg_img_cache[z] = seg
-        if len(seg_img_cache) > parameters.pars.max_draw_layers_r1 // 2:
-            print(f"pop {seg_img_cache.popitem(last=False)[0]}")
-            print(f"len: {len(seg_img_cache)}")
+    def save_seg_img(self, z: int, seg: ndarray):
+        store = self.seg_store
+        if store is None:
+            store = self._create_seg_store(seg.shape, z)
+        elif store.shape[0] < z:
+            store.resize((z, *store.shape[1:]))
+        store[z - 1] = seg
 
-    def read_state(self, slice_num: int, latest_slice: int, seg_img_cache: OrderedDict) -> Tuple[Labels, ndarray]:
+    @property
+    def seg_store(self) -> Optional[zarr.Array]:
+        """The zarr array storing the 2D segmentation results. None if no result was saved"""
+        if self._seg_store is None:
+            path_store = self._path_seg / parameters.seg_store_v2
+            if path_store.exists():
+                self._seg_store = zarr.open_array(str(path_store), mode="r+")
+            elif self.get_seg_files_v1():
+                self.convert_seg_v1_to_v2()
+        return self._seg_store
+
+    def _create_seg_store(self, shape_2d: Tuple[int, int], slice_num: int) -> zarr.Array:
+        self._seg_store = zarr.create_array(
+            str(self._path_seg / parameters.seg_store_v2), shape=(slice_num, *shape_2d), chunks=(1, *shape_2d),
+            dtype=np.uint32, fill_value=0, overwrite=True,
+            compressors=zarr.codecs.BloscCodec(cname="zstd", clevel=3, shuffle="bitshuffle"))
+        return self._seg_store
+
+    def get_seg_files_v1(self) -> Dict[int, Path]:
+        if not self._path_seg.exists():
+            return {}
+        regex = re.compile(parameters.re_seg_filename_v1)
+        return {int(m.group(1)): self._path_seg / fn for fn in os.listdir(self._path_seg) if (m := regex.fullmatch(fn))}
+
+    def convert_seg_v1_to_v2(self):
+        """Copy the segmentation results in the .npz files into the zarr array"""
+        files = self.get_seg_files_v1()
+        print(f"Converting {len(files)} segmentation files (.npz) into {parameters.seg_store_v2}... Please wait")
+        slice_nums = sorted(files)
+        with ThreadPoolExecutor() as executor:
+            segs = executor.map(lambda z: np.load(str(files[z]))["segmentation"], slice_nums)
+            for z, seg in zip(slice_nums, segs):
+                if self._seg_store is None:
+                    self._create_seg_store(seg.shape, slice_nums[-1])
+                self._seg_store[z - 1] = seg
+
+    def read_state(self, slice_num: int, latest_slice: int, seg_img_cache: SliceCache) \
+            -> Tuple[Union[FlatLabels, Labels], ndarray]:
         self.del_label_files(slice_num, latest_slice)
         label = self.read_labels(slice_num)
         seg_img = self.read_seg_img(seg_img_cache, slice_num)
         return label, seg_img
 
-    def read_labels(self, slice_num: int) -> Optional[Union[List[List[int]], Labels]]:
+    def read_labels(self, slice_num: int) -> Optional[Union[FlatLabels, Labels]]:
         """Load a state of the label"""
         if slice_num <= 0:
             return None
-        try:
-            labels = self.load_labels_v2(slice_num)
-        except FileNotFoundError:
-            labels = self.load_labels_v1(slice_num)
-            self.transform_v1_to_v2(slice_num)
+        record = self.writer.pending(slice_num)
+        if record is not None:
+            return record.labels
+        with self._io_lock:
+            try:
+                labels = self._read_labels_v2(slice_num)
+            except FileNotFoundError:
+                self.rebuild_manifest(self.manifest)
+                labels = self._read_labels_v2(slice_num)
+            if labels is None:
+                labels = self.load_labels_v1(slice_num)
+                self.transform_v1_to_v2(slice_num)
+        return labels
+
+    def _read_labels_v2(self, slice_num: int) -> Optional[FlatLabels]:
+        """Reconstruct the labels at the slice from the nearest checkpoint and the following deltas"""
+        if slice_num in self._saved_labels:
+            return self._saved_labels[slice_num]
+        deltas = []
+        checkpoint = slice_num
+        while self.manifest.get(checkpoint, {}).get("file") != parameters.label_filename_v2 % checkpoint:
+            if checkpoint <= 1 or \
+                    self.manifest.get(checkpoint, {}).get("file") != parameters.label_delta_filename % checkpoint:
+                return None
+            deltas.append(checkpoint)
+            checkpoint -= 1
+        labels1d, label_nums = flatten_2d_list(self.load_labels_v2(checkpoint))
+        labels1d = np.asarray(labels1d, dtype=np.int64)
+        for s in reversed(deltas):
+            delta = self.load_labels_delta(s)
+            labels1d = np.concatenate((map_labels(labels1d, delta["mapping"]),
+                                       np.asarray(delta["labels"], dtype=np.int64)))
+            label_nums.append(len(delta["labels"]))
+        labels = FlatLabels(labels1d, label_nums)
+        self._cache_saved_labels(slice_num, labels)
         return labels
 
     def load_labels_v1(self, slice_num: int) -> Labels:
@@ -331,26 +1024,53 @@ class Archive:
             return pickle.load(f)
 
     def load_labels_v2(self, slice_num: int) -> List[List[int]]:
-        with open(self._path_labels / (parameters.label_filename_v2 % slice_num), 'rb') as f:
-            return pickle.load(f)
+        return self._load_labels_file(slice_num, parameters.label_filename_v2)
+
+    def load_labels_delta(self, slice_num: int) -> dict:
+        return self._load_labels_file(slice_num, parameters.label_delta_filename)
 
     def transform_v1_to_v2(self, slice_num: int):
         for i in range(1, slice_num + 1):
-            with open(self._path_labels / (parameters.label_filename_v2 % i), 'wb') as f:
-                pickle.dump(self.load_labels_v1(i)._labels, f, pickle.HIGHEST_PROTOCOL)
+            self._save_labels_file(i, parameters.label_filename_v2, self.load_labels_v1(i)._labels)
 
     def del_label_files(self, current_slice_num: int, latest_slice_num: int):
-        for s in range(current_slice_num + 1, latest_slice_num + 1):
-            try:
-                os.remove(self._path_labels / (parameters.label_filename_v2 % s))
-            except FileNotFoundError:
-                pass
-
-    def read_seg_img(self, seg_img_cache: OrderedDict, layer_idx: int) -> Optional[ndarray]:
+        self.flush()
+        with self._io_lock:
+            for s in [s for s in self.manifest if current_slice_num < s <= latest_slice_num]:
+                self._saved_labels.pop(s, None)
+                try:
+                    os.remove(self._path_labels / self.manifest.pop(s)["file"])
+                except FileNotFoundError:
+                    pass
+            self._write_manifest()
+
+    def read_seg_img(self, seg_img_cache: SliceCache, layer_idx: int) -> Optional[ndarray]:
         """Load a 2D segmentation result"""
         if layer_idx <= 0:
             return None
-        if layer_idx not in seg_img_cache:
-            seg = np.load(str(self._path_seg / ('segmentation_slice%04i.npz' % layer_idx)))["segmentation"]
-            self.append_seg(seg_img_cache, seg, layer_idx)
-        return seg_img_cache[layer_idx]
+        return seg_img_cache.get(layer_idx)
+
+    def load_seg_img(self, layer_idx: int) -> ndarray:
+        """Load a 2D segmentation result from the disk (used by the cache)"""
+        record = self.writer.pending(layer_idx)
+        if record is not None:
+            return record.seg_img
+        with self._io_lock:
+            store = self.seg_store
+            if store is None or not 1 <= layer_idx <= store.shape[0]:
+                raise FileNotFoundError(f"The segmentation of slice {layer_idx} was not archived")
+            return store[layer_idx - 1]
+
+    def load_seg_imgs(self, layer_idxes: List[int]) -> List[ndarray]:
+        """Load several 2D segmentation results by reading the range of slices (the chunks are read in parallel)"""
+        records = {z: self.writer.pending(z) for z in layer_idxes}
+        layers_stored = [z for z, record in records.items() if record is None]
+        if not layers_stored:
+            return [records[z].seg_img for z in layer_idxes]
+        start, stop = min(layers_stored), max(layers_stored)
+        with self._io_lock:
+            store = self.seg_store
+            if store is None or start < 1 or stop > store.shape[0]:
+                raise FileNotFoundError(f"The segmentation of slices {start}-{stop} were not archived")
+            segs = store[start - 1:stop]
+        return [segs[z - start] if records[z] is None else records[z].seg_img for z in layer_idxes]
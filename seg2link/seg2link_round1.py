@@ -2,8 +2,9 @@ from __future__ import annotations
 
 import copy
 import datetime
+import time
 import webbrowser
-from collections import deque, OrderedDict, namedtuple
+from collections import deque, namedtuple
 from pathlib import Path
 from typing import Tuple, Optional, List, Union, Set
 
@@ -18,10 +19,11 @@ from skimage.segmentation import relabel_sequential
 
 from seg2link.cache_bbox import NoLabelError
 from seg2link import parameters
-from seg2link.seg2dlink_core import Labels, Segmentation, Archive
-from seg2link.misc import print_information, TinyCells
+from seg2link.seg2dlink_core import Labels, Segmentation, Archive, FlatLabels, LabelsSnapshot
+from seg2link.misc import print_information
 from seg2link._tests_r1 import test_merge_r1, test_delete_r1, test_divide_r1, test_link_r1
 from seg2link.single_cell_division import separate_one_label_r1, NoDivisionError
+from seg2link.slice_cache import SliceCache, ImageSlices
 from seg2link.widgets_round1 import WidgetsR1
 
 if parameters.DEBUG:
@@ -43,18 +45,22 @@ class Seg2LinkR1:
 
     def __init__(self, raw: ndarray, cell_region: ndarray, mask: Optional[ndarray], enable_mask: bool,
                  layer_num: int, path_save: Path, ratio_overlap: float, ratio_mask: float,
-                 target_slice: int):
+                 target_slice: int, raw_levels: Optional[List[ndarray]] = None):
         self.current_slice = 0
         self.layer_num = layer_num
-        self.seg_img_cache = OrderedDict()
         self.label_list: Set[int] = set()
         self.labels_divided: List[int] = []
+        self.next_slice_latency: List[float] = []
         self.cache = CacheState(self)
         self.archive = Archive(self, path_save)
         self.archive.make_folders()
+        self.seg_img_cache = SliceCache(self.archive.load_seg_img, parameters.pars.cache_seg_mb_r1 * 2 ** 20,
+                                        batch_loader=self.archive.load_seg_imgs)
         self.path_export = path_save
         self.seg = Segmentation(cell_region, enable_mask, mask, ratio_mask)
-        self.vis = VisualizePartial(self, raw, cell_region, mask)
+        self.vis = VisualizePartial(self, raw, cell_region, mask, raw_levels)
+        QApplication.instance().aboutToQuit.connect(self.archive.flush)
+        QApplication.instance().aboutToQuit.connect(self.seg.prefetch.close)
         self.labels = Labels(self, ratio_overlap)
         self.keys_binding()
         self.widget_binding()
@@ -68,16 +74,23 @@ class Seg2LinkR1:
         self.vis.update_max_actions_labelslist()
 
     def _set_seg2d_and_slice(self, current_seg: ndarray):
-        self.seg.current_seg = current_seg.copy()
+        # The segmentation is always replaced instead of modified in place, so it is shared with the cached states
+        self.seg.current_seg = current_seg
         self.current_slice = self.labels.emseg1.current_slice
 
-    def _set_labels(self, labels: Union[List[List[int]], Labels]):
-        """Used for setting two types of possible stored labels: list or Labels object"""
+    def _set_labels(self, labels: Union[List[List[int]], FlatLabels, LabelsSnapshot, Labels]):
+        """Used for setting the possible stored labels: list, flat labels, cached snapshot or Labels object"""
         if isinstance(labels, Labels):
             self.labels = copy.deepcopy(labels)
+        elif isinstance(labels, LabelsSnapshot):
+            self.labels.set_snapshot(labels)
+            self.labels.emseg1.current_slice = self.labels.slice_num
+        elif isinstance(labels, FlatLabels):
+            self.labels.set_flat(*labels)
+            self.labels.emseg1.current_slice = self.labels.slice_num
         else:
-            self.labels._labels = copy.deepcopy(labels)
-            self.labels.emseg1.current_slice = len(labels)
+            self.labels._labels = labels
+            self.labels.emseg1.current_slice = self.labels.slice_num
 
     def retrieve_or_restart(self, target_slice: int):
         history = self.archive.retrieve_history(target_slice, self.seg_img_cache)
@@ -129,7 +142,7 @@ class Seg2LinkR1:
         current_seg, self.labels_divided = separate_one_label_r1(
             modified_label[..., z], selected_label, self.labels.flatten()[0])
         _labels = np.unique(current_seg)
-        self.labels._labels[-1] = _labels[_labels != 0].tolist()
+        self.labels.set_last_labels(_labels[_labels != 0])
         self.seg.current_seg = relabel_sequential(current_seg)[0]
 
     def save_and_refresh(self, cache_action: Optional[str] = None):
@@ -148,12 +161,16 @@ class Seg2LinkR1:
         def _next_slice(viewer_seg):
             """To the next slice"""
             self.vis.widgets.show_state_info(f"Segmenting and linking... Please wait")
+            t0 = time.perf_counter()
             is_last_slice = self.next_slice()
             if is_last_slice:
                 self.vis.widgets.show_state_info(f"This is the last slice!!!")
                 return
             self.save_and_refresh(f"Next slice ({self.current_slice})")
-            self.vis.widgets.show_state_info(f"Segmenting and linking were done")
+            self.next_slice_latency.append(time.perf_counter() - t0)
+            self.vis.widgets.show_state_info(
+                f"Segmenting and linking were done in {self.next_slice_latency[-1]:.2f} s "
+                f"(mean: {np.mean(self.next_slice_latency):.2f} s)")
 
         @viewer_seg.bind_key(parameters.pars.key_separate)
         @print_information("Divide a label")
@@ -308,65 +325,88 @@ class Seg2LinkR1:
                 filter=".npy"
             )
             if path:
-                self.vis.widgets.show_state_info("Generating segmentation... Please wait")
-                seg_array = self.labels.to_multiple_labels(slice(0, self.current_slice))
-                self.vis.widgets.show_state_info("Sorting labels... Please wait")
-                sorted_labels = self.sort_remove_tiny(seg_array)
-                self.vis.widgets.show_state_info("Save segmentation as npy... Please wait")
-                np.save(path, sorted_labels)
+                self.export_sorted(path)
                 self.vis.widgets.show_state_info("Segmentation was exported")
             else:
                 self.vis.widgets.show_state_info("Warning: Folder doesn't exist!")
 
-    @staticmethod
-    def sort_remove_tiny(seg_array):
-        tc = TinyCells()
-        tc.sort_by_areas(seg_array)
-        if parameters.pars.dtype_r2 == np.uint16 and seg_array.dtype == np.uint32:
-            sorted_labels = tc.remove_and_relabel(seg_array, parameters.pars.upper_limit_export_r1).astype(np.uint16)
+    def export_sorted(self, path: str):
+        """Save the segmentation slice by slice, with the cells sorted by areas and the tiny cells removed"""
+        if parameters.pars.dtype_r2 == np.uint16:
+            self.labels.export_sorted(path, np.uint16, parameters.pars.upper_limit_export_r1,
+                                      show_info=self.vis.widgets.show_state_info)
         elif parameters.pars.dtype_r2 == np.uint32:
-            sorted_labels = tc.remove_and_relabel(seg_array)
+            self.labels.export_sorted(path, np.uint32, show_info=self.vis.widgets.show_state_info)
         else:
             raise ValueError("config.pars.dtype_r2 should be np.uint32 or np.uint16")
-        return sorted_labels
 
 
 class VisualizeBase:
     """Visualize the segmentation results"""
 
-    def __init__(self, raw: ndarray, cell_region: ndarray, cell_mask: ndarray):
-        self.raw = raw
-        self.cell_region = cell_region
-        self.cell_mask = cell_mask
+    def __init__(self, raw: ndarray, cell_region: ndarray, cell_mask: ndarray,
+                 raw_levels: Optional[List[ndarray]] = None):
+        max_bytes = parameters.pars.cache_images_mb * 2 ** 20
+        raw_levels = [] if raw_levels is None else raw_levels
+        self.raw = ImageSlices(raw, max_bytes, levels=raw_levels)
+        self.cell_region = None if cell_region is None else \
+            ImageSlices(cell_region, max_bytes, strided_levels=len(raw_levels))
+        self.cell_mask = None if cell_mask is None else \
+            ImageSlices(cell_mask, max_bytes, strided_levels=len(raw_levels))
         self.scale = parameters.pars.scale_xyz
+        self.window = slice(0, 0)
         self.viewer = self.initialize_viewer()
+        self.viewer.dims.events.current_step.connect(self.prefetch_displayed)
 
     def initialize_viewer(self):
-        """Initialize the napari viewer"""
+        """Initialize the napari viewer. The images are multiscale layers if their downsampled levels were given,
+        while the segmentation is always at full resolution"""
         viewer = napari.Viewer()
         QApplication.processEvents()
 
         putative_data32bit = np.zeros((*self.raw.shape[:2], 2), dtype=np.uint32)
-        putative_data = np.zeros((*self.raw.shape[:2], 2), dtype=np.uint8)
         if self.cell_mask is not None:
-            viewer.add_labels(putative_data, name='mask_cells', color={0: "k", 1: "w"}, visible=False, scale=self.scale)
+            viewer.add_labels(self.cell_mask.placeholder(np.uint8), name='mask_cells', color={0: "k", 1: "w"},
+                              visible=False, scale=self.scale, multiscale=self.cell_mask.multiscale)
         viewer.add_image(
-            putative_data, name='raw_image', contrast_limits=[0, 2 ** parameters.pars.raw_bit - 1], scale=self.scale
+            self.raw.placeholder(np.uint8), name='raw_image', contrast_limits=[0, 2 ** parameters.pars.raw_bit - 1],
+            scale=self.scale, multiscale=self.raw.multiscale
         )
         if self.cell_region is not None:
-            viewer.add_labels(putative_data, name='cell_region', color={0: "k", 1: "w"}, opacity=0.4, scale=self.scale)
+            viewer.add_labels(self.cell_region.placeholder(np.uint8), name='cell_region', color={0: "k", 1: "w"},
+                              opacity=0.4, scale=self.scale, multiscale=self.cell_region.multiscale)
         viewer.add_labels(putative_data32bit, name='segmentation', num_colors=100, scale=self.scale)
         viewer.dims.set_axis_label(axis=2, label="Slice (0-0)")
         viewer.dims.order = (2, 0, 1)
         viewer.layers["segmentation"].mode = "pick"
         return viewer
 
+    @property
+    def images(self) -> List[ImageSlices]:
+        return [images for images in (self.cell_mask, self.raw, self.cell_region) if images is not None]
+
+    def show_images(self, window: slice, current: Optional[int] = None):
+        """Show the images in the window (slices), read from the caches of decoded slices"""
+        self.window = window
+        if self.cell_mask is not None:
+            self.viewer.layers['mask_cells'].data = self.cell_mask.window(window, current)
+        self.viewer.layers['raw_image'].data = self.raw.window(window, current)
+        if self.cell_region is not None:
+            self.viewer.layers['cell_region'].data = self.cell_region.window(window, current)
+
+    def prefetch_displayed(self, event=None):
+        """Decode in background the slices around the displayed one, when moving through the slices"""
+        current = self.window.start + self.viewer.dims.current_step[2]
+        for images in self.images:
+            images.prefetch(self.window, current)
+
 
 class VisualizePartial(VisualizeBase):
     """Visualize the segmentation results"""
 
-    def __init__(self, emseg1: Seg2LinkR1, raw: ndarray, cell_region: ndarray, cell_mask: Optional[ndarray]):
-        super().__init__(raw, cell_region, cell_mask)
+    def __init__(self, emseg1: Seg2LinkR1, raw: ndarray, cell_region: ndarray, cell_mask: Optional[ndarray],
+                 raw_levels: Optional[List[ndarray]] = None):
+        super().__init__(raw, cell_region, cell_mask, raw_levels)
         self.emseg1 = emseg1
         self.layer_num = cell_region.shape[-1]
         self.viewer.title = "Seg2Link 1st round"
@@ -390,11 +430,7 @@ class VisualizePartial(VisualizeBase):
         slice_layers = self.get_slice(current_slice)
         labels = self.emseg1.labels.to_multiple_labels(slice_layers)
 
-        if self.cell_mask is not None:
-            self.viewer.layers['mask_cells'].data = self.cell_mask[..., slice_layers]
-        self.viewer.layers['raw_image'].data = self.raw[..., slice_layers]
-        if self.cell_region is not None:
-            self.viewer.layers['cell_region'].data = self.cell_region[..., slice_layers]
+        self.show_images(slice_layers, current_slice - 1)
         self.viewer.layers['segmentation'].data = labels
 
         current_layer_relative = current_slice - slice_layers.start - 1
@@ -449,8 +485,8 @@ class CacheState:
         self.emseg1 = emseg1
 
     def cache_state(self, action: str):
-        """Cache the current state"""
-        state = StateR1(copy.deepcopy(self.emseg1.labels._labels), self.emseg1.seg.current_seg.copy(), action)
+        """Cache the current state. The unchanged slices and the segmentation are shared with the other states"""
+        state = StateR1(self.emseg1.labels.snapshot(), self.emseg1.seg.current_seg, action)
         self.cache.append(state)
 
     def load_cache(self, method: str) -> Tuple[Labels, ndarray, str]:
@@ -466,5 +502,5 @@ class CacheState:
     def cached_actions(self) -> List[str]:
         history = [hist.action + "\n" for hist in self.cache.history]
         future = [fut.action + "\n" for fut in self.cache.future][::-1]
-        history_str_list = history + [f"***Head ({len(self.cache.history[-1].labels)})***\n"] + future
+        history_str_list = history + [f"***Head ({len(self.cache.history[-1].labels.label_nums)})***\n"] + future
         return history_str_list
@@ -13,7 +13,7 @@ from seg2link.seg2dlink_core import relabel_min_change
 from seg2link._tests_r2 import test_merge_r2, test_delete_r2, test_divide_r2
 from seg2link import parameters
 from seg2link.seg2link_round1 import Cache, VisualizeBase
-from seg2link.misc import print_information, replace, get_unused_labels_quick
+from seg2link.misc import print_information, replace, get_unused_labels_quick, to_volume_layout
 from seg2link.message_windows_round2 import message_delete_labels
 from seg2link.cache_bbox import NoLabelError, CacheBbox, merge_bbox, Bbox
 from seg2link.widgets_round2 import WidgetsR2
@@ -36,14 +36,15 @@ class StateR2(NamedTuple):
 class Seg2LinkR2:
     """Segment the cells in 3D EM images"""
     # TODO: The action insert now is not supported by undo/redo and this will be fixed in next version.
-    def __init__(self, raw: ndarray, cell_region: ndarray, mask: ndarray, labels: ndarray, labels_npy: Path):
+    def __init__(self, raw: ndarray, cell_region: ndarray, mask: ndarray, labels: ndarray, labels_npy: Path,
+                 raw_levels: Optional[List[ndarray]] = None):
         self.labels = labels
         self.divide_list = []
         self.label_list: Set[int] = set()
         self.s = slice(0, self.labels.shape[2])
         self.divide_subregion_slice = None
         self.labels_path = labels_npy
-        self.vis = VisualizeAll(self, raw, cell_region, mask)
+        self.vis = VisualizeAll(self, raw, cell_region, mask, raw_levels)
         self.cache_bbox = CacheBbox(self)
         self.cache = CacheSubArray(self)
         self.update_info()
@@ -59,7 +60,7 @@ class Seg2LinkR2:
         self.vis.update_segmentation_r2()
 
     def reset_labels(self, labels):
-        self.labels = labels
+        self.labels = to_volume_layout(labels)
         self.divide_list.clear()
         self.label_list.clear()
         self.s = slice(0, self.labels.shape[2])
@@ -102,7 +103,7 @@ class Seg2LinkR2:
     def update_cmap(self):
         viewer_seg = self.vis.viewer.layers["segmentation"]
         viewer_seg._all_vals = low_discrepancy_image(
-            np.arange(int(max(self.cache_bbox.bbox)) + 10), viewer_seg._seed
+            np.arange(self.cache_bbox.max_label + 10), viewer_seg._seed
         )
         viewer_seg._all_vals[0] = 0
 
@@ -110,6 +111,7 @@ class Seg2LinkR2:
         self.vis.update_widgets(label_pre_division)
 
     def update(self, state: StateR2, update_cmap: bool=False, label_pre_division: Optional[int] = None):
+        self.cache_bbox.stats.update(state.bbox, state.old.array, state.new.array)
         self.labels[state.bbox] = state.new.array
         if update_cmap:
             self.update_cmap()
@@ -379,6 +381,7 @@ class Seg2LinkR2:
             if history is None:
                 return
             self.cache_bbox.bbox = history.old.bboxes.copy()
+            self.cache_bbox.stats.update(history.bbox, history.new.array, history.old.array)
             self.labels[history.bbox] = history.old.array
             self.reset_division_list()
             self._update_segmentation()
@@ -393,6 +396,7 @@ class Seg2LinkR2:
             if future is None:
                 return
             self.cache_bbox.bbox = future.new.bboxes.copy()
+            self.cache_bbox.stats.update(future.bbox, future.old.array, future.new.array)
             self.labels[future.bbox] = future.new.array
             self.reset_division_list()
             self._update_segmentation()
@@ -440,8 +444,9 @@ class Seg2LinkR2:
 class VisualizeAll(VisualizeBase):
     """Visualize the segmentation results"""
 
-    def __init__(self, emseg2: Seg2LinkR2, raw: ndarray, cell_region: ndarray, cell_mask: ndarray):
-        super().__init__(raw, cell_region, cell_mask)
+    def __init__(self, emseg2: Seg2LinkR2, raw: ndarray, cell_region: ndarray, cell_mask: ndarray,
+                 raw_levels: Optional[List[ndarray]] = None):
+        super().__init__(raw, cell_region, cell_mask, raw_levels)
         self.emseg2 = emseg2
         self.viewer.title = "Seg2link 2nd round"
         self.widgets = WidgetsR2(self)
@@ -453,11 +458,7 @@ class VisualizeAll(VisualizeBase):
 
     def show_segmentation_r2(self):
         """show the segmentation results and other images/label"""
-        if self.cell_mask is not None:
-            self.viewer.layers['mask_cells'].data = self.cell_mask[..., self.emseg2.s]
-        self.viewer.layers['raw_image'].data = self.raw[..., self.emseg2.s]
-        if self.cell_region is not None:
-            self.viewer.layers['cell_region'].data = self.cell_region[..., self.emseg2.s]
+        self.show_images(self.emseg2.s)
         self.viewer.layers['segmentation'].data = self.emseg2.labels
         QApplication.processEvents()
 
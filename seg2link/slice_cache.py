@@ -0,0 +1,226 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import Callable, Dict, Iterable, Optional, Tuple, List, Sequence, Union
+
+import dask
+import dask.array as da
+import numpy as np
+from numpy import ndarray
+
+
+class SliceCache:
+    """LRU cache of 2D slices (one array per slice) limited by the memory usage
+
+    Notes
+    -----
+    The cached slices are e.g. the segmentation results in round 1 (indexed from 1 as in the archive) or the decoded
+    slices of an image (see ImageSlices), as indexed by the loader function. A missing slice is loaded with the loader,
+    either when it is requested (a miss) or in advance by a worker thread (prefetch). Several missing slices can be
+    loaded together with the batch_loader function.
+    The least recently used slices are evicted when the total size exceeds max_bytes.
+    """
+
+    def __init__(self, loader: Callable[[int], ndarray], max_bytes: int, margin: int = 10,
+                 batch_loader: Optional[Callable[[List[int]], List[ndarray]]] = None):
+        self.loader = loader
+        self.batch_loader = batch_loader
+        self.max_bytes = max_bytes
+        self.margin = margin
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+        self._slices: "OrderedDict[int, ndarray]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = Lock()
+        self._pending: Dict[int, Tuple[object, Future]] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __contains__(self, z: int) -> bool:
+        return z in self._slices
+
+    def __len__(self) -> int:
+        return len(self._slices)
+
+    def __getitem__(self, z: int) -> ndarray:
+        return self.get(z)
+
+    def __setitem__(self, z: int, seg: ndarray):
+        self.put(z, seg)
+
+    def __repr__(self):
+        return (f"SliceCache: {len(self)} slices, {self._nbytes / 2 ** 20:.1f}/{self.max_bytes / 2 ** 20:.0f} MB, "
+                f"hits: {self.hits}, misses: {self.misses}, evictions: {self.evictions}, "
+                f"prefetched: {self.prefetched}")
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def get(self, z: int) -> ndarray:
+        """Get a slice, loading it when it is not cached"""
+        with self._lock:
+            pending = self._pending.get(z)
+        if pending is not None:
+            pending[1].result()
+        with self._lock:
+            if z in self._slices:
+                self.hits += 1
+                self._slices.move_to_end(z)
+                return self._slices[z]
+            self.misses += 1
+        seg = self.loader(z)
+        self.put(z, seg)
+        return seg
+
+    def load_many(self, zs: List[int]):
+        """Load the slices not cached yet together (counted as misses)"""
+        with self._lock:
+            pending = [self._pending[z][1] for z in zs if z in self._pending]
+        for future in pending:
+            future.result()
+        with self._lock:
+            missing = [z for z in zs if z not in self._slices]
+            self.misses += len(missing)
+        if not missing:
+            return
+        segs = self.batch_loader(missing) if self.batch_loader is not None else [self.loader(z) for z in missing]
+        for z, seg in zip(missing, segs):
+            self.put(z, seg)
+
+    def put(self, z: int, seg: ndarray):
+        """Cache a slice (new or modified). A pending prefetch of the old slice is discarded"""
+        with self._lock:
+            self._pending.pop(z, None)
+            self._put(z, seg)
+
+    def _put(self, z: int, seg: ndarray):
+        if z in self._slices:
+            self._nbytes -= self._slices.pop(z).nbytes
+        self._slices[z] = seg
+        self._nbytes += seg.nbytes
+        while self._nbytes > self.max_bytes and len(self._slices) > 1:
+            _, seg_evicted = self._slices.popitem(last=False)
+            self._nbytes -= seg_evicted.nbytes
+            self.evictions += 1
+
+    def prefetch(self, zs: Iterable[int]):
+        """Load the slices not cached yet in a worker thread"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="seg_cache")
+        with self._lock:
+            for z in zs:
+                if z in self._slices or z in self._pending:
+                    continue
+                token = object()
+                self._pending[z] = (token, self._executor.submit(self._load_async, z, token))
+
+    def _load_async(self, z: int, token: object):
+        try:
+            seg = self.loader(z)
+        except Exception:
+            seg = None
+        with self._lock:
+            pending = self._pending.get(z)
+            if pending is None or pending[0] is not token:
+                return
+            del self._pending[z]
+            if seg is not None:
+                self.prefetched += 1
+                self._put(z, seg)
+
+
+class ImageSlices:
+    """Decoded slices of a lazy image volume (H, W, Z), such as the raw images, shown in round 1 and round 2
+
+    Notes
+    -----
+    Each time the layers are refreshed, a lazy volume (dask array of TIFF readers or of a dataset in a container)
+    would decode its slices again. Here the decoded slices are kept in a SliceCache (indexed from 0), which is read
+    by the lazy arrays given to napari (see window). The slices around the displayed one are decoded in background
+    (see prefetch), so that when the window slides, only the slices entering it have to be decoded.
+    A volume already in memory (numpy array) is shown directly.
+    For multiscale layers, the downsampled levels (H / 2 ** i, W / 2 ** i, Z) are given by levels (e.g. the raw
+    images averaged by misc.load_raw_levels), or taken every 2 ** i pixels from the full resolution slices
+    (strided_levels, for the labels).
+    """
+
+    def __init__(self, volume, max_bytes: int, margin: int = 10, levels: Sequence = (), strided_levels: int = 0):
+        self.volume = volume
+        self.shape = tuple(volume.shape)
+        self.dtype = np.dtype(volume.dtype)
+        self.ndim = 3
+        self.cache = SliceCache(self.read_slice, max_bytes, margin, batch_loader=self.read_slices)
+        self._lazy = da.from_array(self, chunks=(self.shape[0], self.shape[1], 1), name=f"image-slices-{id(self)}",
+                                   lock=False, fancy=False, meta=np.empty((0, 0, 0), dtype=self.dtype))
+        full_resolution = self.volume if self.in_memory else self._lazy
+        self.levels = list(levels) + [full_resolution[::2 ** i, ::2 ** i] for i in range(1, strided_levels + 1)]
+
+    def __repr__(self):
+        return f"ImageSlices {self.shape}, {self.cache}"
+
+    @property
+    def in_memory(self) -> bool:
+        return isinstance(self.volume, np.ndarray)
+
+    @property
+    def multiscale(self) -> bool:
+        return len(self.levels) > 0
+
+    def placeholder(self, dtype: type) -> Union[ndarray, List[ndarray]]:
+        """Zero images of 2 slices with the shapes of the levels, for creating the layer"""
+        shapes = [self.shape] + [level.shape for level in self.levels]
+        images = [np.zeros((*shape[:2], 2), dtype=dtype) for shape in shapes]
+        return images if self.multiscale else images[0]
+
+    def read_slice(self, z: int) -> ndarray:
+        return np.asarray(self.volume[..., z])
+
+    def read_slices(self, zs: List[int]) -> List[ndarray]:
+        if isinstance(self.volume, da.Array):
+            return list(dask.compute(*[self.volume[..., z] for z in zs]))
+        return [self.read_slice(z) for z in zs]
+
+    def __getitem__(self, key) -> ndarray:
+        """Slices read from the cache. Used by the lazy arrays: the last index (z) is an integer or a slice"""
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        *key_yx, key_z = key + (slice(None),) * (self.ndim - len(key))
+        zs = range(self.shape[2])[key_z]
+        if isinstance(zs, int):
+            return self.cache.get(zs)[tuple(key_yx)]
+        if len(zs) == 0:
+            return np.empty(self.shape[:2] + (0,), dtype=self.dtype)[tuple(key_yx)]
+        if len(zs) > 1:
+            self.cache.load_many(list(zs))
+        return np.stack([self.cache.get(z) for z in zs], axis=-1)[tuple(key_yx)]
+
+    def window(self, s: slice, current: Optional[int] = None):
+        """Lazy array of the slices in s (H, W, Z) read from the cache, or the list of its levels if multiscale.
+        The slices in and around s are decoded in background, starting from the current one"""
+        if self.in_memory:
+            images = self.volume[..., s]
+        else:
+            self.prefetch(s, current)
+            images = self._lazy[..., s]
+        return [images] + [level[..., s] for level in self.levels] if self.multiscale else images
+
+    def prefetch(self, s: slice, current: Optional[int] = None):
+        """Decode in background the slices in s and in the margins around it, the nearest to the current slice
+        first, as many as the cache can hold"""
+        start, stop, _ = s.indices(self.shape[2])
+        if self.in_memory or start >= stop:
+            return
+        current = start if current is None else min(max(current, start), stop - 1)
+        zs = range(max(start - self.cache.margin, 0), min(stop + self.cache.margin, self.shape[2]))
+        slice_bytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+        num = max(self.cache.max_bytes // slice_bytes, 1)
+        self.cache.prefetch(sorted(zs, key=lambda z: abs(z - current))[:num])
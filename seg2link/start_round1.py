@@ -1,14 +1,13 @@
 from pathlib import Path
-from typing import Callable, List
+from typing import List, Tuple
 
-import numpy as np
-from magicgui import magicgui
-from numpy import ndarray
+from magicgui import magicgui, use_app
 
 from seg2link import parameters
 from seg2link.seg2dlink_core import Archive
 from seg2link.seg2link_round1 import Seg2LinkR1
-from seg2link.misc import load_image_pil, load_image_lazy, load_array_lazy, fill_holes_scipy
+from seg2link.misc import load_volume_lazy, load_raw_levels, load_cell_region, load_mask_region, is_container, \
+    open_dataset, HDF5_SUFFIXES
 from seg2link.userconfig import UserConfig, get_config_dir
 
 try:
@@ -20,44 +19,19 @@ CURRENT_DIR = Path.home()
 USR_CONFIG = UserConfig()
 
 
-def cache_images_lazy(func) -> Callable:
-    def wrapper(*args, file_cached: Path, **kwargs) -> ndarray:
-        if file_cached is None:
-            array = func(*args, **kwargs)
-        elif file_cached.exists():
-            array = load_array_lazy(file_cached)
-        else:
-            print("Caching data... Please wait")
-            array = func(*args, **kwargs)
-            np.save(file_cached, array)
-            array = load_array_lazy(file_cached)
-        print("Image shape:", array.shape)
-        return array
-
-    return wrapper
-
-
-@cache_images_lazy
-def load_cells(cell_value, path_cells):
-    return load_image_pil(path_cells) == cell_value
-
-
-@cache_images_lazy
-def load_mask(mask_value: int, path_mask: Path, fill_holes: bool) -> ndarray:
-    mask_images = load_image_pil(path_mask) == mask_value
-    if not mask_images.any():
-        raise ValueError("No cell region found in Mask images. Check if the value for mask regions is correct!")
-    if fill_holes:
-        return fill_holes_scipy(mask_images, filter_size=parameters.pars.mask_dilate_kernel)
-    else:
-        return mask_images
-
-
 def show_error_msg(widget_error_state, msg):
     widget_error_state.show()
     widget_error_state.value = msg
 
 
+def show_loading_info(widget_loading_info, info: str):
+    """Show the progress of loading images in the start widget"""
+    print(info)
+    widget_loading_info.show()
+    widget_loading_info.value = info
+    use_app().process_events()
+
+
 @magicgui(
     call_button="Start Round #1 - Seg2D + Link",
     layout="vertical",
@@ -67,13 +41,19 @@ def show_error_msg(widget_error_state, msg):
     mask_value={"label": "Value of the mask region", "visible": False},
     historical_info={"label": "   Historical info:", "visible": False},
     error_info={"widget_type": "TextEdit", "label": "Warnings:", "visible": False},
+    loading_info={"label": "Loading:", "enabled": False, "visible": False},
     threshold_link={"widget_type": "FloatSlider", "label": "Min_Overlap (linking)", "min": 0.05, "max": 0.95},
     threshold_mask={"widget_type": "FloatSlider", "label": "Min_Overlap (masking)", "min": 0.05, "max": 0.95,
                     "visible": False},
     retrieve_slice={"widget_type": "Slider", "max": 1, "visible": False},
-    path_cells={"label": "Open image sequences: Cell regions (*.tiff):", "mode": "d"},
-    path_raw={"label": "Open image sequences: Raw images (*.tiff):", "mode": "d"},
-    path_mask={"label": "Open image sequences: Mask images (*.tiff):", "mode": "d", "visible": False},
+    select_hdf5={"label": "Select HDF5 files (*.h5) instead of folders"},
+    path_cells={"label": "Open image sequences: Cell regions (*.tiff, or .zarr/.n5/.h5):", "mode": "d"},
+    key_cells={"label": "Dataset in the container: Cell regions", "visible": False},
+    path_raw={"label": "Open image sequences: Raw images (*.tiff, or .zarr/.n5/.h5):", "mode": "d"},
+    key_raw={"label": "Dataset in the container: Raw images", "visible": False},
+    path_mask={"label": "Open image sequences: Mask images (*.tiff, or .zarr/.n5/.h5):", "mode": "d",
+               "visible": False},
+    key_mask={"label": "Dataset in the container: Mask images", "visible": False},
     path_result={"label": "Select a folder for storing results:", "mode": "d"},
     enable_mask={"label": "Use the Mask images"},
     enable_fill_holes={"label": "Fill holes", "visible": False},
@@ -85,9 +65,13 @@ def start_r1(
         enable_mask=False,
         enable_fill_holes=False,
         enable_update_mask=False,
+        select_hdf5=False,
         path_cells=CURRENT_DIR,
+        key_cells="",
         path_raw=CURRENT_DIR,
+        key_raw="",
         path_mask=CURRENT_DIR,
+        key_mask="",
         path_result=CURRENT_DIR,
         historical_info="",
         retrieve_slice=0,
@@ -96,24 +80,26 @@ def start_r1(
         threshold_link=0.5,
         threshold_mask=0.8,
         error_info="",
+        loading_info="",
 ):
     """Run some computation."""
     if test_paths_r1():
         print("Loading cell image... Please wait")
-        cells = load_cells(cell_value, path_cells, file_cached=_npy_name(path_cells))
+        show_info = lambda info: show_loading_info(start_r1.loading_info, info)
+        cells = load_cell_region(cell_value, path_cells, key_cells, show_info=show_info)
         print("Loading raw image... Please wait")
-        images = load_image_lazy(path_raw)
+        images = load_volume_lazy(path_raw, key_raw)
+        raw_levels = load_raw_levels(images, path_raw, key_raw, show_info=show_info)
         if enable_mask:
             print("Loading mask image... Please wait")
-            if enable_update_mask:
-                delete_npy(path_mask)
-            mask_dilated = load_mask(mask_value, path_mask, enable_fill_holes, file_cached=_npy_name(path_mask))
+            mask_dilated = load_mask_region(mask_value, path_mask, enable_fill_holes, key_mask,
+                                            update_cache=enable_update_mask, show_info=show_info)
         else:
             mask_dilated = None
         layer_num = cells.shape[2]
         print("Initiating the soft... Please wait")
         Seg2LinkR1(images, cells, mask_dilated, enable_mask, layer_num, path_result, threshold_link, threshold_mask,
-                   start_r1.retrieve_slice.value)
+                   start_r1.retrieve_slice.value, raw_levels)
         print("The soft was started")
         start_r1.close()
 
@@ -124,7 +110,7 @@ def test_paths_r1() -> bool:
         show_error_msg(start_r1.error_info, msg)
         return False
     else:
-        msg = check_tiff_existence(tiff_folders_r1())
+        msg = "\n".join(filter(None, [check_tiff_existence(tiff_folders_r1()), check_datasets(datasets_r1())]))
         if msg:
             show_error_msg(start_r1.error_info, msg)
             return False
@@ -132,10 +118,6 @@ def test_paths_r1() -> bool:
         return True
 
 
-def delete_npy(path_folder):
-    _npy_name(path_folder).unlink(missing_ok=True)
-
-
 start_r1.error_info.min_height = 70
 
 
@@ -153,13 +135,36 @@ def check_existence_path(paths_list: List[Path]) -> str:
 def check_tiff_existence(paths_list: List[Path]) -> str:
     msg = []
     for path in paths_list:
-        if not path.name.endswith(".npy") and not list(path.glob("*.tif*")):
+        if not path.name.endswith(".npy") and not is_container(path) and not list(path.glob("*.tif*")):
             msg.append(f'Warning: Folder "{path.name}" includes no TIFF files')
     return "\n".join(msg)
 
 
-def _npy_name(path_cells: Path, addi_str: str = "") -> Path:
-    return Path(*path_cells.parts[:-1], path_cells.parts[-1] + addi_str + ".npy")
+def check_datasets(paths_keys: List[Tuple[Path, str]]) -> str:
+    """Check the datasets in the Zarr/N5/HDF5 containers"""
+    msg = []
+    for path, key in paths_keys:
+        if is_container(path) and path.exists():
+            try:
+                open_dataset(path, key)
+            except (ValueError, OSError) as e:
+                msg.append(f"Warning: {e}")
+    return "\n".join(msg)
+
+
+def show_dataset_keys(mgui, path_key_widgets: List[Tuple[str, str, bool]]):
+    """Show the dataset key widgets (path widget name, key widget name, used) of the selected containers"""
+    for path_name, key_name, used in path_key_widgets:
+        getattr(mgui, key_name).visible = used and is_container(getattr(mgui, path_name).value)
+
+
+def set_file_modes(mgui, path_key_widgets: List[Tuple[str, str, bool]]):
+    """Let the file dialogs of the images select a HDF5 file, or a folder (TIFF images or a Zarr/N5 container)"""
+    select_hdf5 = mgui.select_hdf5.value
+    for path_name, _, _ in path_key_widgets:
+        widget = getattr(mgui, path_name)
+        widget.mode = "r" if select_hdf5 else "d"
+        widget.filter = " ".join("*" + suffix for suffix in HDF5_SUFFIXES) if select_hdf5 else None
 
 
 @start_r1.enable_mask.changed.connect
@@ -170,17 +175,11 @@ def use_mask():
     start_r1.path_mask.visible = visible
     start_r1.threshold_mask.visible = visible
     start_r1.mask_value.visible = visible
+    show_dataset_keys(start_r1, key_widgets_r1())
 
     test_paths_r1()
 
 
-def enable_update_mask():
-    start_r1.enable_update_mask.value = True
-
-
-start_r1.enable_fill_holes.changed.connect(enable_update_mask)
-
-
 @start_r1.save_para.changed.connect
 def _on_save_para_changed():
     parameters_r1 = {"use_mask": start_r1.enable_mask.value,
@@ -191,6 +190,9 @@ def _on_save_para_changed():
                        "path_raw": start_r1.path_raw.value,
                        "path_mask": start_r1.path_mask.value,
                        "path_result": start_r1.path_result.value,
+                       "key_cells": start_r1.key_cells.value,
+                       "key_raw": start_r1.key_raw.value,
+                       "key_mask": start_r1.key_mask.value,
                        "cell_value": start_r1.cell_value.value,
                        "mask_value": start_r1.mask_value.value}
     USR_CONFIG.save_ini_r1(parameters_r1, CURRENT_DIR)
@@ -204,10 +206,8 @@ def _on_load_para_changed():
     except ValueError:
         return
 
-    start_r1.enable_fill_holes.changed.disconnect()
     set_pars_r1r2(start_r1, USR_CONFIG.pars.r1r2)
     set_pars_r1(USR_CONFIG.pars.r1)
-    start_r1.enable_fill_holes.changed.connect(enable_update_mask)
 
     parameters.pars.set_from_dict(USR_CONFIG.pars.advanced)
 
@@ -217,6 +217,9 @@ def set_pars_r1r2(mgui, parameters_r1r2: dict):
     mgui.path_raw.value = parameters_r1r2["path_raw"]
     mgui.path_mask.value = parameters_r1r2["path_mask"]
     mgui.path_result.value = parameters_r1r2["path_result"]
+    mgui.key_cells.value = parameters_r1r2.get("key_cells", "")
+    mgui.key_raw.value = parameters_r1r2.get("key_raw", "")
+    mgui.key_mask.value = parameters_r1r2.get("key_mask", "")
     mgui.cell_value.value = int(parameters_r1r2["cell_value"])
     mgui.mask_value.value = int(parameters_r1r2["mask_value"])
 
@@ -248,9 +251,12 @@ def _on_path_cells_changed():
     if start_r1.path_cells.value.exists():
         global CURRENT_DIR
         CURRENT_DIR = start_r1.path_cells.value.parent
-        start_r1.path_raw.value = CURRENT_DIR
-        start_r1.path_mask.value = CURRENT_DIR
+        # The other images are usually stored in the same container
+        path_images = start_r1.path_cells.value if is_container(start_r1.path_cells.value) else CURRENT_DIR
+        start_r1.path_raw.value = path_images
+        start_r1.path_mask.value = path_images
         start_r1.path_result.value = CURRENT_DIR
+    show_dataset_keys(start_r1, key_widgets_r1())
     test_paths_r1()
 
 
@@ -266,6 +272,17 @@ def folders_r1() -> List[Path]:
                 start_r1.path_result.value]
 
 
+def key_widgets_r1() -> List[Tuple[str, str, bool]]:
+    return [("path_cells", "key_cells", True),
+            ("path_raw", "key_raw", True),
+            ("path_mask", "key_mask", start_r1.enable_mask.value)]
+
+
+def datasets_r1() -> List[Tuple[Path, str]]:
+    return [(getattr(start_r1, path_name).value, getattr(start_r1, key_name).value)
+            for path_name, key_name, used in key_widgets_r1() if used]
+
+
 def tiff_folders_r1() -> List[Path]:
     if start_r1.enable_mask.value:
         return [start_r1.path_cells.value,
@@ -278,11 +295,25 @@ def tiff_folders_r1() -> List[Path]:
 
 @start_r1.path_raw.changed.connect
 def _on_path_raw_changed():
+    show_dataset_keys(start_r1, key_widgets_r1())
     test_paths_r1()
 
 
+@start_r1.select_hdf5.changed.connect
+def _on_select_hdf5_changed():
+    set_file_modes(start_r1, key_widgets_r1())
+
+
 @start_r1.path_mask.changed.connect
 def _on_path_mask_changed():
+    show_dataset_keys(start_r1, key_widgets_r1())
+    test_paths_r1()
+
+
+@start_r1.key_cells.changed.connect
+@start_r1.key_raw.changed.connect
+@start_r1.key_mask.changed.connect
+def _on_key_changed():
     test_paths_r1()
 
 
@@ -1,14 +1,15 @@
 import warnings
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 from magicgui import magicgui
 
-from seg2link.misc import load_image_pil, load_image_lazy
+from seg2link.misc import load_image_stack, load_volume_lazy, load_raw_levels, load_cell_region, load_mask_region, \
+    to_volume_layout, is_container
 from seg2link import parameters
-from seg2link.start_round1 import load_cells, load_mask, _npy_name, check_existence_path, show_error_msg, set_pars_r1r2, \
-    check_tiff_existence
+from seg2link.start_round1 import check_existence_path, show_error_msg, set_pars_r1r2, \
+    check_tiff_existence, show_loading_info, check_datasets, show_dataset_keys, set_file_modes
 from seg2link.seg2link_round2 import Seg2LinkR2
 from seg2link.userconfig import UserConfig, get_config_dir, get_last_current_base_dir
 
@@ -33,14 +34,22 @@ USR_CONFIG = UserConfig()
     cell_value={"label": "Value of the cell region"},
     mask_value={"label": "Value of the mask region", "visible": False},
     error_info={"widget_type": "TextEdit", "label": "Warnings:", "visible": False},
-    path_cells={"label": "Open image sequence: Cell regions (*.tiff):", "mode": "d"},
-    path_raw={"label": "Open image sequence: Raw images (*.tiff):", "mode": "d"},
-    path_mask={"label": "Open image sequence: Mask images (*.tiff):", "mode": "d", "visible": False},
+    loading_info={"label": "Loading:", "enabled": False, "visible": False},
+    select_hdf5={"label": "Select HDF5 files (*.h5) instead of folders"},
+    path_cells={"label": "Open image sequence: Cell regions (*.tiff, or .zarr/.n5/.h5):", "mode": "d"},
+    key_cells={"label": "Dataset in the container: Cell regions", "visible": False},
+    path_raw={"label": "Open image sequence: Raw images (*.tiff, or .zarr/.n5/.h5):", "mode": "d"},
+    key_raw={"label": "Dataset in the container: Raw images", "visible": False},
+    path_mask={"label": "Open image sequence: Mask images (*.tiff, or .zarr/.n5/.h5):", "mode": "d",
+               "visible": False},
+    key_mask={"label": "Dataset in the container: Mask images", "visible": False},
     path_result={"label": "Open file: segmentation (*.npy):", "mode": "r", "filter": '*.npy'},
-    seg_dir={"label": "Open image sequence: segmentation (*.tiff): ", "mode": "d", "visible": False},
+    seg_dir={"label": "Open image sequence: segmentation (*.tiff, or .zarr/.n5/.h5): ", "mode": "d",
+             "visible": False},
+    key_seg={"label": "Dataset in the container: segmentation", "visible": False},
     enable_mask={"label": "Use the Mask images", "visible": False},
     enable_cell={"label": "Use the Cell-region images"},
-    load_seg_dir={"label": "Use image sequence as segmentation"},
+    load_seg_dir={"label": "Use image sequence (or container) as segmentation"},
 )
 def start_r2(
         load_para,
@@ -48,23 +57,32 @@ def start_r2(
         enable_mask=False,
         enable_cell=False,
         load_seg_dir=False,
+        select_hdf5=False,
         path_cells=CURRENT_DIR,
+        key_cells="",
         path_raw=CURRENT_DIR,
+        key_raw="",
         path_mask=CURRENT_DIR,
+        key_mask="",
         path_result=CURRENT_DIR,
         seg_dir=CURRENT_DIR,
+        key_seg="",
         cell_value=1,
         mask_value=1,
         error_info="",
+        loading_info="",
 ):
     """Run some computation."""
     if test_paths_r2():
-        cells = load_cells(cell_value, path_cells, file_cached=_npy_name(path_cells)) if enable_cell else None
-        images = load_image_lazy(path_raw)
-        mask_dilated = load_mask(mask_value, path_mask, file_cached=_npy_name(path_mask)) if enable_mask else None
+        show_info = lambda info: show_loading_info(start_r2.loading_info, info)
+        cells = load_cell_region(cell_value, path_cells, key_cells, show_info=show_info) if enable_cell else None
+        images = load_volume_lazy(path_raw, key_raw)
+        raw_levels = load_raw_levels(images, path_raw, key_raw, show_info=show_info)
+        mask_dilated = load_mask_region(mask_value, path_mask, False, key_mask, show_info=show_info) \
+            if enable_mask else None
         path_labels = seg_dir if load_seg_dir else path_result
-        segmentation, path_npy = load_segmentation(path_labels)
-        Seg2LinkR2(images, cells, mask_dilated, segmentation, path_npy)
+        segmentation, path_npy = load_segmentation(path_labels, key_seg)
+        Seg2LinkR2(images, cells, mask_dilated, segmentation, path_npy, raw_levels)
         start_r2.close()
         return None
 
@@ -78,8 +96,9 @@ def test_paths_r2() -> bool:
         show_error_msg(start_r2.error_info, msg)
         return False
 
-    msg = "\n".join([check_tiff_existence(tiff_folders_r2()), check_seg_file()])
-    if msg == '\n':
+    msg = "\n".join(filter(None, [check_tiff_existence(tiff_folders_r2()), check_datasets(datasets_r2()),
+                                  check_seg_file()]))
+    if not msg:
         show_error_msg(start_r2.error_info, "")
         return True
     else:
@@ -107,6 +126,18 @@ def paths_r2() -> List[Path]:
     return paths
 
 
+def key_widgets_r2() -> List[Tuple[str, str, bool]]:
+    return [("path_cells", "key_cells", start_r2.enable_cell.value),
+            ("path_raw", "key_raw", True),
+            ("path_mask", "key_mask", start_r2.enable_mask.value),
+            ("seg_dir", "key_seg", start_r2.load_seg_dir.value)]
+
+
+def datasets_r2() -> List[Tuple[Path, str]]:
+    return [(getattr(start_r2, path_name).value, getattr(start_r2, key_name).value)
+            for path_name, key_name, used in key_widgets_r2() if used]
+
+
 def tiff_folders_r2() -> List[Path]:
     paths = [start_r2.path_raw.value]
     if start_r2.load_seg_dir.value:
@@ -118,16 +149,21 @@ def tiff_folders_r2() -> List[Path]:
     return paths
 
 
-def load_segmentation(path_seg: Path):
-    if path_seg.is_dir():
+def load_segmentation(path_seg: Path, key: str = ""):
+    # The segmentation is edited in RAM and saved as .npy files, and the bbox cache is keyed by the modification time
+    # of the loaded .npy file. So the images/container are converted into a .npy file once, which is then loaded
+    # (as path_result) in the next sessions instead of the images/container
+    if path_seg.is_dir() or is_container(path_seg):
         print("Caching segmentation... Please wait")
-        segmentation = load_image_pil(path_seg)
-        start_r2.path_result.value = path_seg.parent / (path_seg.stem + "_from_dir.npy")
+        segmentation = load_image_stack(path_seg, show_info=lambda info: show_loading_info(start_r2.loading_info, info),
+                                        key=key)
+        key_name = "_" + key.strip("/").replace("/", "_") if is_container(path_seg) else ""
+        start_r2.path_result.value = path_seg.parent / (path_seg.stem + key_name + "_from_dir.npy")
         np.save(start_r2.path_result.value, segmentation)
         path_npy = start_r2.path_result.value
         _on_save_para_changed()
     else:
-        segmentation = np.load(str(path_seg))
+        segmentation = to_volume_layout(np.load(str(path_seg)))
         path_npy = path_seg
 
     if segmentation.dtype != parameters.pars.dtype_r2:
@@ -142,16 +178,23 @@ def use_mask():
     visible = start_r2.enable_mask.value
     start_r2.path_mask.visible = visible
     start_r2.mask_value.visible = visible
+    show_dataset_keys(start_r2, key_widgets_r2())
 
     msg = check_existence_path(paths_r2())
     show_error_msg(start_r2.error_info, msg)
 
 
+@start_r2.enable_cell.changed.connect
+def use_cell():
+    show_dataset_keys(start_r2, key_widgets_r2())
+
+
 @start_r2.load_seg_dir.changed.connect
 def load_seg_dir():
     visible = start_r2.load_seg_dir.value
     start_r2.path_result.visible = not visible
     start_r2.seg_dir.visible = visible
+    show_dataset_keys(start_r2, key_widgets_r2())
 
     msg = check_existence_path(paths_r2())
     show_error_msg(start_r2.error_info, msg)
@@ -163,6 +206,9 @@ def _on_save_para_changed():
                        "path_raw": start_r2.path_raw.value,
                        "path_mask": start_r2.path_mask.value,
                        "path_result": start_r2.path_result.value.parent,
+                       "key_cells": start_r2.key_cells.value,
+                       "key_raw": start_r2.key_raw.value,
+                       "key_mask": start_r2.key_mask.value,
                        "cell_value": start_r2.cell_value.value,
                        "mask_value": start_r2.mask_value.value}
     parameters_r2 = {"seg_file": start_r2.path_result.value}
@@ -197,8 +243,14 @@ def _on_path_result_changed():
     show_error_msg(start_r2.error_info, msg)
 
 
+@start_r2.select_hdf5.changed.connect
+def _on_select_hdf5_changed():
+    set_file_modes(start_r2, key_widgets_r2())
+
+
 @start_r2.seg_dir.changed.connect
 def _on_seg_dir_changed():
+    show_dataset_keys(start_r2, key_widgets_r2())
     msg = check_existence_path(paths_r2())
     show_error_msg(start_r2.error_info, msg)
 
@@ -207,20 +259,25 @@ def _on_seg_dir_changed():
 def _on_path_cells_changed():
     if start_r2.path_cells.value.exists():
         new_cwd = start_r2.path_cells.value.parent
-        start_r2.path_raw.value = new_cwd
-        start_r2.path_mask.value = new_cwd
+        # The other images are usually stored in the same container
+        path_images = start_r2.path_cells.value if is_container(start_r2.path_cells.value) else new_cwd
+        start_r2.path_raw.value = path_images
+        start_r2.path_mask.value = path_images
         start_r2.path_result.value = new_cwd
+    show_dataset_keys(start_r2, key_widgets_r2())
     msg = check_existence_path(paths_r2())
     show_error_msg(start_r2.error_info, msg)
 
 
 @start_r2.path_raw.changed.connect
 def _on_path_raw_changed():
+    show_dataset_keys(start_r2, key_widgets_r2())
     msg = check_existence_path(paths_r2())
     show_error_msg(start_r2.error_info, msg)
 
 
 @start_r2.path_mask.changed.connect
 def _on_path_mask_changed():
+    show_dataset_keys(start_r2, key_widgets_r2())
     msg = check_existence_path(paths_r2())
     show_error_msg(start_r2.error_info, msg)
@@ -1,5 +1,6 @@
 from typing import Tuple, TYPE_CHECKING
 
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication
 from magicgui import widgets
 from magicgui.widgets import Container
@@ -26,6 +27,8 @@ class WidgetsR1:
                                               tooltip=f"Less than {parameters.pars.cache_length_r1} action can be cached",
                                               enabled=True)
         self.label_list_msg = widgets.LineEdit(label="Label list", enabled=False)
+        self.pending_writes = widgets.LineEdit(label="Pending writes", value="0", enabled=False,
+                                               tooltip="Number of slices waiting to be saved into the hard disk")
 
         self.hotkeys_info_value = '[Shift + N]: Go to the next slice' \
                                   '\n---------------' \
@@ -49,6 +52,9 @@ class WidgetsR1:
         self.state_info = widgets.Label(value="")
 
         self.add_widgets()
+        self.timer_pending_writes = QTimer()
+        self.timer_pending_writes.timeout.connect(self.update_pending_writes)
+        self.timer_pending_writes.start(500)
         QApplication.processEvents()
 
     def show_state_info(self, info: str):
@@ -57,9 +63,10 @@ class WidgetsR1:
         QApplication.processEvents()
 
     def add_widgets(self):
-        container_states = Container(widgets=[self.image_size, self.max_label, self.cached_action, self.label_list_msg])
+        container_states = Container(widgets=[self.image_size, self.max_label, self.cached_action, self.label_list_msg,
+                                              self.pending_writes])
         container_export = Container(widgets=[self.export_button])
-        container_states.min_height = 310
+        container_states.min_height = 340
         self.viewer.window.add_dock_widget(container_states, name="States", area="right")
         self.viewer.window.add_dock_widget([self.hotkeys_info], name="HotKeys", area="right")
         self.viewer.window.add_dock_widget(container_export, name="Save/Export", area="right")
@@ -70,4 +77,8 @@ class WidgetsR1:
         self.cached_action.value = add_blank_lines("".join(self.emseg1.cache.cached_actions),
                                                    parameters.pars.cache_length_r1 + 1)
         self.label_list_msg.value = tuple(self.emseg1.label_list)
+        self.update_pending_writes()
         return None
+
+    def update_pending_writes(self):
+        self.pending_writes.value = str(self.emseg1.archive.writer.num_pending)
@@ -4,17 +4,17 @@ from pathlib import Path
 from typing import Optional, TYPE_CHECKING
 
 import numpy as np
-from PIL import Image
 from PyQt5.QtWidgets import QApplication
 from magicgui import widgets, use_app
 from magicgui.types import FileDialogMode
 from magicgui.widgets import Container
 
 from seg2link import parameters
-from seg2link.misc import TinyCells, make_folder
+from seg2link.misc import TinyCells
 from seg2link.message_windows_round2 import sort_remove_window
 from seg2link.single_cell_division import DivideMode
 from seg2link.cache_bbox import NoLabelError
+from seg2link.writers import TiffSlicesWriter, write_slices, tiff_dtype
 
 if TYPE_CHECKING:
     from seg2link.seg2link_round2 import VisualizeAll
@@ -98,7 +98,7 @@ class WidgetsR2:
         self.viewer.window.add_dock_widget([self.hotkeys_info], name="HotKeys", area="left")
 
     def update_info(self, label_pre_division: Optional[int]=None):
-        self.label_max = max(self.emseg2.cache_bbox.bbox)
+        self.label_max = self.emseg2.cache_bbox.max_label
         labels_post_division = self.emseg2.divide_list
         if len(labels_post_division) != 0:
             self.choose_box.max = len(labels_post_division)
@@ -133,12 +133,14 @@ class WidgetsR2:
 
     def locate_cell_2d(self, label):
         current_layer = self.emseg2.layer_selected
-        locs_current_layer = np.where(self.emseg2.labels[..., current_layer] == label)
-        if locs_current_layer[0].size == 0:
+        stored_bbox = self.emseg2.cache_bbox.bbox.get(label)
+        if stored_bbox is None or self.emseg2.cache_bbox.stats.count_in_slice(label, current_layer) == 0:
             self.locate_cell_button.location.value = f"Not found in current slice"
         else:
             self.emseg2.vis.viewer.dims.set_current_step(axis=2, value=current_layer)
-            x_loc, y_loc = np.mean(locs_current_layer[0], dtype=int), np.mean(locs_current_layer[1], dtype=int)
+            locs_current_layer = np.where(self.emseg2.labels[stored_bbox[0], stored_bbox[1], current_layer] == label)
+            x_loc = np.mean(locs_current_layer[0], dtype=int) + stored_bbox[0].start
+            y_loc = np.mean(locs_current_layer[1], dtype=int) + stored_bbox[1].start
             self.locate_cell_button.location.value = f"[{x_loc}, {y_loc}]"
 
     def locate_cell_3d(self, label, subregion_slice=None):
@@ -146,6 +148,18 @@ class WidgetsR2:
             stored_bbox = self.emseg2.cache_bbox.bbox[label]
         except KeyError:
             raise NoLabelError
+        if subregion_slice is None:
+            # The middle one of the occupied slices is looked up in the statistics of labels, and the location is
+            # the center of the label in that slice
+            layers_with_label = self.emseg2.cache_bbox.stats.occupied_slices(label)
+            center_layer = layers_with_label[len(layers_with_label) // 2]
+            locs_center_layer = np.where(self.emseg2.labels[stored_bbox[0], stored_bbox[1], center_layer] == label)
+            if len(locs_center_layer[0]) > 0:
+                x_loc = np.mean(locs_center_layer[0], dtype=int) + stored_bbox[0].start
+                y_loc = np.mean(locs_center_layer[1], dtype=int) + stored_bbox[1].start
+                self.emseg2.vis.viewer.dims.set_current_step(axis=2, value=center_layer)
+                self.locate_cell_button.location.value = f"[{x_loc}, {y_loc}]"
+                return
         center_layer, x_loc, y_loc = self.locate_cell_3d_subregion(
             self.emseg2.labels[stored_bbox], label, subregion_slice
         )
@@ -258,7 +272,8 @@ class WidgetsR2:
         @remove_and_save.changed.connect
         def show_info_remove_cells():
             self.show_state_info("Sorting cells... Please wait")
-            self.tiny_cells.sort_by_areas(label_image=self.emseg2.labels)
+            self.emseg2.cache_bbox.update_new_labels()
+            self.tiny_cells.sort_by_label_areas(self.emseg2.cache_bbox.stats.areas())
             self.remove_sort_window.width = 400
             self.remove_sort_window.height = 200
             self.remove_sort_window.show(run=True)
@@ -319,12 +334,12 @@ class WidgetsR2:
             if path:
                 self.show_state_info("Modifying boundary... Please wait")
                 modify_boundary()
-                transformed_labels = transform_dtype(self.emseg2.labels)
+                labels = self.emseg2.labels
 
                 self.show_state_info("Saving images... Please wait")
-                path_ = make_folder(Path(path) / "seg_tiff")
-                for z, img_z in enumerate(transformed_labels):
-                    Image.fromarray(img_z).save(str(path_ / "seg_slice%04i.tiff") % z)
+                with TiffSlicesWriter(Path(path) / "seg_tiff" / "seg_slice%04i.tiff", labels.shape,
+                                      tiff_dtype(labels)) as writer:
+                    write_slices(writer, lambda z: labels[..., z], show_info=self.show_state_info)
                 self.show_state_info("Segementation was exported as tiff images")
             else:
                 self.show_state_info("Warning: Folder doesn't exist!")
@@ -345,16 +360,6 @@ class WidgetsR2:
             else:
                 pass
 
-        def transform_dtype(labels):
-            if labels.dtype == np.uint16 or np.max(labels) > 65535:
-                transformed_labels = labels.transpose((2, 0, 1))
-            elif labels.dtype == np.uint32 or labels.dtype == np.int32:
-                transformed_labels = labels.view(np.uint16)[:, :, ::2].transpose((2, 0, 1))
-            else:
-                raise ValueError(f"emseg2.labels.dtype is {labels.dtype} "
-                                 f"but should be np.uint32 or np.uint16")
-            return transformed_labels
-
 
 class LocateSelectedCellButton(Container):
     def __init__(self, **kwargs):
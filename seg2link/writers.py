@@ -0,0 +1,213 @@
+"""Write image volumes (H, W, slice) slice by slice into different formats.
+
+The slices are generated and written by a thread pool, so the volume is never created in RAM.
+The target format is chosen by the file name (see get_writer):
+    *.npy: memory-mapped numpy array
+    *.zarr: Zarr array (one chunk per slice); *.ome.zarr: OME-Zarr image
+    *.tif/*.tiff: multi-page BigTIFF
+    a folder/file name pattern containing %: one TIFF image per slice
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Optional, Tuple, Union
+
+import numpy as np
+import tifffile
+import zarr
+from numpy import ndarray
+
+from seg2link import parameters
+
+
+class SliceWriter:
+    """Base class of the writers. Slices (2D arrays of shape (H, W)) are written by write(z, img) with z from 0
+
+    Notes
+    -----
+    If parallel is True, different slices can be written by several threads at the same time.
+    Otherwise the slices should be written in order.
+    """
+    parallel = True
+
+    def __init__(self, path: Union[str, Path], shape: Tuple[int, int, int], dtype: type):
+        self.path = Path(path)
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, z: int, img: ndarray):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NpyWriter(SliceWriter):
+    """Memory-mapped .npy file. Fortran order is used so that each slice is contiguous on the disk"""
+
+    def __init__(self, path: Union[str, Path], shape: Tuple[int, int, int], dtype: type):
+        super().__init__(path, shape, dtype)
+        self._array = np.lib.format.open_memmap(str(self.path), mode="w+", dtype=self.dtype, shape=shape,
+                                                fortran_order=True)
+
+    def write(self, z: int, img: ndarray):
+        self._array[..., z] = img
+
+    def close(self):
+        if self._array is not None:
+            self._array.flush()
+            self._array = None
+
+
+class ZarrWriter(SliceWriter):
+    """Zarr array of shape (slice, H, W) with one chunk per slice, or an OME-Zarr image (array "0" of a group)
+
+    Notes
+    -----
+    If packbits is True, a boolean volume is stored with 8 voxels per byte along W, i.e. as uint8 array
+    (slice, H, ceil(W / 8)) with the attribute "packed_width": W (see misc.load_volume_cache)
+    """
+
+    def __init__(self, path: Union[str, Path], shape: Tuple[int, int, int], dtype: type, ome: bool = False,
+                 packbits: bool = False):
+        super().__init__(path, shape, dtype)
+        h, w, z = shape
+        if packbits and (ome or self.dtype != bool):
+            raise ValueError("Only a boolean volume (not OME-Zarr) can be bit-packed")
+        self.packbits = packbits
+        compressors = zarr.codecs.BloscCodec(cname="zstd", clevel=3, shuffle=zarr.codecs.BloscShuffle.bitshuffle)
+        if ome:
+            group = zarr.open_group(str(self.path), mode="w")
+            scale_x, scale_y, scale_z = parameters.pars.scale_xyz
+            group.attrs["ome"] = {"version": "0.5", "multiscales": [{
+                "axes": [{"name": "z", "type": "space"}, {"name": "y", "type": "space"},
+                         {"name": "x", "type": "space"}],
+                "datasets": [{"path": "0", "coordinateTransformations": [
+                    {"type": "scale", "scale": [scale_z, scale_y, scale_x]}]}]}]}
+            self._array = group.create_array("0", shape=(z, h, w), chunks=(1, h, w), dtype=self.dtype,
+                                             compressors=compressors, fill_value=0)
+        elif packbits:
+            w_packed = (w + 7) // 8
+            self._array = zarr.create_array(str(self.path), shape=(z, h, w_packed), chunks=(1, h, w_packed),
+                                            dtype=np.uint8, compressors=compressors, fill_value=0, overwrite=True,
+                                            attributes={"packed_width": w})
+        else:
+            self._array = zarr.create_array(str(self.path), shape=(z, h, w), chunks=(1, h, w), dtype=self.dtype,
+                                            compressors=compressors, fill_value=0, overwrite=True)
+
+    @classmethod
+    def open_existing(cls, path: Union[str, Path]) -> "ZarrWriter":
+        """Writer of an array created by a ZarrWriter (not OME-Zarr), e.g. for writing its slices in other processes"""
+        array = zarr.open_array(str(path), mode="r+")
+        width = array.attrs.get("packed_width")
+        z, h, w = array.shape
+        writer = cls.__new__(cls)
+        SliceWriter.__init__(writer, path, (h, w if width is None else width, z),
+                             array.dtype if width is None else bool)
+        writer.packbits = width is not None
+        writer._array = array
+        return writer
+
+    def write(self, z: int, img: ndarray):
+        self._array[z] = np.packbits(img, axis=-1) if self.packbits else img
+
+
+class TiffSlicesWriter(SliceWriter):
+    """One TIFF image per slice. The path is a file name pattern such as folder/seg_slice%04i.tiff,
+    formatted with z + first_index"""
+
+    def __init__(self, path: Union[str, Path], shape: Tuple[int, int, int], dtype: type, first_index: int = 0):
+        super().__init__(path, shape, dtype)
+        self.first_index = first_index
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, z: int, img: ndarray):
+        tifffile.imwrite(str(self.path) % (z + self.first_index), img)
+
+
+class BigTiffWriter(SliceWriter):
+    """Multi-page BigTIFF file (one page per slice). The pages are written in order"""
+    parallel = False
+
+    def __init__(self, path: Union[str, Path], shape: Tuple[int, int, int], dtype: type):
+        super().__init__(path, shape, dtype)
+        self._tiff = tifffile.TiffWriter(str(self.path), bigtiff=True)
+        self._next_z = 0
+        self._lock = Lock()
+
+    def write(self, z: int, img: ndarray):
+        with self._lock:
+            if z != self._next_z:
+                raise ValueError(f"Slice {z} should be written after slice {self._next_z - 1}")
+            self._tiff.write(img, contiguous=True, photometric="minisblack")
+            self._next_z += 1
+
+    def close(self):
+        self._tiff.close()
+
+
+def tiff_dtype(labels: ndarray) -> np.dtype:
+    """dtype of the exported TIFF images: uint16 if all labels fit in it, otherwise the dtype of the labels
+
+    Notes
+    -----
+    The slices are converted one by one by write_slices, which works for any memory layout of the labels
+    """
+    if labels.dtype == np.uint16 or np.max(labels) > 65535:
+        return labels.dtype
+    if labels.dtype in (np.uint32, np.int32):
+        return np.dtype(np.uint16)
+    raise ValueError(f"emseg2.labels.dtype is {labels.dtype} but should be np.uint32 or np.uint16")
+
+
+def get_writer(path: Union[str, Path], shape: Tuple[int, int, int], dtype: type, **kwargs) -> SliceWriter:
+    """Choose the writer according to the file name"""
+    name = os.path.basename(str(path)).lower()
+    if "%" in name:
+        return TiffSlicesWriter(path, shape, dtype, **kwargs)
+    if name.endswith(".npy"):
+        return NpyWriter(path, shape, dtype)
+    if name.endswith(".ome.zarr"):
+        return ZarrWriter(path, shape, dtype, ome=True)
+    if name.endswith(".zarr"):
+        return ZarrWriter(path, shape, dtype)
+    if name.endswith((".tif", ".tiff")):
+        return BigTiffWriter(path, shape, dtype)
+    raise ValueError(f"Unknown format of {path}. Should be .npy, .zarr, .ome.zarr, .tif(f) or a pattern with %")
+
+
+def write_slices(writer: SliceWriter, get_slice: Callable[[int], ndarray], num_slices: Optional[int] = None,
+                 workers: Optional[int] = None, show_info: Callable[[str], None] = print, info_interval: int = 50):
+    """Generate the slices with get_slice(z) (z from 0) and write them with a thread pool
+
+    Notes
+    -----
+    Only a few slices (2 per worker) are in RAM at the same time. For the writers that can not write in parallel,
+    the slices are still generated in parallel but written in order.
+    """
+    num_slices = writer.shape[2] if num_slices is None else num_slices
+    workers = min(4, os.cpu_count() or 1) if workers is None else workers
+
+    def generate(z: int) -> ndarray:
+        img = np.ascontiguousarray(get_slice(z), dtype=writer.dtype)
+        if writer.parallel:
+            writer.write(z, img)
+            return None
+        return img
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="writer") as executor:
+        batch_size = 2 * workers
+        for start in range(0, num_slices, batch_size):
+            zs = range(start, min(start + batch_size, num_slices))
+            for z, img in zip(zs, executor.map(generate, zs)):
+                if img is not None:
+                    writer.write(z, img)
+                if (z + 1) % info_interval == 0 or z + 1 == num_slices:
+                    show_info(f"Saving slices: {z + 1}/{num_slices}... Please wait")
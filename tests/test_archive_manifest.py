@@ -0,0 +1,60 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from seg2link import parameters
+from seg2link.seg2dlink_core import Archive, FlatLabels
+
+
+def make_archive(path):
+    archive = Archive(None, path)
+    archive.make_folders()
+    return archive
+
+
+def save_slices(archive, num_slices):
+    labels2d = []
+    for z in range(1, num_slices + 1):
+        labels2d.append([z, z + 100])
+        labels1d = [label for labels in labels2d for label in labels]
+        archive.save_labels_v2(z, FlatLabels(np.asarray(labels1d, dtype=np.int64), [2] * z))
+
+
+def test_saves_are_journaled_and_merged_when_loading(tmp_path):
+    archive = make_archive(tmp_path)
+    save_slices(archive, 5)
+    path_labels = tmp_path / "History_labels"
+    assert (path_labels / parameters.manifest_journal_filename).exists()
+
+    archive = make_archive(tmp_path)
+    assert archive.latest_slice == 5
+    assert archive.read_labels(5).labels1d.tolist() == [1, 101, 2, 102, 3, 103, 4, 104, 5, 105]
+    assert not (path_labels / parameters.manifest_journal_filename).exists()
+    assert archive.manifest[5]["mtime_ns"] == os.stat(path_labels / archive.manifest[5]["file"]).st_mtime_ns
+
+
+def test_a_label_file_overwritten_by_another_program_is_not_reported_as_corrupted(tmp_path):
+    save_slices(make_archive(tmp_path), 1)
+    path_file = tmp_path / "History_labels" / (parameters.label_filename_v2 % 1)
+    stat = os.stat(path_file)
+    # Same name and size, so the folder and the size do not show the change
+    with open(path_file, 'wb') as f:
+        f.write(pickle.dumps([[2, 101]], pickle.HIGHEST_PROTOCOL))
+    os.utime(path_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert os.stat(path_file).st_size == stat.st_size
+
+    assert make_archive(tmp_path).read_labels(1).labels1d.tolist() == [2, 101]
+
+
+def test_a_modified_label_file_with_the_recorded_size_and_time_is_corrupted(tmp_path):
+    save_slices(make_archive(tmp_path), 1)
+    path_file = tmp_path / "History_labels" / (parameters.label_filename_v2 % 1)
+    stat = os.stat(path_file)
+    with open(path_file, 'wb') as f:
+        f.write(pickle.dumps([[2, 101]], pickle.HIGHEST_PROTOCOL))
+    os.utime(path_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    with pytest.raises(IOError, match="corrupted"):
+        make_archive(tmp_path).read_labels(1)
@@ -0,0 +1,21 @@
+import pytest
+
+from seg2link.seg2dlink_core import ArchiveRecord, ArchiveWriter
+
+
+def test_flush_raises_the_write_error():
+    written = []
+
+    def write(record):
+        if record.slice_num == 2:
+            raise OSError("No space left on device")
+        written.append(record.slice_num)
+
+    writer = ArchiveWriter(write)
+    for slice_num in (1, 2, 3):
+        writer.put(ArchiveRecord(slice_num, None, None))
+    with pytest.raises(RuntimeError, match="slice 2") as excinfo:
+        writer.flush()
+    assert isinstance(excinfo.value.__cause__, OSError)
+    assert written == [1, 3]
+    writer.flush()
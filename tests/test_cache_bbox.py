@@ -0,0 +1,32 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from seg2link.cache_bbox import CacheBbox
+
+
+def make_cache_bbox(labels, tmp_path):
+    np.save(str(tmp_path / "seg.npy"), labels)
+    emseg2 = SimpleNamespace(labels=labels, labels_path=tmp_path / "seg.npy",
+                             vis=SimpleNamespace(widgets=SimpleNamespace(show_state_info=lambda info: None)))
+    return CacheBbox(emseg2)
+
+
+def test_stats_of_a_painted_label_and_of_the_labels_painted_over(tmp_path):
+    labels = np.zeros((60, 70, 12), dtype=np.uint32)
+    labels[5:30, 5:40, 1:8] = 1
+    labels[35:55, 10:60, 3:11] = 2
+    labels[10:14, 50:54, 4:6] = 3
+    cache_bbox = make_cache_bbox(labels, tmp_path)
+
+    label = cache_bbox.insert_label()
+    labels[20:40, 30:56, 4:7] = label  # Over parts of labels 1 and 2
+    labels[8:16, 48:56, 3:7] = label  # Over all voxels of label 3
+    cache_bbox.update_new_labels()
+
+    areas = np.bincount(labels.ravel())
+    areas[0] = 0
+    np.testing.assert_array_equal(cache_bbox.stats.areas(), areas)
+    for label_ in (1, 2, label):
+        np.testing.assert_allclose(cache_bbox.stats.centroid(label_), np.mean(np.nonzero(labels == label_), axis=1))
+    assert cache_bbox.stats.count(3) == 0
@@ -0,0 +1,121 @@
+import copy
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from skimage.segmentation import relabel_sequential
+
+from seg2link.link_by_overlap import link_previous_slices_round1
+from seg2link.seg2dlink_core import Labels, relabel_min_change
+
+RATIO_OVERLAP = 0.5
+
+
+class ListLabels:
+    """The labels as a plain list of lists, modified by replacing the values (the semantics before the union-find)"""
+
+    def __init__(self):
+        self.labels2d = []
+
+    @property
+    def labels1d(self):
+        return [label for labels in self.labels2d for label in labels]
+
+    @property
+    def max_label(self):
+        return max(self.labels1d, default=0)
+
+    def replace(self, mapping):
+        self.labels2d = [[mapping.get(label, label) for label in labels] for labels in self.labels2d]
+
+    def link_or_append(self, seg_imgs):
+        seg = seg_imgs[-1]
+        if len(seg_imgs) == 1:
+            self.labels2d.append(np.unique(seg[seg != 0]).tolist())
+            return False
+        seg_pre = np.asarray([0] + self.labels2d[-1])[seg_imgs[-2]]
+        seg_post = seg.copy()
+        if self.labels1d:
+            seg_post[seg_post != 0] += self.max_label
+        list_post = np.unique(seg_post[seg_post != 0])
+        if np.max(seg_pre) == 0:
+            self.labels2d.append((list_post + self.max_label).tolist())
+            return False
+        targets_pre, list_post_linked = link_previous_slices_round1(seg_pre, seg_post, list_post, RATIO_OVERLAP)
+        self.replace(targets_pre)
+        self.labels2d.append(list_post_linked.tolist())
+        return True
+
+    def relabel(self):
+        labels1d, label_nums = self.labels1d, [len(labels) for labels in self.labels2d]
+        labels1d_re = relabel_min_change(np.asarray(labels1d), labels1d[:-label_nums[-1]]).tolist()
+        self.labels2d = Labels._to_labels2d(labels1d_re, label_nums)
+
+
+def random_seg(rng, seg_pre=None):
+    """A small segmentation (values 1..N), partially copied from the previous slice so that some cells are linked"""
+    seg = np.repeat(np.repeat(rng.integers(0, 7, (4, 4)), 3, axis=0), 3, axis=1)
+    if seg_pre is not None:
+        keep = np.repeat(np.repeat(rng.random((4, 4)) < 0.6, 3, axis=0), 3, axis=1)
+        seg = np.where(keep, seg_pre, seg)
+    return relabel_sequential(seg)[0]
+
+
+def run_random_sequence(seed, num_steps=40):
+    rng = np.random.default_rng(seed)
+    seg_imgs = []
+    emseg1 = SimpleNamespace(current_slice=0, label_list=set(), seg=SimpleNamespace(current_seg=None),
+                             seg_img_cache=None,
+                             archive=SimpleNamespace(read_seg_img=lambda cache, z: seg_imgs[z - 1]))
+    labels = Labels(emseg1, RATIO_OVERLAP)
+    model = ListLabels()
+    history = []
+
+    for step in range(num_steps):
+        operation = rng.choice(["link", "link", "merge", "delete", "divide", "undo"]) if seg_imgs else "link"
+        used = sorted(set(model.labels1d) - {0})
+        if operation == "link":
+            emseg1.current_slice += 1
+            seg_imgs.append(random_seg(rng, seg_imgs[-1] if seg_imgs else None))
+            emseg1.seg.current_seg = seg_imgs[-1]
+            if labels.link_or_append_labels():
+                labels.relabel()
+            if model.link_or_append(seg_imgs):
+                model.relabel()
+        elif operation == "merge" and len(used) >= 2:
+            emseg1.label_list = set(rng.choice(used, size=rng.integers(2, min(4, len(used)) + 1),
+                                               replace=False).tolist())
+            labels.merge()
+            model.replace({label: min(emseg1.label_list) for label in emseg1.label_list})
+        elif operation == "delete" and used:
+            delete_list = set(rng.choice(used, size=rng.integers(1, min(3, len(used)) + 1), replace=False).tolist())
+            labels.delete(delete_list)
+            model.replace({label: 0 for label in delete_list})
+        elif operation == "divide":
+            # Replace the last slice, with existing labels and/or new labels (or no label), as after dividing a cell
+            seg_imgs[-1] = random_seg(rng) if rng.random() < 0.8 else np.zeros_like(seg_imgs[-1])
+            emseg1.seg.current_seg = seg_imgs[-1]
+            candidates = used + list(range(model.max_label + 1, model.max_label + 8))
+            new_labels = sorted(rng.choice(candidates, size=int(seg_imgs[-1].max()), replace=False).tolist())
+            labels.set_last_labels(np.asarray(new_labels, dtype=np.int64))
+            model.labels2d[-1] = new_labels
+        elif operation == "undo" and history:
+            snapshot, labels2d, segs = history[rng.integers(len(history))]
+            labels.set_snapshot(snapshot)
+            model.labels2d = copy.deepcopy(labels2d)
+            seg_imgs[:] = segs
+            emseg1.current_slice = len(segs)
+            emseg1.seg.current_seg = segs[-1] if segs else None
+        history.append((labels.snapshot(), copy.deepcopy(model.labels2d), list(seg_imgs)))
+
+        assert labels._labels == model.labels2d, f"seed {seed}, step {step}: {operation}"
+        assert labels.label_nums == [len(slice_labels) for slice_labels in model.labels2d]
+        assert labels.max_label == model.max_label
+        assert labels._cell_num == len(set(model.labels1d))
+        for z in range(1, labels.slice_num + 1):
+            assert labels.slice_labels(z).tolist() == model.labels2d[z - 1]
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_random_operations_match_the_list_of_lists_labels(seed):
+    run_random_sequence(seed)
@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from seg2link.seg2dlink_core import Labels
+
+
+def make_labels(labels2d):
+    labels = Labels(SimpleNamespace(current_slice=len(labels2d)))
+    labels._labels = labels2d
+    return labels
+
+
+def test_snapshot_after_replacing_the_last_slice_by_an_empty_slice():
+    labels = make_labels([[1], [1], [2, 3, 4, 5], [6, 7]])
+    labels.snapshot()
+
+    labels.set_last_labels([])
+    snapshot = labels.snapshot()
+
+    assert snapshot.label_nums == [1, 1, 4, 0]
+    assert [len(parent) for parent, _ in snapshot.blocks] == [1, 1, 4, 0]
+    restored = make_labels([[9]])
+    restored.set_snapshot(snapshot)
+    assert restored._labels == [[1], [1], [2, 3, 4, 5], []]
+
+
+def test_snapshot_after_replacing_the_last_slice_restores_the_new_labels():
+    labels = make_labels([[1, 2], [3, 4]])
+    labels.snapshot()
+
+    labels.set_last_labels(np.array([5, 6], dtype=np.int64))
+    snapshot = labels.snapshot()
+
+    restored = make_labels([[9]])
+    restored.set_snapshot(snapshot)
+    assert restored._labels == [[1, 2], [5, 6]]
@@ -0,0 +1,13 @@
+import numpy as np
+
+from seg2link.misc import TinyCells
+
+
+def test_remove_and_relabel_removes_labels_missing_from_the_sorted_labels():
+    image = np.asfortranarray(np.array([[[1, 2], [2, 3]], [[3, 3], [0, 9]]], dtype=np.uint32))
+    tiny_cells = TinyCells()
+    tiny_cells.sort_by_areas(np.where(image == 9, 0, image))
+
+    relabeled = tiny_cells.remove_and_relabel(image, max_cell_num=2)
+
+    np.testing.assert_array_equal(relabeled, [[[0, 2], [2, 1]], [[1, 1], [0, 0]]])
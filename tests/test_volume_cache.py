@@ -0,0 +1,62 @@
+import numpy as np
+import tifffile
+
+from seg2link.misc import VolumeCache, load_cells
+
+
+def save_images(path, volume):
+    path.mkdir()
+    for z in range(volume.shape[2]):
+        tifffile.imwrite(str(path / f"cells_{z:04d}.tif"), volume[..., z])
+
+
+def test_a_variant_missing_from_the_manifest_is_rebuilt(tmp_path):
+    volume = np.random.default_rng(0).integers(0, 3, size=(16, 24, 4), dtype=np.uint8)
+    save_images(tmp_path / "cells", volume)
+    load_cells(1, tmp_path / "cells", file_cached=VolumeCache(tmp_path / "cells"))
+
+    # As if the run was interrupted after moving the variant into place, before adding it to the manifest
+    cache = VolumeCache(tmp_path / "cells")
+    cache.manifest["variants"].clear()
+    cache._write_manifest()
+
+    cells = load_cells(1, tmp_path / "cells", file_cached=VolumeCache(tmp_path / "cells"))
+    np.testing.assert_array_equal(cells.compute(), volume == 1)
+    assert len(VolumeCache(tmp_path / "cells").manifest["variants"]) == 1
+
+
+def test_variants_without_a_manifest_are_removed(tmp_path):
+    volume = np.random.default_rng(1).integers(0, 3, size=(16, 24, 4), dtype=np.uint8)
+    save_images(tmp_path / "cells", volume)
+    cache = VolumeCache(tmp_path / "cells")
+    orphan = cache.path_cache / "load_cells_0123456789abcdef.zarr"
+    orphan.mkdir(parents=True)
+
+    cells = load_cells(2, tmp_path / "cells", file_cached=VolumeCache(tmp_path / "cells"))
+    np.testing.assert_array_equal(cells.compute(), volume == 2)
+    assert not orphan.exists()
+
+
+def test_the_npy_cache_of_a_previous_version_is_migrated(tmp_path):
+    volume = np.random.default_rng(2).integers(0, 3, size=(16, 24, 4), dtype=np.uint8)
+    save_images(tmp_path / "cells", volume)
+    # Previous versions reused the .npy cache whatever the parameters were
+    legacy = np.zeros(volume.shape, dtype=bool)
+    legacy[2:5, 3:9, 1] = True
+    np.save(str(tmp_path / "cells.npy"), legacy)
+
+    cells = load_cells(1, tmp_path / "cells", file_cached=VolumeCache(tmp_path / "cells"))
+    np.testing.assert_array_equal(cells.compute(), legacy)
+    assert not (tmp_path / "cells.npy").exists()
+    cells = load_cells(1, tmp_path / "cells", file_cached=VolumeCache(tmp_path / "cells"))
+    np.testing.assert_array_equal(cells.compute(), legacy)
+
+
+def test_an_npy_cache_not_matching_the_images_is_kept(tmp_path):
+    volume = np.random.default_rng(3).integers(0, 3, size=(16, 24, 4), dtype=np.uint8)
+    save_images(tmp_path / "cells", volume)
+    np.save(str(tmp_path / "cells.npy"), np.zeros((16, 24, 3), dtype=bool))
+
+    cells = load_cells(1, tmp_path / "cells", file_cached=VolumeCache(tmp_path / "cells"))
+    np.testing.assert_array_equal(cells.compute(), volume == 1)
+    assert (tmp_path / "cells.npy").exists()
@@ -0,0 +1,24 @@
+import numpy as np
+import tifffile
+
+from seg2link.writers import TiffSlicesWriter, tiff_dtype, write_slices
+
+
+def test_export_fortran_ordered_uint32_labels_as_uint16_tiff(tmp_path):
+    rng = np.random.default_rng(0)
+    labels = np.asfortranarray(rng.integers(0, 65536, size=(20, 30, 5), dtype=np.uint32))
+
+    dtype = tiff_dtype(labels)
+    with TiffSlicesWriter(tmp_path / "seg_slice%04i.tiff", labels.shape, dtype) as writer:
+        write_slices(writer, lambda z: labels[..., z], show_info=lambda info: None)
+
+    assert dtype == np.uint16
+    for z in range(labels.shape[2]):
+        img = tifffile.imread(str(tmp_path / f"seg_slice{z:04d}.tiff"))
+        assert img.dtype == np.uint16
+        np.testing.assert_array_equal(img, labels[..., z])
+
+
+def test_export_keeps_uint32_when_labels_exceed_uint16():
+    labels = np.asfortranarray(np.full((4, 4, 2), 70000, dtype=np.uint32))
+    assert tiff_dtype(labels) == np.uint32
@@ -0,0 +1,73 @@
+"""
+Benchmark the caches of the cell region/mask images used in round #1: the previous .npy cache (Z last, one
+dask task per slice) vs. the Zarr cache (one compressed chunk per slice), with or without bit-packing.
+The startup (opening the lazy array), the per-slice read latency and the cache size are reported.
+
+Usage: python benchmark_cache.py [-s 2048] [-z 64] [--dir path/to/temporary/folder]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from seg2link.misc import load_array_lazy, save_volume_cache, load_volume_cache
+
+
+def synthetic_cells(size: int, depth: int, seed: int = 0) -> np.ndarray:
+    """A boolean volume of discs, similar to the cell regions"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    volume = np.zeros((size, size, depth), dtype=bool)
+    for z in range(depth):
+        centers = rng.integers(0, size, (size // 32, 2))
+        radius = size // 40
+        img = np.zeros((size, size), dtype=bool)
+        for y, x in centers:
+            y0, y1, x0, x1 = max(0, y - radius), y + radius, max(0, x - radius), x + radius
+            img[y0:y1, x0:x1] |= (yy[y0:y1, x0:x1] - y) ** 2 + (xx[y0:y1, x0:x1] - x) ** 2 < radius ** 2
+        volume[..., z] = img
+    return volume
+
+
+def folder_size(path: Path) -> int:
+    return path.stat().st_size if path.is_file() else sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def benchmark(load_lazy, path: Path, depth: int):
+    t0 = time.perf_counter()
+    array = load_lazy(path)
+    time_startup = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for z in range(depth):
+        array[..., z].compute()
+    time_slice = (time.perf_counter() - t0) / depth
+    return time_startup * 1000, time_slice * 1000, folder_size(path) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cache of the cell region/mask images")
+    parser.add_argument("-s", type=int, default=2048, help="Height/width of the volume. Default: 2048")
+    parser.add_argument("-z", type=int, default=64, help="Number of slices. Default: 64")
+    parser.add_argument("--dir", type=Path, default=None, help="Folder for the caches. Default: temp")
+    args = parser.parse_args()
+    volume = synthetic_cells(args.s, args.z)
+
+    print(f"Volume {volume.shape}, bool")
+    print(f"{'cache':>14} {'startup (ms)':>13} {'slice (ms)':>11} {'size (MB)':>10}")
+    with tempfile.TemporaryDirectory(dir=args.dir) as folder:
+        path_npy, path_zarr = Path(folder) / "cells.npy", Path(folder) / "cells.zarr"
+        path_zarr_bytes = Path(folder) / "cells_bytes.zarr"
+        np.save(path_npy, np.ascontiguousarray(volume))
+        save_volume_cache(path_zarr, volume, show_info=lambda info: None)
+        save_volume_cache(path_zarr_bytes, volume, show_info=lambda info: None, packbits=False)
+        for name, load_lazy, path in (("previous .npy", load_array_lazy, path_npy),
+                                      ("Zarr (bytes)", load_volume_cache, path_zarr_bytes),
+                                      ("Zarr (bits)", load_volume_cache, path_zarr)):
+            time_startup, time_slice, size = benchmark(load_lazy, path, args.z)
+            print(f"{name:>14} {time_startup:>13.1f} {time_slice:>11.2f} {size:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
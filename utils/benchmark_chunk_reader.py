@@ -0,0 +1,78 @@
+"""
+Benchmark reading a chunked Zarr array slice by slice (as done by the round #1/#2 for the images in containers):
+the previous lazy array (one delayed zarr read per slice) vs. the ChunkReader (slices mapped onto the chunk grid,
+decoded chunks cached and read in parallel).
+
+Usage: python benchmark_chunk_reader.py [-s 1024] [-z 64] [-c 16 256 256] [-m 512] [-o path/to/folder]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import dask.array as da
+import numpy as np
+import zarr
+from dask import delayed
+
+from seg2link.chunk_reader import ChunkReader
+
+
+def synthetic_array(path: Path, size: int, depth: int, chunks) -> zarr.Array:
+    """A (depth, size, size) uint8 Zarr array of random blobs, compressed with Blosc"""
+    rng = np.random.default_rng(0)
+    array = zarr.create_array(str(path), shape=(depth, size, size), chunks=tuple(chunks), dtype=np.uint8,
+                              compressors=zarr.codecs.BloscCodec(cname="zstd", clevel=3), overwrite=True)
+    for z in range(depth):
+        noise = rng.random((size // 8, size // 8)) > 0.5
+        array[z] = np.repeat(np.repeat(noise, 8, axis=0), 8, axis=1).astype(np.uint8)
+    return array
+
+
+def previous_lazy(zarr_array) -> da.Array:
+    """The previous load_zarr_lazy: one delayed read of the whole slice per slice"""
+    imread = lambda z: zarr_array[z]
+    sample = imread(0)
+    lazy_arrays = [delayed(imread)(z) for z in range(zarr_array.shape[0])]
+    return da.stack([da.from_delayed(lazy_array, shape=sample.shape, dtype=sample.dtype)
+                     for lazy_array in lazy_arrays], axis=-1)
+
+
+def read_slices(volume: da.Array) -> float:
+    """Mean time (s) for reading the slices one after another, as when moving through the slices"""
+    t0 = time.perf_counter()
+    for z in range(volume.shape[2]):
+        volume[..., z].compute()
+    return (time.perf_counter() - t0) / volume.shape[2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reading a chunked Zarr array slice by slice")
+    parser.add_argument("-s", type=int, default=1024, help="Height/width of the images. Default: 1024")
+    parser.add_argument("-z", type=int, default=64, help="Number of slices. Default: 64")
+    parser.add_argument("-c", type=int, nargs=3, default=[16, 256, 256],
+                        help="Chunks of the Zarr array (z, y, x). Default: 16 256 256")
+    parser.add_argument("-m", type=int, default=512, help="Memory of the ChunkReader cache (MB). Default: 512")
+    parser.add_argument("-o", type=Path, help="Folder for the test array. Default: a temporary folder")
+    args = parser.parse_args()
+
+    folder = Path(tempfile.mkdtemp(dir=args.o))
+    try:
+        array = synthetic_array(folder / "volume.zarr", args.s, args.z, args.c)
+        reader = ChunkReader(array, args.m * 2 ** 20)
+        t_previous = read_slices(previous_lazy(array))
+        t_reader = read_slices(reader.to_dask())
+        stats = repr(reader)
+        assert np.array_equal(previous_lazy(array)[..., ::7].compute(), reader.to_dask()[..., ::7].compute()), \
+            "The results are different!"
+        print(f"Array {array.shape}, chunks {array.chunks}")
+        print(f"{'per slice':>10} {'previous (ms)':>14} {'ChunkReader (ms)':>17} {'speedup':>8}")
+        print(f"{'':>10} {t_previous * 1000:>14.1f} {t_reader * 1000:>17.1f} {t_previous / t_reader:>7.1f}x")
+        print(stats)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
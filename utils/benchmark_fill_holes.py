@@ -0,0 +1,62 @@
+"""
+Benchmark closing and filling holes in the mask images (round #1 with "Fill holes" checked):
+the previous fill_holes_scipy (whole volume in RAM, one core) vs. fill_holes_blockwise (blocks with halos in a
+process pool, streamed into the cache).
+
+Usage: python benchmark_fill_holes.py [-s 1024] [-z 64] [-k 25 25 7] [-w 4] [-b 16] [-o path/to/folder]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy import ndimage as ndi
+
+from seg2link.misc import fill_holes_scipy, fill_holes_blockwise, save_volume_cache, load_volume_cache
+
+
+def synthetic_mask(size: int, depth: int, seed: int = 0) -> np.ndarray:
+    """A (size, size, depth) mask of smooth random blobs"""
+    rng = np.random.default_rng(seed)
+    noise = rng.random((size // 16, size // 16, max(depth // 4, 2)))
+    zoom = (size / noise.shape[0], size / noise.shape[1], depth / noise.shape[2])
+    return ndi.zoom(noise, zoom, order=1)[:size, :size, :depth] > 0.55
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark closing and filling holes in the mask images")
+    parser.add_argument("-s", type=int, default=1024, help="Height/width of the images. Default: 1024")
+    parser.add_argument("-z", type=int, default=64, help="Number of slices. Default: 64")
+    parser.add_argument("-k", type=int, nargs=3, default=[25, 25, 7], help="Kernel of the closing. Default: 25 25 7")
+    parser.add_argument("-w", type=int, help="Number of worker processes. Default: number of CPUs (max 8)")
+    parser.add_argument("-b", type=int, default=16, help="Slices per block. Default: 16")
+    parser.add_argument("-o", type=Path, help="Folder for the test caches. Default: a temporary folder")
+    args = parser.parse_args()
+
+    folder = Path(tempfile.mkdtemp(dir=args.o))
+    try:
+        mask = synthetic_mask(args.s, args.z)
+        save_volume_cache(folder / "mask.zarr", mask, show_info=lambda info: None)
+
+        t0 = time.perf_counter()
+        result_previous = fill_holes_scipy(load_volume_cache(folder / "mask.zarr").compute(), tuple(args.k))
+        t_previous = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        fill_holes_blockwise(folder / "mask.zarr", folder / "filled.zarr", tuple(args.k), block_depth=args.b,
+                             workers=args.w, show_info=lambda info: None)
+        t_blockwise = time.perf_counter() - t0
+
+        assert np.array_equal(load_volume_cache(folder / "filled.zarr").compute(), result_previous), \
+            "The results are different!"
+        print(f"Mask {mask.shape}, kernel {tuple(args.k)}")
+        print(f"{'previous (s)':>13} {'blockwise (s)':>14} {'speedup':>8}")
+        print(f"{t_previous:>13.2f} {t_blockwise:>14.2f} {t_previous / t_blockwise:>7.1f}x")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
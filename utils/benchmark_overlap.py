@@ -0,0 +1,62 @@
+"""
+Benchmark the search of overlapped labels between two slices used for linking:
+the previous label-by-label search vs. the single-pass contingency table (OverlapTable).
+
+Usage: python benchmark_overlap.py [-s 4096] [-n 5000] [-r 3]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from seg2link.link_by_overlap import OverlapTable, extract_links_from_matching, \
+    extract_links_from_matching_deprecated, labels_and_areas
+
+
+def synthetic_slices(size: int, label_num: int, seed: int = 0):
+    """Two neighbouring slices with about label_num cells each. Cells in slice 2 are shifted and partially lost"""
+    rng = np.random.default_rng(seed)
+    tiles = int(np.ceil(np.sqrt(label_num)))
+    tile_size = size // tiles
+    rows = np.minimum(np.arange(size) // tile_size, tiles - 1)
+    seg_s1 = (rows[:, None] * tiles + rows[None, :] + 1).astype(np.int64)
+    seg_s1[::tile_size, :] = 0
+    seg_s1[:, ::tile_size] = 0
+    shift = tile_size // 5
+    seg_s2 = np.roll(seg_s1, (shift, shift), axis=(0, 1))
+    seg_s2[rng.random(seg_s2.shape) < 0.05] = 0
+    seg_s2[seg_s2 != 0] += seg_s1.max()
+    return seg_s1, seg_s2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the overlap search between two slices")
+    parser.add_argument("-s", type=int, default=4096, help="Height/width of the slices. Default: 4096")
+    parser.add_argument("-n", type=int, default=5000, help="Approximate number of labels. Default: 5000")
+    parser.add_argument("-r", type=int, default=3, help="Repeats of the new method. Default: 3")
+    args = parser.parse_args()
+
+    seg_s1, seg_s2 = synthetic_slices(args.s, args.n)
+    print(f"Slices: {seg_s1.shape}, labels in s1: {len(np.unique(seg_s1)) - 1}, "
+          f"labels in s2: {len(np.unique(seg_s2)) - 1}")
+
+    times_new = []
+    for _ in range(args.r):
+        t0 = time.perf_counter()
+        links_new = extract_links_from_matching(OverlapTable(seg_s1, seg_s2), 0.5)
+        times_new.append(time.perf_counter() - t0)
+    print(f"OverlapTable: {np.min(times_new):.3f} s (best of {args.r})")
+
+    t0 = time.perf_counter()
+    labels_and_area_s1 = {label: area for label, area in zip(*labels_and_areas(seg_s1))}
+    labels_and_area_s2 = {label: area for label, area in zip(*labels_and_areas(seg_s2))}
+    links_old = extract_links_from_matching_deprecated(seg_s1, seg_s2, labels_and_area_s1, labels_and_area_s2, 0.5)
+    time_old = time.perf_counter() - t0
+    print(f"Label-by-label search: {time_old:.3f} s")
+
+    assert [(int(l1), int(l2)) for l1, l2 in links_old] == links_new, "The links are different!"
+    print(f"Both found the same {len(links_new)} links. Speedup: {time_old / np.min(times_new):.1f}x")
+
+
+if __name__ == '__main__':
+    main()
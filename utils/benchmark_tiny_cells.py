@@ -0,0 +1,65 @@
+"""
+Benchmark sorting the cells by areas and removing the tiny cells (TinyCells, used in round #2 and the export):
+the previous np.unique + label-by-label relabeling vs. the bincount + lookup table, for increasing label numbers.
+
+Usage: python benchmark_tiny_cells.py [-s 512] [-z 64] [-n 1000 4000 16000] [-k 0.9]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from seg2link.misc import TinyCells
+
+
+def synthetic_volume(size: int, depth: int, label_num: int, seed: int = 0) -> np.ndarray:
+    """A (size, size, depth) volume of boxes with random labels and sizes"""
+    rng = np.random.default_rng(seed)
+    tiles = int(np.ceil(np.sqrt(label_num)))
+    edges = np.sort(rng.choice(np.arange(1, size), tiles - 1, replace=False))
+    rows = np.searchsorted(edges, np.arange(size), side="right")
+    tile_ids = rows[:, None] * tiles + rows[None, :]
+    labels = rng.permutation(tiles * tiles * 2)[:tiles * tiles] + 1
+    labels[rng.random(len(labels)) < 0.05] = 0
+    return np.repeat(labels[tile_ids][:, :, None], depth, axis=2).astype(np.uint32)
+
+
+def time_it(func, repeats: int = 1):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    return result, np.min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sorting/removing of tiny cells")
+    parser.add_argument("-s", type=int, default=512, help="Height/width of the volume. Default: 512")
+    parser.add_argument("-z", type=int, default=64, help="Number of slices. Default: 64")
+    parser.add_argument("-n", type=int, nargs="+", default=[1000, 4000, 16000],
+                        help="Approximate numbers of labels. Default: 1000 4000 16000")
+    parser.add_argument("-k", type=float, default=0.9, help="Ratio of the cells to be kept. Default: 0.9")
+    args = parser.parse_args()
+
+    print(f"{'labels':>8} {'previous (s)':>13} {'new (s)':>9} {'speedup':>8}")
+    for label_num in args.n:
+        volume = synthetic_volume(args.s, args.z, label_num)
+        tc_old, tc_new = TinyCells(), TinyCells()
+
+        def previous():
+            tc_old.sort_by_areas_deprecated(volume)
+            return tc_old.remove_and_relabel_deprecated(volume, int(len(tc_old.sorted_labels) * args.k))
+
+        def new():
+            tc_new.sort_by_areas(volume)
+            return tc_new.remove_and_relabel(volume, int(len(tc_new.sorted_labels) * args.k))
+
+        result_new, time_new = time_it(new, repeats=3)
+        result_old, time_old = time_it(previous)
+        assert np.array_equal(result_old, result_new), "The results are different!"
+        print(f"{len(tc_new.sorted_labels):>8} {time_old:>13.3f} {time_new:>9.3f} {time_old / time_new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
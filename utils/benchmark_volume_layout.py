@@ -0,0 +1,65 @@
+"""
+Benchmark the per-slice access of the volumes (H, W, Z) in the two layouts (parameter z_first_layout):
+slices scattered across the volume (C order, z_first_layout=False) vs. contiguous slices (Fortran order, True).
+Reading/writing all slices is timed for an array in RAM and for a memory-mapped .npy file.
+
+Usage: python benchmark_volume_layout.py [-s 1024] [-z 64] [--dir path/to/temporary/folder]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from seg2link import parameters
+from seg2link.misc import empty_volume
+
+
+def per_slice_time(func, num_slices: int) -> float:
+    t0 = time.perf_counter()
+    for z in range(num_slices):
+        func(z)
+    return (time.perf_counter() - t0) / num_slices * 1000
+
+
+def benchmark(shape, out_path=None):
+    img = np.random.default_rng(0).integers(0, 2 ** 16, shape[:2], dtype=np.uint16)
+    volume = empty_volume(shape, np.uint16, out_path)
+
+    def write(z):
+        volume[..., z] = img
+
+    def read(z):
+        np.ascontiguousarray(volume[..., z])
+
+    time_write = per_slice_time(write, shape[2])
+    if out_path is not None:
+        volume.flush()
+        del volume
+        volume = np.load(out_path, mmap_mode="r")
+    time_read = per_slice_time(read, shape[2])
+    return time_write, time_read
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-slice access of the two volume layouts")
+    parser.add_argument("-s", type=int, default=1024, help="Height/width of the volume. Default: 1024")
+    parser.add_argument("-z", type=int, default=64, help="Number of slices. Default: 64")
+    parser.add_argument("--dir", type=Path, default=None, help="Folder for the memory-mapped files. Default: temp")
+    args = parser.parse_args()
+    shape = (args.s, args.s, args.z)
+
+    print(f"Volume {shape}, uint16. Time per slice (ms)")
+    print(f"{'layout':>22} {'storage':>8} {'write':>8} {'read':>8}")
+    with tempfile.TemporaryDirectory(dir=args.dir) as folder:
+        for z_first in (False, True):
+            parameters.pars.z_first_layout = z_first
+            layout = "Z first (Fortran)" if z_first else "Z last (C)"
+            for storage, out_path in (("RAM", None), ("memmap", Path(folder) / f"volume_{z_first}.npy")):
+                time_write, time_read = benchmark(shape, out_path)
+                print(f"{layout:>22} {storage:>8} {time_write:>8.2f} {time_read:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
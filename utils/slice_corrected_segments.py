@@ -7,10 +7,11 @@ Affiliation: Cardona lab, Cambridge University, UK
 """
 
 import numpy as np
-import tifffile as t
 import os
 import argparse
 
+from seg2link.writers import TiffSlicesWriter, write_slices
+
 
 def slice_segmentations(seg, slices):
     segm = np.load(seg, mmap_mode='r')
@@ -42,14 +43,11 @@ def slice_segmentations(seg, slices):
     elif slices[0].start is None and slices[0].stop is not None:
         z_index_range = range(0, slices[0].stop)
 
-    for z_index, slice in enumerate(z_index_range):
-        # Extract the Z slice
-        z_slice = segc[z_index, ...]
-        if z_slice.dtype not in [np.uint16, np.uint8]:
-            z_slice = z_slice.astype(np.uint16)
-
-        tiff_filename = f"{output_folder}/slice_{(slice):04}.tiff"
-        t.imwrite(str(tiff_filename), z_slice)
+    # The tiff files are named with the original indices of the slices
+    dtype = segc.dtype if segc.dtype in [np.uint16, np.uint8] else np.uint16
+    with TiffSlicesWriter(f"{output_folder}/slice_%04i.tiff", (*segc.shape[1:], len(z_index_range)), dtype,
+                          first_index=z_index_range[0] if len(z_index_range) else 0) as writer:
+        write_slices(writer, lambda z_index: segc[z_index, ...])
 
 
 # Custom function to parse None
@@ -2,9 +2,9 @@ import os
 import shutil
 
 import dask
-import tifffile
 from pathlib import Path
 from seg2link.misc import load_zarr
+from seg2link.writers import TiffSlicesWriter, write_slices
 import numpy as np
 
 
@@ -58,19 +58,12 @@ def _split(zarr_array, output_folder, ds):
 
     # Get the shape of the Zarr array
     shape_zarr = zarr_array.shape
+    dtype = zarr_array.dtype if zarr_array.dtype in [np.uint16, np.uint8] else np.uint16
 
-    # Iterate over the Z dimension and save each slice as a TIFF
-    for z_index, slice in enumerate(range(shape_zarr[0])):
-        # Extract the Z slice
-        z_slice = zarr_array[z_index, ...]
-        if z_slice.dtype not in [np.uint16, np.uint8]:
-            z_slice = z_slice.astype(np.uint16)
-
-        # Save the Z slice as a TIFF - format filename_0000.tif*
-        tiff_filename = output_folder / f"slice_{z_index:04}.tiff"
-        tifffile.imwrite(str(tiff_filename), z_slice)
-
-        print(f"Saved {tiff_filename}")
+    # Save each Z slice as a TIFF - format filename_0000.tif*
+    with TiffSlicesWriter(output_folder / "slice_%04i.tiff", (*shape_zarr[1:], shape_zarr[0]), dtype) as writer:
+        write_slices(writer, lambda z_index: zarr_array[z_index, ...],
+                     show_info=lambda info: print(f"{output_folder}: {info}"))
 
 
 if __name__ == '__main__':